@@ -1,16 +1,18 @@
 import streamlit as st
-import tensorflow as tf
-from tensorflow.keras.models import load_model
-from spacy.lang.en import English
+from app_warm_up import warm_up
 
+# TensorFlow, spaCy and the model are not imported here, so the page renders before they are loaded. The warm-up
+# thread loads them once per process, started by run_app.py at container start or by the first run of this script.
+# It serves the active version of the model registry, or deploy_models/model without one. Point SERVING_MODEL_PATH
+# at a .tflite file written by export_tflite.py to serve with the TFLite interpreter.
+warm_up.start()
 
-def split_chars(text):
+
+def get_inference_session():
     """
-    Converts a list of string to list of chars
-    :param text: string input to be converted to list of chars.
-    :return: list of chars.
+    Waits for the warm-up thread; every Streamlit session and rerun shares the same warmed up InferenceSession.
     """
-    return " ".join(list(text))
+    return warm_up.get_session()
 
 
 def preprocess_predict_text(input_text):
@@ -22,55 +24,36 @@ def preprocess_predict_text(input_text):
 
     Returns: processed text with line numbers
     """
-    language = English()
-    sentencizer = language.create_pipe("sentencizer")
-    language.add_pipe(sentencizer)
-    doc = language(input_text)
-    abstract_lines = [str(sentence) for sentence in list(doc.sents)]
-
-    # Get total number of lines
-    total_lines_in_sample = len(abstract_lines)
-
-    # Go through each line in abstract and create a list of dictionaries containing features for each line
-    sample_lines = []
-    for i, line in enumerate(abstract_lines):
-        sample_dict = {"text": str(line), "line_number": i, "total_lines": total_lines_in_sample - 1}
-        sample_lines.append(sample_dict)
-
-    test_abstract_line_numbers = [line["line_number"] for line in sample_lines]
-    # One-hot encode to same depth as training data, so model accepts right input shape
-    test_abstract_line_numbers_one_hot = tf.one_hot(test_abstract_line_numbers, depth=15)
-
-    # Get all total_lines values from sample abstract
-    test_abstract_total_lines = [line["total_lines"] for line in sample_lines]
-
-    # One-hot encode to same depth as training data, so model accepts right input shape
-    test_abstract_total_lines_one_hot = tf.one_hot(test_abstract_total_lines, depth=20)
-
-    abstract_chars = [split_chars(sentence) for sentence in abstract_lines]
-
-    loaded_model = load_serving_model()
-    test_abstract_pred_probs = loaded_model.predict(x=(test_abstract_line_numbers_one_hot,
-                                                       test_abstract_total_lines_one_hot,
-                                                       tf.constant(abstract_lines),
-                                                       tf.constant(abstract_chars)))
-
-    test_abstract_preds = tf.argmax(test_abstract_pred_probs, axis=1)
-    label = ['BACKGROUND', 'CONCLUSIONS', 'METHODS', 'OBJECTIVE', 'RESULTS']
-    test_abstract_pred_classes = [label[i] for i in test_abstract_preds]
     display_to_ui = {"OBJECTIVE": [], "BACKGROUND": [], "CONCLUSIONS": [], "METHODS": [], "RESULTS": []}
 
     # Visualize abstract lines and predicted sequence labels
-    for i, line in enumerate(abstract_lines):
-        display_to_ui[test_abstract_pred_classes[i]].append(line)
+    for line, label in get_inference_session().predict_abstract(input_text):
+        display_to_ui[label].append(line)
+    warm_up.mark("first_prediction")
 
     return display_to_ui
 
 
+def show_model_status():
+    """
+    Shows whether the model is still loading in the background, ready or failed to load.
+    """
+    status = warm_up.status()
+    if status["state"] == "ready":
+        version = f" ({status['model_version']})" if status["model_version"] else ""
+        latency = status["latency"]
+        abstracts = (f" Abstracts take {latency['abstract_ms_p50']:.0f} ms (median of {latency['abstracts']}, "
+                     f"first one {latency['first_abstract_ms']:.0f} ms).") if latency["abstracts"] else ""
+        st.success(f"Model ready{version}, loaded in {status['timings']['model_ready']:.1f}s.{abstracts}")
+    elif status["state"] == "failed":
+        st.error(f"The model could not be loaded: {status['error']}")
+    else:
+        st.info(f"Loading the model in the background ({status['seconds']:.0f}s). You can paste an abstract "
+                f"meanwhile, it is classified as soon as the model is ready.")
+
+
 def load_serving_model():
-    print("loading model...")
-    serving_model = load_model('deploy_models/model')
-    return serving_model
+    return get_inference_session().model
 
 
 def main():
@@ -95,13 +78,18 @@ def main():
             "-  CONCLUSIONS\n"
             "-  BACKGROUND\n"
             "-  OBJECTIVE\n")
-
+        show_model_status()
 
         input_text = st.text_area("Enter abstract here")
         if st.button("Submit"):
             if len(input_text) > 0:
-                with st.spinner("Processing..."):
-                    ui_elements = preprocess_predict_text(input_text)
+                spinner = "Processing..." if warm_up.ready.is_set() else "Waiting for the model to load..."
+                with st.spinner(spinner):
+                    try:
+                        ui_elements = preprocess_predict_text(input_text)
+                    except RuntimeError as e:
+                        st.error(str(e))
+                        st.stop()
                 with st.expander("Objective"):
                     if len(ui_elements["OBJECTIVE"]) > 0:
                         for methods in ui_elements["OBJECTIVE"]:
@@ -198,6 +186,8 @@ def main():
                  "\nIf you have any questions, please feel free to contact me at shreyas0906@gmail.com or raise an issue and i will have a"
                  "look into it.")
 
+    warm_up.mark("first_paint")
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import threading
+
+# Only the standard library is imported here: the app imports this module before its first paint.
+PROCESS_START = time.time()
+STARTUP_REPORT_PATH = "src/logs/app_startup.json"
+
+
+class WarmUp:
+    """
+    Imports the TensorFlow stack and builds the app's InferenceSession in a background thread, so
+    the Streamlit UI renders right away. Started once per process, by run_app.py at container start,
+    or by the first run of app.py when it is started with `streamlit run app.py`.
+
+    Startup events are timed from PROCESS_START and written to STARTUP_REPORT_PATH the first time
+    they happen: 'imports' and 'model_ready' here, 'first_paint' and 'first_prediction' by app.py.
+    """
+
+    def __init__(self, report_path=STARTUP_REPORT_PATH):
+        self.report_path = report_path
+        self.state = "idle"
+        self.session = None
+        self.error = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.timings = {}
+
+    def start(self, model_path=None):
+        """
+        Starts the warm-up thread if it is not started yet.
+        :param model_path: model to serve, defaults to SERVING_MODEL_PATH in the environment, then to
+        src.inference.default_serving_path().
+        """
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.state = "starting"
+            self.thread = threading.Thread(target=self.run, args=(model_path,), name="app-warm-up", daemon=True)
+            self.thread.start()
+
+    def run(self, model_path):
+        try:
+            self.state = "importing"
+            import src.inference  # TensorFlow and the src modules serving needs
+            self.mark("imports")
+
+            self.state = "loading"
+            model_path = model_path or os.environ.get("SERVING_MODEL_PATH") or src.inference.default_serving_path()
+            self.session = src.inference.InferenceSession(model_path,
+                                                          cache_size=src.inference.PREDICTION_CACHE_SIZE,
+                                                          version_check_interval=src.inference.HOT_SWAP_INTERVAL)
+            self.mark("model_ready")
+            self.state = "ready"
+        except Exception as e:
+            self.error = e
+            self.state = "failed"
+            print(f"warm-up failed: {e}")
+        finally:
+            self.ready.set()
+
+    def get_session(self, timeout=None):
+        """
+        :param timeout: seconds to wait for the warm-up, None to wait until it is done.
+        :return: the InferenceSession, None if it is not ready within timeout.
+        """
+        self.start()
+        if not self.ready.wait(timeout):
+            return None
+        if self.error is not None:
+            raise RuntimeError(f"the model could not be loaded: {self.error}") from self.error
+        return self.session
+
+    def mark(self, event):
+        """
+        Records the first time event happened, in seconds since PROCESS_START.
+        """
+        with self.lock:
+            if event in self.timings:
+                return
+            self.timings[event] = round(time.time() - PROCESS_START, 3)
+            timings = dict(self.timings)
+        try:
+            os.makedirs(os.path.dirname(self.report_path) or '.', exist_ok=True)
+            with open(self.report_path, 'w') as f:
+                json.dump(timings, f, indent=2)
+        except OSError:
+            pass  # a read-only deployment still serves
+
+    def status(self):
+        """
+        :return: dict with the warm-up state, the seconds since the process started, the startup
+        timings so far, and the served model version and its per abstract latency once ready.
+        """
+        return {"state": self.state,
+                "seconds": round(time.time() - PROCESS_START, 1),
+                "timings": dict(self.timings),
+                "model_version": self.session.model_version if self.session is not None else None,
+                "latency": self.session.latency_report() if self.session is not None else None,
+                "error": str(self.error) if self.error is not None else None}
+
+
+warm_up = WarmUp()
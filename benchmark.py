@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+import tempfile
+import src.benchmarks
+import src.data
+import src.models
+from argparse import ArgumentParser
+
+SUITES = ("imports", "parsing", "data_loader", "pipelines", "train_steps", "inference")
+
+
+def main(args):
+    """
+    Run the benchmark suites on a synthetic corpus, write the results and compare them with a baseline.
+    :param args: contains the benchmark configurations
+    :return: exit code, 1 if a regression was found and --fail-on-regression is set.
+    """
+    output, baseline_path = os.path.abspath(args.output), os.path.abspath(args.baseline)
+    args.store_data_dirs = [os.path.abspath(store_data_dir) for store_data_dir in args.store_data_dirs]
+    work_dir = os.path.abspath(args.work_dir)
+    data_dir = os.path.join(work_dir, f"corpus-{args.size}-{args.seed}")
+    if not os.path.exists(os.path.join(data_dir, src.data.SPLIT_FILES["test"])):
+        print(f"sentences written: {src.benchmarks.generate_corpus(data_dir, args.size, args.seed)}")
+    # labels.json and char_vocab.json are written to the working directory, keep them out of the repository
+    os.chdir(work_dir)
+
+    results = src.benchmarks.run_benchmarks(data_dir, batch_size=args.batch_size, num_workers=args.num_workers,
+                                            num_batches=args.num_batches, train_repeats=args.repeats,
+                                            parse_workers=args.parse_workers, store_data_dirs=args.store_data_dirs,
+                                            suites=args.suites)
+    report = {"environment": src.benchmarks.get_environment(),
+              "config": {"size": args.size, "seed": args.seed, "batch_size": args.batch_size,
+                         "num_workers": args.num_workers, "parse_workers": args.parse_workers},
+              "results": results}
+
+    regressions = []
+    if os.path.exists(baseline_path) and not args.update_baseline:
+        with open(baseline_path, 'r') as f:
+            baseline = json.load(f)
+        if baseline["config"] != report["config"]:
+            print(f"warning: baseline config {baseline['config']} differs from {report['config']}")
+        report["comparison"] = src.benchmarks.compare_results(results, baseline["results"], args.tolerance)
+        regressions = [entry for entry in report["comparison"] if entry["regression"]]
+        for entry in report["comparison"]:
+            flag = "REGRESSION" if entry["regression"] else ""
+            print(f"{entry['benchmark']:>45} {entry['metric']:>18} {entry['baseline']:>12} -> "
+                  f"{entry['value']:>12} ({100 * entry['change']:+.1f}%) {flag}")
+    else:
+        print(json.dumps(results, indent=2))
+
+    for path in [output] + ([baseline_path] if args.update_baseline else []):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"saved results to {path}")
+
+    if regressions:
+        print(f"{len(regressions)} benchmarks regressed by more than {100 * args.tolerance:.0f}%")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == '__main__':
+
+    p = ArgumentParser()
+    p.add_argument('--size', required=False, type=str, default='small',
+                   help=f'synthetic corpus size, one of {list(src.benchmarks.CORPUS_SIZES)} or a number of abstracts')
+    p.add_argument('--seed', required=False, type=int, default=42, help='seed of the synthetic corpus')
+    p.add_argument('--suites', required=False, type=str, nargs='+', default=list(SUITES), choices=SUITES,
+                   help='benchmark suites to run, inference needs train_steps')
+    p.add_argument('--batch-size', required=False, type=int, default=src.models.BATCH_SIZE, help='pipeline batch size')
+    p.add_argument('--num-workers', required=False, type=int, default=1,
+                   help='number of processes parsing the splits in the data_loader suite')
+    p.add_argument('--parse-workers', required=False, type=int, nargs='+', default=list(src.benchmarks.PARSE_WORKERS),
+                   help='numbers of processes the parsing suite times parsing every split with')
+    p.add_argument('--store-data-dirs', required=False, type=str, nargs='*', default=[],
+                   help='dataset directories, e.g. PubMed 20k and 200k, whose train split memory as a SampleStore '
+                        'is compared with the former lists and DataFrame too')
+    p.add_argument('--num-batches', required=False, type=int, default=50,
+                   help='number of batches read from every pipeline')
+    p.add_argument('--repeats', required=False, type=int, default=20, help='number of timed train steps per model')
+    p.add_argument('--work-dir', required=False, type=str,
+                   default=os.path.join(tempfile.gettempdir(), 'pubmed-rct-benchmarks'),
+                   help='directory of the synthetic corpus and its caches')
+    p.add_argument('--output', required=False, type=str, default='benchmarks/results.json',
+                   help='JSON file to write the results to')
+    p.add_argument('--baseline', required=False, type=str, default='benchmarks/baseline.json',
+                   help='results of an earlier run to compare with')
+    p.add_argument('--tolerance', required=False, type=float, default=0.1,
+                   help='relative slow down accepted before a benchmark is flagged as a regression')
+    p.add_argument('--update-baseline', action='store_true', help='write the results to --baseline as well')
+    p.add_argument('--fail-on-regression', action='store_true',
+                   help='exit with status 1 on a regression, an error without a --baseline to compare with')
+    args = p.parse_args()
+
+    if args.fail_on_regression and not args.update_baseline and not os.path.exists(args.baseline):
+        p.error(f'--fail-on-regression needs a baseline, {args.baseline} does not exist. Record one with '
+                f'--update-baseline first')
+
+    sys.exit(main(args))
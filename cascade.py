@@ -0,0 +1,62 @@
+import os
+import json
+import shutil
+import src.cascade
+import src.data
+import src.inference
+import src.models
+from argparse import ArgumentParser
+from tensorflow.keras.models import load_model
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+
+def build_cascade(args):
+    """
+    Train the first stage of the cascade on top of a trained tribrid model, pick the confidence threshold
+    on the validation split and report escalation rate, accuracy and latency per threshold on the test split.
+    :param args: contains the cascade configurations
+    :return:
+    """
+    data = src.models.get_data()
+    full_model = load_model(args.model_path)
+
+    first_stage = src.cascade.first_stage_model(full_model, num_buckets=args.num_buckets)
+    train_dataset, validation_dataset = data.get_positional_token_data()
+    first_stage.fit(train_dataset, epochs=args.epochs, validation_data=validation_dataset)
+
+    cascade = src.cascade.CascadeModel(first_stage, full_model)
+    thresholds = sorted(set(args.thresholds) | {1.01})  # above 1, every sentence goes to the full model
+    print("validation split:")
+    val_results = src.cascade.sweep_thresholds(cascade, data.val_store, thresholds, num_samples=args.eval_samples)
+    threshold = src.cascade.pick_threshold(val_results, max_accuracy_drop=args.max_accuracy_drop)
+    print(f"picked threshold {threshold}, test split:")
+    test_results = src.cascade.sweep_thresholds(cascade, data.test_store, thresholds, num_samples=args.eval_samples)
+
+    src.cascade.save_cascade(first_stage, args.model_path, args.output_dir, threshold)
+    labels_path = os.path.join(args.model_path, 'labels.json')
+    shutil.copy(labels_path if os.path.exists(labels_path) else src.data.LABELS_PATH, args.output_dir)
+    with open(os.path.join(args.output_dir, 'report.json'), 'w') as f:
+        json.dump({"threshold": threshold, "validation": val_results, "test": test_results}, f, indent=2)
+    print(f"saved report to {os.path.join(args.output_dir, 'report.json')}")
+
+
+if __name__ == '__main__':
+
+    p = ArgumentParser()
+    p.add_argument('--model-path', required=False, type=str, default=src.inference.SERVING_MODEL_PATH,
+                   help='directory of the trained tribrid model used as the full model')
+    p.add_argument('--output-dir', required=False, type=str, default='deploy_models/cascade',
+                   help='directory to save the first stage, cascade.json and the report to')
+    p.add_argument('--epochs', required=False, type=int, default=5, help='number of epochs of the first stage')
+    p.add_argument('--num-buckets', required=False, type=int, default=2 ** 16,
+                   help='number of hashed word embeddings of the first stage')
+    p.add_argument('--thresholds', required=False, type=float, nargs='+',
+                   default=list(src.cascade.DEFAULT_THRESHOLDS), help='first stage confidence thresholds to evaluate')
+    p.add_argument('--max-accuracy-drop', required=False, type=float, default=0.005,
+                   help='largest validation accuracy loss accepted for the picked threshold')
+    p.add_argument('--eval-samples', required=False, type=int, default=5000,
+                   help='number of sentences of each split the thresholds are evaluated on')
+    args = p.parse_args()
+
+    build_cascade(args)
@@ -0,0 +1,100 @@
+import os
+import json
+import src.data
+import src.evaluation
+import src.inference
+import src.registry
+import src.tfrecords
+from argparse import ArgumentParser
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+
+def get_dataset(args, class_names, data=None):
+    """
+    :param data: DataLoader of the dataset directory, when evaluating one of its splits.
+    :return: batches of (inputs, one hot labels, line numbers) of the evaluated source.
+    """
+    if args.tfrecords_dir:
+        return src.tfrecords.read_split(args.tfrecords_dir, args.split, args.batch_size,
+                                        ('line_numbers', 'total_lines', 'tokens', 'chars'), len(class_names),
+                                        with_line_numbers=True)
+    if args.jsonl:
+        return src.evaluation.read_jsonl_split(args.jsonl, args.batch_size, class_names)
+    return data.get_test_dataset(args.split, with_line_numbers=True)
+
+
+def get_class_names(args, models, data=None):
+    """
+    :param data: DataLoader of the dataset directory, when evaluating one of its splits.
+    :return: class names of the source labels, in label id order.
+    """
+    if args.tfrecords_dir:
+        return src.tfrecords.read_split_meta(args.tfrecords_dir, args.split)["class_names"]
+    if args.jsonl:
+        return next(iter(models.values()))["labels"]
+    return data.class_names
+
+
+def evaluate(args):
+    """
+    Evaluate one or more models over the same pass of an evaluation split and write the report.
+    :param args: contains the evaluation configurations
+    :return:
+    """
+    models = src.evaluation.load_models(args.models, registry_dir=args.registry_dir)
+    data = None
+    if not (args.tfrecords_dir or args.jsonl):
+        data = src.data.DataLoader(batch_size=args.batch_size, data_dir=args.data_dir)
+    class_names = get_class_names(args, models, data)
+    report = src.evaluation.evaluate_models(models, get_dataset(args, class_names, data), class_names,
+                                            max_batches=args.max_batches)
+    report["config"] = {"source": args.tfrecords_dir or args.jsonl or "split", "split": args.split,
+                        "batch_size": args.batch_size, "max_batches": args.max_batches}
+
+    for name, metrics in report["models"].items():
+        agreement = metrics.get("agreement_with_reference")
+        agreement = f", agreement {agreement:.4f}" if agreement is not None else ""
+        print(f"{name:>30}: accuracy {metrics['accuracy']:.4f}, macro F1 {metrics['macro_f1']:.4f}, "
+              f"{metrics['sentences_per_sec']} sentences/sec, per-batch latency p50/p99 "
+              f"{metrics['batch_latency_ms']['p50']}/{metrics['batch_latency_ms']['p99']} ms{agreement}")
+    print(f"wall time {report['wall_seconds']} secs, waiting for the input pipeline {report['input_wait_seconds']} "
+          f"secs")
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"saved report to {args.output}")
+
+
+if __name__ == '__main__':
+
+    p = ArgumentParser()
+    p.add_argument('--models', required=False, type=str, nargs='+',
+                   default=['active' if src.registry.is_registry(src.registry.REGISTRY_DIR)
+                            else src.inference.SERVING_MODEL_PATH],
+                   help="models to compare: registry versions, 'active', 'latest' or model paths. The first one is "
+                        "the reference the agreement of the others is measured against")
+    p.add_argument('--registry-dir', required=False, type=str, default=src.registry.REGISTRY_DIR,
+                   help='model registry the version names refer to')
+    p.add_argument('--split', required=False, type=str, default='test', choices=list(src.data.SPLIT_FILES),
+                   help='split of the dataset, or of --tfrecords-dir, to evaluate on')
+    p.add_argument('--data-dir', required=False, type=str, default=None,
+                   help='dataset directory with the split files, defaults to the one train.py uses')
+    p.add_argument('--tfrecords-dir', required=False, type=str, default=None,
+                   help='evaluate on the TFRecord shards written by export_tfrecords.py in this directory')
+    p.add_argument('--jsonl', required=False, type=str, default=None,
+                   help='evaluate on a JSONL file of labelled sentences with text, target, line_number and '
+                        'total_lines fields')
+    p.add_argument('--batch-size', required=False, type=int, default=src.evaluation.EVALUATION_BATCH_SIZE,
+                   help='number of sentences per model batch')
+    p.add_argument('--max-batches', required=False, type=int, default=None,
+                   help='number of batches evaluated, defaults to the whole source')
+    p.add_argument('--output', required=False, type=str, default='reports/evaluation.json',
+                   help='JSON file to write the report to')
+    args = p.parse_args()
+
+    if args.tfrecords_dir and args.jsonl:
+        p.error('--tfrecords-dir cannot be combined with --jsonl')
+
+    evaluate(args)
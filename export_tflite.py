@@ -0,0 +1,64 @@
+import os
+import json
+import src.data
+import src.inference
+import src.models
+import src.tflite
+from argparse import ArgumentParser
+from tensorflow.keras.models import load_model
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+
+def export(args):
+    """
+    Convert a trained tribrid model to TFLite and compare the variants.
+    :param args: contains the export configurations
+    :return:
+    """
+    data = src.models.get_data()
+    src.tflite.check_labels(args.model_path, data.class_names)
+    model = load_model(args.model_path)
+    labels_path = os.path.join(args.model_path, 'labels.json')
+
+    model_paths = {"keras": args.model_path}
+    for quantization in args.quantizations:
+        representative_dataset = None
+        if quantization == "int8":
+            representative_dataset = src.tflite.calibration_samples(model, data.train_store,
+                                                                    num_samples=args.calibration_samples)
+        tflite_path = os.path.join(args.output_dir, f"model_{quantization}.tflite")
+        src.tflite.export_tflite(model, tflite_path, quantization, representative_dataset,
+                                 labels_path=labels_path if os.path.exists(labels_path) else src.data.LABELS_PATH)
+        model_paths[quantization] = tflite_path
+
+    if args.eval_samples:
+        report = src.tflite.compare_backends(model_paths, data.test_store,
+                                             num_samples=args.eval_samples,
+                                             num_latency_samples=args.latency_samples,
+                                             num_threads=args.threads)
+        report_path = os.path.join(args.output_dir, 'report.json')
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"saved report to {report_path}")
+
+
+if __name__ == '__main__':
+
+    p = ArgumentParser()
+    p.add_argument('--model-path', required=False, type=str, default=src.inference.SERVING_MODEL_PATH,
+                   help='directory of the saved tribrid model')
+    p.add_argument('--output-dir', required=False, type=str, default='deploy_models/tflite',
+                   help='directory to write the .tflite files and the report to')
+    p.add_argument('--quantizations', required=False, nargs='+', default=list(src.tflite.QUANTIZATIONS),
+                   choices=src.tflite.QUANTIZATIONS, help='variants to export')
+    p.add_argument('--calibration-samples', required=False, type=int, default=200,
+                   help='number of train sentences used to calibrate int8 quantization')
+    p.add_argument('--eval-samples', required=False, type=int, default=2000,
+                   help='number of test sentences the variants are compared on, 0 to skip the report')
+    p.add_argument('--latency-samples', required=False, type=int, default=200,
+                   help='number of sentences predicted one at a time to measure latency')
+    p.add_argument('--threads', required=False, type=int, default=None, help='number of TFLite interpreter threads')
+    args = p.parse_args()
+
+    export(args)
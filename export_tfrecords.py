@@ -0,0 +1,35 @@
+import os
+import time
+import src.models
+import src.tfrecords
+from argparse import ArgumentParser
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+
+def export(args):
+    """
+    Export the dataset splits to sharded TFRecord files.
+    :param args: contains the export configurations
+    :return:
+    """
+    data = src.models.get_data()
+    tfrecords_dir = args.output_dir or src.tfrecords.get_tfrecords_dir(data.DATA_DIR)
+
+    start = time.time()
+    counts = src.tfrecords.export_splits(data.DATA_DIR, tfrecords_dir, data.class_names,
+                                         num_shards=args.num_shards, splits=args.splits)
+    print(f"Exported {sum(counts.values())} sentences in {time.time() - start:.2f} secs to {tfrecords_dir}")
+
+
+if __name__ == '__main__':
+
+    p = ArgumentParser()
+    p.add_argument('--output-dir', required=False, type=str, default=None,
+                   help='directory to write the shards to, defaults to pubmed-rct/<dataset>_tfrecords')
+    p.add_argument('--num-shards', required=False, type=int, default=8, help='number of shards per split')
+    p.add_argument('--splits', required=False, nargs='+', default=['train', 'val', 'test'],
+                   choices=['train', 'val', 'test'], help='splits to export')
+    args = p.parse_args()
+
+    export(args)
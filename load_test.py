@@ -0,0 +1,60 @@
+import os
+import json
+import asyncio
+import itertools
+import src.models
+import src.parsing
+import src.serving
+from argparse import ArgumentParser
+
+
+def load_abstracts(args):
+    """
+    :param args: contains the load test configurations
+    :return: list of abstract texts to send.
+    """
+    if args.input:
+        with open(args.input, 'r') as f:
+            records = (json.loads(line) for line in f if line.strip())
+            return [record[args.text_field] for record in itertools.islice(records, args.num_abstracts)]
+
+    data_file = args.data_file or src.models.get_data().DATA_DIR + 'test.txt'
+    return [" ".join(line["text"] for line in abstract)
+            for abstract in itertools.islice(src.parsing.iter_abstracts(data_file), args.num_abstracts)]
+
+
+def main(args):
+    """
+    Send concurrent requests to a running serve.py and report throughput and latency percentiles.
+    :param args: contains the load test configurations
+    :return:
+    """
+    abstracts = load_abstracts(args)
+    report = asyncio.get_event_loop().run_until_complete(
+        src.serving.run_load_test(args.host, args.port, abstracts,
+                                  num_requests=args.requests, concurrency=args.concurrency))
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+
+    p = ArgumentParser()
+    p.add_argument('--host', required=False, type=str, default='127.0.0.1', help='address of the server')
+    p.add_argument('--port', required=False, type=int, default=8000, help='port of the server')
+    p.add_argument('--requests', required=False, type=int, default=1000, help='number of requests to send')
+    p.add_argument('--concurrency', required=False, type=int, default=32, help='number of concurrent clients')
+    p.add_argument('--input', required=False, type=str, default=None,
+                   help='JSONL file of abstracts to send, defaults to the abstracts of the test split')
+    p.add_argument('--text-field', required=False, type=str, default='abstract', help='field holding the abstract')
+    p.add_argument('--data-file', required=False, type=str, default=None,
+                   help='PubMed RCT file to take the abstracts from when --input is not given')
+    p.add_argument('--num-abstracts', required=False, type=int, default=500, help='number of distinct abstracts')
+    p.add_argument('--output', required=False, type=str, default=None, help='JSON file to write the report to')
+    args = p.parse_args()
+
+    main(args)
@@ -0,0 +1,50 @@
+import os
+import src.batch_inference
+from argparse import ArgumentParser
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+
+def predict(args):
+    """
+    Label every sentence of a JSONL file of abstracts.
+    :param args: contains the prediction configurations
+    :return:
+    """
+    src.batch_inference.predict_jsonl(args.input, args.output, args.model_path,
+                                      batch_size=args.batch_size,
+                                      num_workers=args.workers,
+                                      chunk_size=args.chunk_size,
+                                      start_offset=args.start_offset,
+                                      resume=args.resume,
+                                      text_field=args.text_field,
+                                      id_field=args.id_field,
+                                      include_probs=args.include_probs)
+
+
+if __name__ == '__main__':
+
+    p = ArgumentParser()
+    p.add_argument('--input', required=True, type=str, help='JSONL file with one abstract per line')
+    p.add_argument('--output', required=True, type=str, help='JSONL file to write one prediction per sentence to')
+    p.add_argument('--model-path', required=False, type=str, default=None,
+                   help='model registry, whose active version is used, or directory of a saved tribrid model. '
+                        'Defaults to the registry train.py registers its models in, or deploy_models/model')
+    p.add_argument('--batch-size', required=False, type=int, default=1024, help='number of sentences per model batch')
+    p.add_argument('--workers', required=False, type=int, default=os.cpu_count(),
+                   help='number of sentence splitting processes, 1 to split in the main process')
+    p.add_argument('--chunk-size', required=False, type=int, default=256,
+                   help='number of abstracts sent to a worker at once')
+    p.add_argument('--start-offset', required=False, type=int, default=0,
+                   help='byte offset into the input to start from, must be the start of a line')
+    p.add_argument('--resume', action='store_true',
+                   help='continue an interrupted run from the last complete abstract in --output')
+    p.add_argument('--text-field', required=False, type=str, default='abstract', help='field holding the abstract')
+    p.add_argument('--id-field', required=False, type=str, default='id', help='field holding the abstract id')
+    p.add_argument('--include-probs', action='store_true', help='write the probabilities of every class')
+    args = p.parse_args()
+
+    if args.resume and args.start_offset:
+        p.error('--start-offset cannot be combined with --resume')
+
+    predict(args)
@@ -0,0 +1,50 @@
+import json
+import src.inference
+import src.registry
+from argparse import ArgumentParser
+
+
+def main(args):
+    """
+    List, register, activate or remove model versions of the registry.
+    :param args: contains the registry command
+    :return:
+    """
+    if args.command == 'list':
+        index = src.registry.read_index(args.registry_dir)
+        for version, manifest in sorted(index["versions"].items(), key=lambda item: item[1]["created"]):
+            metrics = {name: round(value, 4) for name, value in manifest["metrics"].items()}
+            print(f"{'*' if version == index['active'] else ' '} {version:<32} {manifest['path']:<40} {metrics}")
+    elif args.command == 'show':
+        version = args.version or src.registry.get_active_version(args.registry_dir)[0]
+        print(json.dumps(src.registry.read_index(args.registry_dir)["versions"][version], indent=2))
+    elif args.command == 'register':
+        # models saved before the registry existed, e.g. deploy_models/model
+        model = src.inference.load_serving_model(args.model_path)
+        src.registry.register_model(args.model_path, src.registry.get_input_signature(model),
+                                    activate=args.activate, registry_dir=args.registry_dir)
+    elif args.command == 'activate':
+        src.registry.activate_version(args.version, args.registry_dir)
+    elif args.command == 'remove':
+        src.registry.remove_version(args.version, args.registry_dir)
+
+
+if __name__ == '__main__':
+
+    p = ArgumentParser()
+    p.add_argument('command', type=str, choices=['list', 'show', 'register', 'activate', 'remove'],
+                   help='list the versions, show one manifest, register a saved model, activate or remove a version')
+    p.add_argument('--version', required=False, type=str, default=None,
+                   help='version to show, activate or remove, show defaults to the active one')
+    p.add_argument('--model-path', required=False, type=str, default=None, help='saved model directory to register')
+    p.add_argument('--activate', action='store_true', help='make the registered model the active version')
+    p.add_argument('--registry-dir', required=False, type=str, default=src.registry.REGISTRY_DIR,
+                   help='directory of the model registry')
+    args = p.parse_args()
+
+    if args.command in ('activate', 'remove') and not args.version:
+        p.error(f'{args.command} needs --version')
+    if args.command == 'register' and not args.model_path:
+        p.error('register needs --model-path')
+
+    main(args)
@@ -0,0 +1,22 @@
+import sys
+from app_warm_up import warm_up
+
+
+def main():
+    """
+    Starts loading the model in the background, then runs the Streamlit server in the same process,
+    so the model is usually ready by the time the first visitor submits an abstract.
+    Extra arguments are passed to `streamlit run app.py`, e.g. --server.port 8501.
+    :return:
+    """
+    warm_up.start()
+    try:
+        from streamlit.web import cli as streamlit_cli  # streamlit >= 1.12
+    except ImportError:
+        from streamlit import cli as streamlit_cli
+    sys.argv = ["streamlit", "run", "app.py"] + sys.argv[1:]
+    sys.exit(streamlit_cli.main())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import subprocess
+import src.distribute
+from argparse import ArgumentParser
+
+
+def read_throughput(run_name):
+    """
+    :param run_name: --run-name of a finished train.py run.
+    :return: examples/sec of its last epoch, the first one includes tracing the train step.
+    """
+    with open(os.path.join('src/logs', f"step_times_{run_name}.json"), 'r') as f:
+        return json.load(f)["epochs"][-1]["examples_per_sec"]
+
+
+def run_training(args, num_replicas):
+    """
+    Runs a short train.py with num_replicas replicas and waits for it.
+    :param args: contains the benchmark configurations
+    :return: --run-name of the run.
+    """
+    run_name = f"scaling-{args.strategy}-{num_replicas}"
+    command = [sys.executable, 'train.py', '--epochs', str(args.epochs), '--steps-per-epoch', str(args.steps),
+               '--run-name', run_name, '--no-save'] + args.train_args
+    if num_replicas == 1:
+        processes = [subprocess.Popen(command + ['--strategy', 'single'])]
+    elif args.strategy == 'mirrored':
+        processes = [subprocess.Popen(command + ['--strategy', 'mirrored', '--num-devices', str(num_replicas)])]
+    else:
+        # one process per worker, each limited to its share of the cores
+        threads = str(max(os.cpu_count() // num_replicas, 1))
+        processes = []
+        for index in range(num_replicas):
+            env = dict(os.environ,
+                       TF_CONFIG=src.distribute.local_tf_config(num_replicas, index, args.base_port),
+                       TF_NUM_INTRAOP_THREADS=threads, OMP_NUM_THREADS=threads)
+            processes.append(subprocess.Popen(command + ['--strategy', 'multi-worker'], env=env))
+
+    if any(process.wait() != 0 for process in processes):
+        raise RuntimeError(f"training with {num_replicas} replicas failed")
+    return run_name
+
+
+def main(args):
+    """
+    Train for a few steps with 1, 2, 4, ... replicas and report the throughput and scaling efficiency.
+    :param args: contains the benchmark configurations
+    :return:
+    """
+    runs = {}
+    for num_replicas in sorted(set([1] + args.replicas)):
+        runs[num_replicas] = read_throughput(run_training(args, num_replicas))
+        print(f"{num_replicas} replicas: {runs[num_replicas]} examples/sec")
+
+    report = {"strategy": args.strategy,
+              "steps_per_epoch": args.steps,
+              "replicas": src.distribute.scaling_report(runs)}
+    print(json.dumps(report, indent=2))
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+
+    p = ArgumentParser()
+    p.add_argument('--strategy', required=False, type=str, default='multi-worker', choices=['mirrored', 'multi-worker'],
+                   help='mirrored over logical CPU devices of one process, or multi-worker over local processes')
+    p.add_argument('--replicas', required=False, type=int, nargs='+', default=[2, 4],
+                   help='numbers of replicas to compare with a single replica')
+    p.add_argument('--epochs', required=False, type=int, default=2,
+                   help='epochs per run, the throughput is taken from the last one')
+    p.add_argument('--steps', required=False, type=int, default=50, help='train steps per epoch')
+    p.add_argument('--base-port', required=False, type=int, default=12345, help='port of the first local worker')
+    p.add_argument('--output', required=False, type=str, default='src/logs/scaling_report.json',
+                   help='JSON file to write the report to')
+    p.add_argument('train_args', nargs='*', help='extra train.py arguments, after --, e.g. -- --cached-embeddings')
+    args = p.parse_args()
+
+    main(args)
@@ -0,0 +1,51 @@
+import os
+import asyncio
+import src.inference
+import src.serving
+from argparse import ArgumentParser
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+
+def main(args):
+    """
+    Serve the tribrid model over HTTP with micro-batching.
+    :param args: contains the serving configurations
+    :return:
+    """
+    session = src.inference.InferenceSession(args.model_path, cache_size=args.cache_size, cache_ttl=args.cache_ttl,
+                                             version_check_interval=args.version_check_interval)
+    max_batch_size, max_wait_ms = (1, 0.0) if args.per_request else (args.max_batch, args.max_wait_ms)
+    try:
+        asyncio.get_event_loop().run_until_complete(
+            src.serving.serve(session, host=args.host, port=args.port,
+                              max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+                              split_workers=args.split_workers))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+
+    p = ArgumentParser()
+    p.add_argument('--model-path', required=False, type=str, default=src.inference.default_serving_path(),
+                   help='model registry, whose active version is served, or directory of a saved tribrid model')
+    p.add_argument('--version-check-interval', required=False, type=float, default=src.inference.HOT_SWAP_INTERVAL,
+                   help='seconds between checks for a newly activated model to swap in, 0 to never swap')
+    p.add_argument('--host', required=False, type=str, default='127.0.0.1', help='address to listen on')
+    p.add_argument('--port', required=False, type=int, default=8000, help='port to listen on')
+    p.add_argument('--max-batch', required=False, type=int, default=256,
+                   help='number of sentences after which a batch is closed')
+    p.add_argument('--max-wait-ms', required=False, type=float, default=5.0,
+                   help='time a request waits for others to join its batch')
+    p.add_argument('--split-workers', required=False, type=int, default=2,
+                   help='number of threads splitting abstracts into sentences off the event loop')
+    p.add_argument('--per-request', action='store_true',
+                   help='predict every request on its own, the baseline for the load test')
+    p.add_argument('--cache-size', required=False, type=int, default=src.inference.PREDICTION_CACHE_SIZE,
+                   help='number of sentence predictions to cache, 0 to disable the cache')
+    p.add_argument('--cache-ttl', required=False, type=float, default=None,
+                   help='seconds a cached sentence prediction stays valid')
+    args = p.parse_args()
+
+    main(args)
@@ -1,4 +0,0 @@
-import tensorflow as tf
-from src.callbacks import *
-from src.data import *
-from src.models import *
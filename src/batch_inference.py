@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import time
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from src.parsing import split_chars, make_sentencizer
+
+# src.inference, and with it tensorflow, is only imported once the sentence splitting workers are started.
+
+_sentencizer = None
+
+
+def init_sentencizer():
+    """
+    Creates the sentencizer of this process, used as the initializer of the worker pool.
+    """
+    global _sentencizer
+    if _sentencizer is None:
+        _sentencizer = make_sentencizer()
+
+
+def iter_jsonl(filename, start_offset=0):
+    """
+    Streams the non empty lines of a JSONL file.
+    :param filename: path to the JSONL file.
+    :param start_offset: byte offset to start reading from, must be the start of a line.
+    :return: generator of (byte offset of the line, raw line)
+    """
+    with open(filename, 'rb') as f:
+        f.seek(start_offset)
+        offset = start_offset
+        for line in f:
+            if line.strip():
+                yield offset, line
+            offset += len(line)
+
+
+def iter_chunks(iterable, chunk_size):
+    """
+    :return: generator of lists of at most chunk_size consecutive items of iterable.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def split_abstracts(chunk, text_field='abstract', id_field='id'):
+    """
+    Parses JSONL records and splits their abstracts into sentences. Runs in the worker processes.
+    :param chunk: list of (byte offset, raw line) from iter_jsonl.
+    :param text_field: field holding the abstract text.
+    :param id_field: field holding the abstract id, the byte offset is used when it is missing.
+    :return: list of abstract dicts with offset, id, sentences and character-spaced chars.
+    """
+    init_sentencizer()
+    abstracts = []
+    for offset, line in chunk:
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"invalid JSON record at byte offset {offset}: {e}")
+        # same sentence splitting as InferenceSession.split_sentences, so labels match the app's
+        sentences = [str(sentence) for sentence in _sentencizer(record.get(text_field) or "").sents]
+        abstracts.append({"offset": offset,
+                          "id": record.get(id_field, offset),
+                          "sentences": sentences,
+                          "chars": [split_chars(sentence) for sentence in sentences]})
+    return abstracts
+
+
+@contextmanager
+def sentence_split_pool(num_workers):
+    """
+    Worker pool splitting abstracts into sentences, None when num_workers <= 1.
+    The workers are started right away, before tensorflow is imported and the model loaded in this
+    process, so forking never copies a TensorFlow runtime. They are spawned when the caller has
+    already imported tensorflow.
+    """
+    if num_workers <= 1:
+        yield None
+        return
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods and 'tensorflow' not in sys.modules else 'spawn')
+    pool = context.Pool(num_workers, initializer=init_sentencizer)
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iter_split_abstracts(filename, pool=None, start_offset=0, chunk_size=256, max_pending_chunks=8,
+                         text_field='abstract', id_field='id'):
+    """
+    Streams the abstracts of a JSONL file split into sentences, in file order. At most
+    max_pending_chunks chunks are in flight in the pool, so memory stays bounded whatever the
+    size of the file.
+    :param filename: path to the JSONL file.
+    :param pool: pool returned by sentence_split_pool, None to split in this process.
+    :param start_offset: byte offset to start reading from.
+    :param chunk_size: number of records sent to a worker at once.
+    :param max_pending_chunks: number of chunks in flight.
+    :return: generator of abstract dicts, see split_abstracts.
+    """
+    chunks = iter_chunks(iter_jsonl(filename, start_offset), chunk_size)
+    if pool is None:
+        for chunk in chunks:
+            yield from split_abstracts(chunk, text_field, id_field)
+        return
+
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(split_abstracts, (chunk, text_field, id_field)))
+        if len(pending) >= max_pending_chunks:
+            yield from pending.popleft().get()
+    while pending:
+        yield from pending.popleft().get()
+
+
+def find_resume_offset(output_path, input_path):
+    """
+    Finds where an interrupted run stopped. The output is truncated after the last abstract whose
+    sentences were all written, and the input offset of the next abstract is returned.
+    :param output_path: predictions written by predict_jsonl.
+    :param input_path: JSONL input of the interrupted run.
+    :return: byte offset into input_path to resume from.
+    """
+    if not os.path.exists(output_path):
+        return 0
+
+    end, last_offset = 0, None
+    with open(output_path, 'rb') as f:
+        position = 0
+        for line in f:
+            position += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break  # partially written line
+            if record["line_number"] == record["total_lines"]:
+                end, last_offset = position, record["offset"]
+
+    with open(output_path, 'r+b') as f:
+        f.truncate(end)
+
+    if last_offset is None:
+        return 0
+    with open(input_path, 'rb') as f:
+        f.seek(last_offset)
+        f.readline()
+        return f.tell()
+
+
+def prediction_records(abstract, labels, include_probs=False):
+    """
+    :param abstract: abstract dict with its predicted probabilities.
+    :param labels: label names indexed by class id.
+    :param include_probs: add the probabilities of every class to the records.
+    :return: list of per sentence output records.
+    """
+    total_lines = len(abstract["sentences"]) - 1
+    records = []
+    for line_number, (sentence, probs) in enumerate(zip(abstract["sentences"], abstract["probs"])):
+        label_id = int(probs.argmax())
+        record = {"id": abstract["id"],
+                  "offset": abstract["offset"],
+                  "line_number": line_number,
+                  "total_lines": total_lines,
+                  "sentence": sentence,
+                  "label": labels[label_id],
+                  "confidence": round(float(probs[label_id]), 6)}
+        if include_probs:
+            record["probs"] = {label: round(float(p), 6) for label, p in zip(labels, probs)}
+        records.append(record)
+    return records
+
+
+def predict_batch(session, batch):
+    """
+    Predicts one packed batch and stores the probabilities in the abstracts the sentences belong to.
+    :param session: InferenceSession
+    :param batch: list of (abstract dict, line number)
+    """
+    from src.inference import make_features
+
+    features = make_features([abstract["sentences"][i] for abstract, i in batch],
+                             [i for _, i in batch],
+                             [len(abstract["sentences"]) - 1 for abstract, _ in batch],
+                             chars=[abstract["chars"][i] for abstract, i in batch])
+    pred_probs = session.predict_features(features, batch_size=len(batch))
+    for (abstract, i), probs in zip(batch, pred_probs):
+        abstract["probs"][i] = probs
+        abstract["remaining"] -= 1
+
+
+def predict_jsonl(input_path, output_path, model_path=None, batch_size=1024, num_workers=1, chunk_size=256,
+                  start_offset=0, resume=False, text_field='abstract', id_field='id', include_probs=False,
+                  log_every=30):
+    """
+    Labels every sentence of a JSONL file of abstracts. Sentences of consecutive abstracts are
+    packed into model batches of batch_size sentences, and an abstract's predictions are written,
+    one JSON line per sentence, once all its sentences have been predicted.
+    :param input_path: JSONL file with one abstract per line.
+    :param output_path: JSONL file to write the predictions to.
+    :param model_path: model registry or directory of a saved tribrid model, None for default_serving_path().
+    :param batch_size: number of sentences per model batch.
+    :param num_workers: number of sentence splitting processes.
+    :param chunk_size: number of records sent to a worker at once.
+    :param start_offset: byte offset into input_path to start from, ignored when resuming.
+    :param resume: continue an interrupted run, appending to output_path.
+    :param text_field: field holding the abstract text.
+    :param id_field: field holding the abstract id.
+    :param include_probs: write the probabilities of every class.
+    :param log_every: seconds between progress reports.
+    :return: dict with the number of abstracts and sentences and the throughput.
+    """
+    if resume:
+        start_offset = find_resume_offset(output_path, input_path)
+        print(f"resuming from byte offset {start_offset} of {input_path}")
+
+    with sentence_split_pool(num_workers) as pool:
+        from src.inference import InferenceSession, default_serving_path
+
+        session = InferenceSession(model_path or default_serving_path())
+        abstracts = iter_split_abstracts(input_path, pool, start_offset=start_offset, chunk_size=chunk_size,
+                                         max_pending_chunks=2 * num_workers, text_field=text_field, id_field=id_field)
+
+        num_abstracts, num_sentences, offset = 0, 0, start_offset
+        start = last_log = time.time()
+        pending, batch = deque(), []
+
+        with open(output_path, 'a' if resume else 'w', encoding='utf-8') as out:
+
+            def write_completed():
+                nonlocal num_abstracts
+                while pending and pending[0]["remaining"] == 0:
+                    abstract = pending.popleft()
+                    for record in prediction_records(abstract, session.labels, include_probs):
+                        out.write(json.dumps(record) + '\n')
+                    num_abstracts += 1
+                out.flush()
+
+            for abstract in abstracts:
+                offset = abstract["offset"]
+                abstract["probs"] = [None] * len(abstract["sentences"])
+                abstract["remaining"] = len(abstract["sentences"])
+                pending.append(abstract)
+                batch.extend((abstract, i) for i in range(len(abstract["sentences"])))
+
+                while len(batch) >= batch_size:
+                    predict_batch(session, batch[:batch_size])
+                    batch = batch[batch_size:]
+                    num_sentences += batch_size
+                    write_completed()
+
+                    if time.time() - last_log >= log_every:
+                        last_log = time.time()
+                        print(f"{num_abstracts} abstracts, {num_sentences} sentences, "
+                              f"{num_sentences / (last_log - start):.1f} sentences/sec, at byte offset {offset}")
+
+            if batch:
+                predict_batch(session, batch)
+                num_sentences += len(batch)
+            write_completed()
+
+    seconds = time.time() - start
+    stats = {"abstracts": num_abstracts,
+             "sentences": num_sentences,
+             "seconds": round(seconds, 3),
+             "sentences_per_sec": round(num_sentences / seconds, 1) if seconds else 0.0}
+    print(f"labelled {num_sentences} sentences of {num_abstracts} abstracts in {seconds:.2f} secs, "
+          f"{stats['sentences_per_sec']} sentences/sec")
+    return stats
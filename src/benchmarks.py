@@ -0,0 +1,395 @@
+import os
+import sys
+import time
+import random
+import platform
+import tracemalloc
+import subprocess
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from src import models
+from src.callbacks import PerformanceMonitor
+from src.data import DataLoader, SampleStore, SPLIT_FILES, preprocess_text_with_line_numbers, split_chars
+from src.parsing import build_splits_columns
+from src.embeddings import HashingSentenceEncoder, STAND_IN_EMBEDDING_DIM
+from src.inference import make_features
+
+CORPUS_SIZES = {"small": 200, "medium": 2000, "large": 20000}  # train abstracts, val and test get a tenth
+INFERENCE_BATCH_SIZES = (1, 8, 32, 128, 512)
+PARSE_WORKERS = (1, 2, 4, 8)
+IMPORTED_MODULES = ("src", "src.data", "src.models", "src.inference")
+# module level imports of app.py, before the first paint: eager is what it imported before the warm-up thread
+APP_IMPORTS = {"eager": "streamlit, tensorflow, tensorflow.keras.models, spacy.lang.en",
+               "deferred": "streamlit, app_warm_up"}
+# sentences per section of a synthetic abstract, (min, max), in abstract order
+SECTION_LENGTHS = (("BACKGROUND", (0, 3)), ("OBJECTIVE", (1, 1)), ("METHODS", (2, 5)),
+                   ("RESULTS", (2, 6)), ("CONCLUSIONS", (1, 2)))
+SYLLABLES = ("ra", "to", "mi", "ne", "sa", "ku", "lo", "pe", "di", "ve", "ban", "cor", "tis", "mol", "gen")
+
+
+def make_vocabulary(rng, size):
+    return ["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))) for _ in range(size)]
+
+
+def write_synthetic_split(filename, num_abstracts, seed=42):
+    """
+    Writes num_abstracts random abstracts in the PubMed RCT format. Each section draws half of
+    its words from its own vocabulary, so the labels can be learnt, and numbers are '@' like in
+    the numbers_replaced_with_at_sign datasets.
+    :param filename: destination file.
+    :param num_abstracts: number of abstracts.
+    :param seed: seed of the generator, equal seeds write equal files.
+    :return: number of sentences written.
+    """
+    rng = random.Random(seed)
+    common = make_vocabulary(rng, 2000)
+    section_words = {label: make_vocabulary(rng, 300) for label, _ in SECTION_LENGTHS}
+    num_sentences = 0
+
+    with open(filename, 'w') as f:
+        for abstract in range(num_abstracts):
+            f.write(f"###{10000000 + abstract}\n")
+            for label, (low, high) in SECTION_LENGTHS:
+                for _ in range(rng.randint(low, high)):
+                    words = [rng.choice(section_words[label] if rng.random() < 0.5 else common)
+                             for _ in range(rng.randint(6, 40))]
+                    if rng.random() < 0.3:
+                        words.insert(rng.randrange(len(words)), "@")
+                    f.write(f"{label}\t{' '.join(words).capitalize()} .\n")
+                    num_sentences += 1
+            f.write("\n")
+    return num_sentences
+
+
+def generate_corpus(data_dir, size="small", seed=42):
+    """
+    Writes a synthetic train, dev and test split in the PubMed RCT format.
+    :param data_dir: directory to write train.txt, dev.txt and test.txt to.
+    :param size: one of CORPUS_SIZES, or a number of train abstracts.
+    :param seed: seed of the generator.
+    :return: dict of split -> number of sentences.
+    """
+    num_train = CORPUS_SIZES.get(size) or int(size)
+    os.makedirs(data_dir, exist_ok=True)
+    return {split: write_synthetic_split(os.path.join(data_dir, filename),
+                                         num_train if split == "train" else max(num_train // 10, 20),
+                                         seed=seed + i)
+            for i, (split, filename) in enumerate(SPLIT_FILES.items())}
+
+
+def time_call(function, repeats=5, warm_up=1):
+    """
+    :param function: callable without arguments.
+    :param repeats: number of timed calls.
+    :param warm_up: number of untimed calls first, e.g. to trace tf.functions.
+    :return: list of the seconds of every timed call.
+    """
+    for _ in range(warm_up):
+        function()
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def result(metric, value, higher_is_better, **extra):
+    """
+    :return: benchmark entry, compare_results uses metric, value and higher_is_better.
+    """
+    return {"metric": metric, "value": round(float(value), 4), "higher_is_better": higher_is_better, **extra}
+
+
+def time_fresh_import(imports, repeats=3):
+    """
+    :param imports: what to import, e.g. "src.models" or "streamlit, app_warm_up".
+    :return: median (seconds, peak RSS in MB) of a fresh interpreter importing it from the repository root.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = (f"import time, resource; start = time.perf_counter(); import {imports}; "
+              f"print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+    runs = [subprocess.run([sys.executable, "-c", script], cwd=root, check=True,
+                           stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+            for _ in range(repeats)]
+    seconds = np.median([float(seconds) for seconds, _ in runs])
+    max_rss_mb = np.median([int(max_rss) for _, max_rss in runs]) / 1024  # ru_maxrss is in KiB on Linux
+    return float(seconds), round(float(max_rss_mb), 1)
+
+
+def bench_imports(modules=IMPORTED_MODULES, app_imports=APP_IMPORTS, repeats=3):
+    """
+    Import time and peak RSS of a fresh interpreter importing each module, e.g. `import src` alone should
+    not pay for TensorFlow, and the imports app.py runs before its first paint, eager and deferred.
+    """
+    results = {}
+    for module in modules:
+        seconds, max_rss_mb = time_fresh_import(module, repeats)
+        results[f"import/{module}"] = result("seconds", seconds, False, max_rss_mb=max_rss_mb)
+    for name, imports in app_imports.items():
+        seconds, max_rss_mb = time_fresh_import(imports, repeats)
+        results[f"app_first_paint/{name}_imports"] = result("seconds", seconds, False, max_rss_mb=max_rss_mb)
+    return results
+
+
+def bench_parsing(data_dir, repeats=3):
+    filename = os.path.join(data_dir, SPLIT_FILES["train"])
+    num_sentences = len(preprocess_text_with_line_numbers(filename))
+    seconds = np.median(time_call(lambda: preprocess_text_with_line_numbers(filename), repeats, warm_up=0))
+    return {"parse/preprocess_text_with_line_numbers": result("sentences_per_sec", num_sentences / seconds, True,
+                                                              seconds=round(seconds, 4))}
+
+
+def bench_parse_workers(data_dir, worker_counts=PARSE_WORKERS, repeats=3):
+    """
+    Time to parse every split with each number of worker processes, and the speed-up over the first count.
+    Files smaller than MIN_SHARD_BYTES are parsed by a single worker, so use a large corpus to measure sharding.
+    """
+    filenames = {split: os.path.join(data_dir, filename) for split, filename in SPLIT_FILES.items()}
+    results, reference_seconds = {}, None
+    for num_workers in worker_counts:
+        seconds = np.median(time_call(lambda: build_splits_columns(filenames, num_workers), repeats, warm_up=0))
+        reference_seconds = reference_seconds or seconds
+        results[f"parse/splits_{num_workers}_workers"] = result("seconds", seconds, False,
+                                                                speed_up=round(reference_seconds / seconds, 2))
+    return results
+
+
+def bench_data_loader(data_dir, batch_size, num_workers=1, repeats=3):
+    """
+    Time to load every split into a fresh DataLoader, parsing them (cold) and from the preprocessed cache (warm).
+    """
+    def load(rebuild_cache):
+        data = DataLoader(batch_size=batch_size, rebuild_cache=rebuild_cache, num_workers=num_workers,
+                          data_dir=data_dir)
+        data.load_splits(list(SPLIT_FILES))
+
+    results = {}
+    for name, rebuild_cache in (("cold", True), ("warm", False)):
+        seconds = np.median(time_call(lambda: load(rebuild_cache), repeats, warm_up=0))
+        results[f"data_loader/load_splits_{name}"] = result("seconds", seconds, False)
+    return results
+
+
+def bench_sample_store(data_dir, split="train", name="synthetic"):
+    """
+    Memory held by one split as a SampleStore, against the list of dicts, DataFrame, sentence list and
+    character-spaced sentence list the DataLoader used to keep for it, both traced with tracemalloc.
+    :param name: name of the dataset in the benchmark name.
+    """
+    filename = os.path.join(data_dir, SPLIT_FILES[split])
+
+    def traced_bytes(build):
+        tracemalloc.start()
+        try:
+            kept = build()
+            return tracemalloc.get_traced_memory()[0], kept
+        finally:
+            tracemalloc.stop()
+
+    def build_lists_and_frame():
+        samples = preprocess_text_with_line_numbers(filename)
+        df = pd.DataFrame(samples)
+        sentences = df["text"].tolist()
+        return samples, df, sentences, [split_chars(sentence) for sentence in sentences]
+
+    lists_bytes, (samples, _, _, _) = traced_bytes(build_lists_and_frame)
+    class_names = sorted({sample["target"] for sample in samples})
+    del samples
+    store_bytes, store = traced_bytes(lambda: SampleStore.from_file(filename, class_names))
+    return {f"memory/{name}/{split}_sample_store": result("mb", store_bytes / 2 ** 20, False,
+                                                          nbytes_mb=round(store.nbytes / 2 ** 20, 3),
+                                                          lists_and_frame_mb=round(lists_bytes / 2 ** 20, 3),
+                                                          saved_fraction=round(1 - store_bytes / lists_bytes, 4))}
+
+
+def make_variant(data, **options):
+    """
+    :param options: DataLoader options of the variant, e.g. bucket_by_char_length=True.
+    :return: DataLoader of the same corpus and batch size, reading the splits cached by data.
+    """
+    return DataLoader(batch_size=data.BATCH_SIZE, data_dir=data.DATA_DIR, num_workers=data.num_workers, **options)
+
+
+def bench_pipelines(data, num_batches=50):
+    """
+    Throughput of the training pipeline of every DataLoader builder, after its first batch, with
+    fixed-length and length-bucketed char batches.
+    """
+    monitor = PerformanceMonitor("benchmark")
+    bucketed = make_variant(data, bucket_by_char_length=True)
+    builders = {"tokens": data.get_only_tokens_data,
+                "char_and_token": data.get_only_char_and_token_data,
+                "char_and_token_bucketed": bucketed.get_only_char_and_token_data,
+                "tribrid": data.get_tribrid_model_input,
+                "tribrid_bucketed": bucketed.get_tribrid_model_input,
+                "positional_token": data.get_positional_token_data,
+                # cost of the batch timestamps PerformanceMonitor adds to measure the input wait
+                "tribrid_instrumented": lambda: (monitor.instrument(data.get_tribrid_model_input()[0]), None)}
+    results = {}
+    for name, builder in builders.items():
+        start = time.perf_counter()
+        train_dataset, _ = builder()
+        iterator = iter(train_dataset.repeat())  # small corpora may hold fewer than num_batches
+        next(iterator)
+        first_batch_seconds = time.perf_counter() - start
+
+        start, batches, examples = time.perf_counter(), 0, 0
+        for features, _ in (next(iterator) for _ in range(num_batches)):
+            examples += int(tf.shape(tf.nest.flatten(features)[0])[0])
+            batches += 1
+        seconds = time.perf_counter() - start
+        results[f"pipeline/{name}"] = result("examples_per_sec", examples / seconds, True,
+                                             batches_per_sec=round(batches / seconds, 2),
+                                             first_batch_seconds=round(first_batch_seconds, 4))
+    return results
+
+
+def bench_pipeline_memory(data, repeats=3):
+    """
+    Serialized graph size and peak RSS of the tribrid training pipeline with one hot and integer features,
+    each built in a fresh interpreter so the RSS of one mode does not hide the other.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+    results = {}
+    for name, integer_features in (("one_hot", False), ("integer_features", True)):
+        script = ("import resource; from src.data import DataLoader, get_dataset_graph_size; "
+                  f"data = DataLoader(batch_size={data.BATCH_SIZE}, data_dir={data.DATA_DIR!r}, "
+                  f"integer_features={integer_features}); dataset = data.get_tribrid_model_input()[0]; "
+                  "next(iter(dataset)); "
+                  "print(get_dataset_graph_size(dataset), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+        # the last line, the DataLoader prints the caches it loads; runs in the working directory for labels.json
+        runs = [subprocess.run([sys.executable, "-c", script], env=env, check=True,
+                               stdout=subprocess.PIPE, universal_newlines=True).stdout.splitlines()[-1].split()
+                for _ in range(repeats)]
+        graph_mb = int(runs[0][0]) / 2 ** 20  # the same for every run
+        max_rss_mb = np.median([int(max_rss) for _, max_rss in runs]) / 1024  # ru_maxrss is in KiB on Linux
+        results[f"pipeline_memory/tribrid_{name}"] = result("graph_mb", graph_mb, False,
+                                                            max_rss_mb=round(float(max_rss_mb), 1))
+    return results
+
+
+def bench_train_steps(data, repeats=20):
+    """
+    Median train step time of every model over consecutive batches of its pipeline, so the bucketed
+    variants are timed over batches of different lengths like in training.
+    :return: (dict of results, trained tribrid model for bench_inference)
+    """
+    bucketed = make_variant(data, bucket_by_char_length=True)
+    model_builders = {"tokens": (models.only_tokens_model, data.get_only_tokens_data),
+                      "char_and_token": (models.char_and_token_model, data.get_only_char_and_token_data),
+                      "char_and_token_bucketed": (lambda: models.char_and_token_model(bucketed_chars=True),
+                                                  bucketed.get_only_char_and_token_data),
+                      "tribrid": (models.tribrid_model, data.get_tribrid_model_input),
+                      "tribrid_bucketed": (lambda: models.tribrid_model(bucketed_chars=True),
+                                           bucketed.get_tribrid_model_input),
+                      "student": (models.student_model, data.get_tribrid_model_input)}
+    results, trained = {}, {}
+    for name, (build_model, builder) in model_builders.items():
+        model = build_model()
+        batches = iter(builder()[0].repeat())
+        for _ in range(2):  # traces, a bucketed model once per new batch shape until the shapes are relaxed
+            model.train_on_batch(*next(batches))
+        seconds, examples = [], 0
+        for x, y in (next(batches) for _ in range(repeats)):
+            start = time.perf_counter()
+            model.train_on_batch(x, y)
+            seconds.append(time.perf_counter() - start)
+            examples += int(tf.shape(tf.nest.flatten(x)[0])[0])
+        results[f"train_step/{name}"] = result("ms", 1000 * np.median(seconds), False,
+                                               p90_ms=round(1000 * float(np.percentile(seconds, 90)), 3),
+                                               examples_per_sec=round(examples / sum(seconds), 1))
+        trained[name] = model
+    return results, trained["tribrid"]
+
+
+def bench_inference(model, store, batch_sizes=INFERENCE_BATCH_SIZES, repeats=10):
+    """
+    Latency of the serving prediction path, feature construction and predict as in
+    InferenceSession.predict_sentences, by number of sentences per call.
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        indices = [i % len(store) for i in range(batch_size)]
+        sentences = [store.get_sentence(i) for i in indices]
+        line_numbers = [int(store.line_number[i]) for i in indices]
+        total_lines = [int(store.total_lines[i]) for i in indices]
+
+        def predict():
+            model.predict(make_features(sentences, line_numbers, total_lines), batch_size=batch_size)
+
+        seconds = time_call(predict, repeats, warm_up=2)
+        results[f"inference/batch_{batch_size}"] = result("ms", 1000 * np.median(seconds), False,
+                                                          p90_ms=round(1000 * float(np.percentile(seconds, 90)), 3),
+                                                          sentences_per_sec=round(batch_size / np.median(seconds), 1))
+    return results
+
+
+def run_benchmarks(data_dir, batch_size=models.BATCH_SIZE, num_workers=1, num_batches=50, train_repeats=20,
+                   inference_repeats=10, parse_workers=PARSE_WORKERS, store_data_dirs=(),
+                   suites=("imports", "parsing", "data_loader", "pipelines", "train_steps", "inference")):
+    """
+    Runs the benchmark suites on the corpus in data_dir with the HashingSentenceEncoder in place
+    of the Universal Sentence Encoder, so nothing is downloaded. Writes labels.json and
+    char_vocab.json to the working directory, like train.py.
+    :param data_dir: directory of a corpus written by generate_corpus.
+    :param parse_workers: numbers of parsing processes compared in the parsing suite.
+    :param store_data_dirs: real dataset directories, e.g. PubMed 20k and 200k, whose train split memory
+    the data_loader suite measures as well.
+    :param suites: names of the suites to run, train_steps is needed by inference.
+    :return: dict of benchmark name -> result.
+    """
+    models.set_sentence_encoder(HashingSentenceEncoder(), "hashing-stand-in", dim=STAND_IN_EMBEDDING_DIM)
+    data = models.get_data(batch_size=batch_size, num_workers=num_workers, data_dir=data_dir)
+
+    results = {}
+    if "imports" in suites:
+        results.update(bench_imports())
+    if "parsing" in suites:
+        results.update(bench_parsing(data_dir))
+        results.update(bench_parse_workers(data_dir, parse_workers))
+    if "data_loader" in suites:
+        results.update(bench_data_loader(data.DATA_DIR, batch_size, num_workers))
+        results.update(bench_sample_store(data.DATA_DIR))
+        for store_data_dir in store_data_dirs:
+            results.update(bench_sample_store(store_data_dir, name=os.path.basename(store_data_dir.rstrip('/'))))
+    if "pipelines" in suites:
+        results.update(bench_pipelines(data, num_batches))
+        results.update(bench_pipeline_memory(data))
+    if "train_steps" in suites:
+        train_results, tribrid = bench_train_steps(data, train_repeats)
+        results.update(train_results)
+        if "inference" in suites:
+            results.update(bench_inference(tribrid, data.test_store, repeats=inference_repeats))
+    return results
+
+
+def get_environment():
+    return {"python": sys.version.split()[0],
+            "tensorflow": tf.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()}
+
+
+def compare_results(results, baseline, tolerance=0.1):
+    """
+    :param results: dict of benchmark name -> result, as returned by run_benchmarks.
+    :param baseline: results of an earlier run.
+    :param tolerance: relative change in the wrong direction accepted before flagging a regression.
+    :return: list of dicts, one per benchmark present in both, with its change and whether it regressed.
+    """
+    comparison = []
+    for name, entry in results.items():
+        if name not in baseline or not baseline[name]["value"]:
+            continue
+        change = entry["value"] / baseline[name]["value"] - 1
+        worse = -change if entry["higher_is_better"] else change
+        comparison.append({"benchmark": name,
+                           "metric": entry["metric"],
+                           "baseline": baseline[name]["value"],
+                           "value": entry["value"],
+                           "change": round(change, 4),
+                           "regression": worse > tolerance})
+    return comparison
@@ -1,19 +1,251 @@
-from tensorflow.keras.callbacks import ModelCheckpoint, TensorBoard
-from tensorflow.keras.callbacks import ReduceLROnPlateau
+import os
+import json
+import time
+import queue
+import threading
+import collections
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.callbacks import TensorBoard
+from tensorflow.keras.callbacks import ReduceLROnPlateau, Callback
 
 
-def model_checkpoint(save_model_path):
+CHECKPOINT_MANIFEST = "checkpoints.json"
+
+
+def read_checkpoint_manifest(checkpoint_dir):
+    """
+    :param checkpoint_dir: directory written by AsyncCheckpoint.
+    :return: list of checkpoint entries, oldest first, empty if there is none.
+    """
+    path = os.path.join(checkpoint_dir, CHECKPOINT_MANIFEST)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)["checkpoints"]
+
+
+def latest_checkpoint(checkpoint_dir):
+    """
+    :param checkpoint_dir: directory written by AsyncCheckpoint.
+    :return: path of the checkpoint of the last epoch, None if there is none.
+    """
+    checkpoints = read_checkpoint_manifest(checkpoint_dir)
+    if not checkpoints:
+        return None
+    return os.path.join(checkpoint_dir, max(checkpoints, key=lambda entry: entry["epoch"])["file"])
+
+
+def best_checkpoint(checkpoint_dir):
+    """
+    :param checkpoint_dir: directory written by AsyncCheckpoint.
+    :return: path of the checkpoint with the best monitored value, None if there is none.
+    """
+    path = os.path.join(checkpoint_dir, CHECKPOINT_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    ranked = [entry for entry in manifest["checkpoints"] if not np.isnan(entry.get(manifest["monitor"], float('nan')))]
+    if not ranked:
+        return None
+    sign = -1 if manifest["mode"] == 'max' else 1
+    return os.path.join(checkpoint_dir, min(ranked, key=lambda entry: sign * entry[manifest["monitor"]])["file"])
+
+
+def get_checkpoint_weights(model):
+    """
+    Variables a checkpoint holds: the trainable weights and the non-trainable state of the layers that
+    train, such as batch norm statistics. Layers frozen as a whole, such as the sentence encoder, never
+    change and are left out, they are most of the model's size.
+    :param model: keras model.
+    :return: list of variables, in a stable order for models of the same architecture.
+    """
+    frozen = {id(weight) for layer in model.submodules
+              if isinstance(layer, tf.keras.layers.Layer) and not layer.trainable for weight in layer.weights}
+    return model.trainable_weights + [weight for weight in model.non_trainable_weights if id(weight) not in frozen]
+
+
+def build_optimizer(model):
+    """
+    Creates the optimizer state of a compiled model, which keras only creates at the first train step,
+    by applying zero gradients. Must run in the distribution strategy scope the model was built in.
+    """
+    variables = model.trainable_variables
+    tf.distribute.get_strategy().run(
+        lambda: model.optimizer.apply_gradients(zip([tf.zeros_like(variable) for variable in variables], variables)))
+
+
+def restore_checkpoint(model, checkpoint_path, restore_optimizer=True):
+    """
+    Loads the weights and optimizer state saved by AsyncCheckpoint into a compiled model.
+    Must run in the distribution strategy scope the model was built in.
+    :param model: compiled model with the architecture the checkpoint was taken from.
+    :param checkpoint_path: .npz checkpoint, see latest_checkpoint and best_checkpoint.
+    :param restore_optimizer: also restore the optimizer state, to continue training.
+    :return: the epoch the checkpoint was taken at.
+    """
+    with np.load(checkpoint_path) as checkpoint:
+        weights = [checkpoint[f"weight_{i}"] for i in range(int(checkpoint["num_weights"]))]
+        optimizer_weights = [checkpoint[f"optimizer_{i}"] for i in range(int(checkpoint["num_optimizer_weights"]))]
+        epoch = int(checkpoint["epoch"])
+    if restore_optimizer and optimizer_weights:
+        # first, the zero gradient step would otherwise run after, and on top of, the restored weights
+        build_optimizer(model)
+        model.optimizer.set_weights(optimizer_weights)
+    variables = get_checkpoint_weights(model)
+    if len(weights) != len(variables):
+        raise ValueError(f"{checkpoint_path} holds {len(weights)} weights, the model checkpoints {len(variables)}")
+    tf.keras.backend.batch_set_value(list(zip(variables, weights)))
+    print(f"restored epoch {epoch} from {checkpoint_path}")
+    return epoch
+
+
+class AsyncCheckpoint(Callback):
+    """
+    Checkpoints the weights and the optimizer state at the end of every epoch without stalling
+    training on the disk: the training thread only copies the weights to host memory, and a
+    background thread writes them to a .npz file, then deletes the checkpoints that are neither
+    among the keep_best best nor the keep_last latest. The frozen layers, such as the sentence
+    encoder, never change and are not checkpointed, see get_checkpoint_weights; the full model is
+    exported once by train.py at the end of training, from the best checkpoint.
+
+    The time the training thread spends on checkpoints and the time spent writing them in the
+    background are written to checkpoint_stats.json at the end of training.
+    """
+
+    def __init__(self, checkpoint_dir, monitor='accuracy', mode='max', keep_best=3, keep_last=2, max_pending=2,
+                 blocking=False):
+        """
+        :param checkpoint_dir: directory of the checkpoints, their manifest and stats.
+        :param monitor: metric ranking the checkpoints, e.g. 'hard_output_accuracy' for distillation.
+        :param mode: 'max' or 'min', whether a higher or a lower monitor value is better.
+        :param keep_best: number of best checkpoints kept.
+        :param keep_last: number of latest checkpoints kept, to resume from.
+        :param max_pending: number of snapshots waiting to be written before the training thread waits.
+        :param blocking: write in the training thread instead, to measure the stall it removes.
+        """
+        super().__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.monitor = monitor
+        self.mode = mode
+        self.keep_best = keep_best
+        self.keep_last = keep_last
+        self.blocking = blocking
+        self.checkpoints = read_checkpoint_manifest(checkpoint_dir)  # resumed runs keep their older checkpoints
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.writer = None
+        self.error = None
+        self.stall_seconds = []
+        self.write_seconds = []
+
+    def on_train_begin(self, logs=None):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        if not self.blocking:
+            self.writer = threading.Thread(target=self.write_pending, name="checkpoint-writer", daemon=True)
+            self.writer.start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.error is not None:
+            raise self.error
+        start = time.perf_counter()
+        snapshot = {"epoch": epoch,
+                    "value": float((logs or {}).get(self.monitor, float('nan'))),
+                    "weights": tf.keras.backend.batch_get_value(get_checkpoint_weights(self.model)),
+                    "optimizer_weights": self.model.optimizer.get_weights()}
+        if self.blocking:
+            self.write(snapshot)
+        else:
+            self.queue.put(snapshot)  # only waits when max_pending snapshots are not written yet
+        self.stall_seconds.append(time.perf_counter() - start)
+
+    def on_train_end(self, logs=None):
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+        if self.error is not None:
+            raise self.error
+        stats = self.stats()
+        with open(os.path.join(self.checkpoint_dir, "checkpoint_stats.json"), 'w') as f:
+            json.dump(stats, f, indent=2)
+        print(f"checkpoints: {stats['stall_ms_total']} ms in the training loop, "
+              f"{stats['write_ms_total']} ms writing {'in the loop' if self.blocking else 'in the background'}")
+
+    def write_pending(self):
+        while True:
+            snapshot = self.queue.get()
+            if snapshot is None:
+                return
+            try:
+                self.write(snapshot)
+            except Exception as e:  # raised in the training thread at the next epoch end
+                self.error = e
+
+    def write(self, snapshot):
+        start = time.perf_counter()
+        name = f"ckpt-{snapshot['epoch']:04d}.npz"
+        path = os.path.join(self.checkpoint_dir, name)
+        arrays = {f"weight_{i}": weight for i, weight in enumerate(snapshot["weights"])}
+        arrays.update({f"optimizer_{i}": weight for i, weight in enumerate(snapshot["optimizer_weights"])})
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, epoch=snapshot["epoch"], num_weights=len(snapshot["weights"]),
+                     num_optimizer_weights=len(snapshot["optimizer_weights"]), **arrays)
+        os.replace(path + '.tmp', path)
+
+        self.checkpoints = [entry for entry in self.checkpoints if entry["epoch"] != snapshot["epoch"]]
+        self.checkpoints.append({"epoch": snapshot["epoch"], "file": name, self.monitor: snapshot["value"]})
+        self.prune()
+        self.write_seconds.append(time.perf_counter() - start)
+
+    def prune(self):
+        """
+        Deletes the checkpoints outside the keep_best best and keep_last latest, then rewrites the manifest.
+        """
+        sign = -1 if self.mode == 'max' else 1
+        ranked = [entry for entry in self.checkpoints if not np.isnan(entry.get(self.monitor, float('nan')))]
+        best = sorted(ranked, key=lambda entry: sign * entry[self.monitor])[:self.keep_best]
+        latest = sorted(self.checkpoints, key=lambda entry: entry["epoch"])[-self.keep_last:] if self.keep_last else []
+        keep = {entry["epoch"] for entry in best + latest}
+
+        for entry in self.checkpoints:
+            if entry["epoch"] not in keep:
+                try:
+                    os.remove(os.path.join(self.checkpoint_dir, entry["file"]))
+                except FileNotFoundError:
+                    pass
+        self.checkpoints = sorted((entry for entry in self.checkpoints if entry["epoch"] in keep),
+                                  key=lambda entry: entry["epoch"])
+
+        manifest_path = os.path.join(self.checkpoint_dir, CHECKPOINT_MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump({"monitor": self.monitor, "mode": self.mode, "checkpoints": self.checkpoints}, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def stats(self):
+        """
+        :return: dict of the time checkpoints took in the training loop and writing them.
+        """
+        count = len(self.stall_seconds)
+        return {"checkpoints": count,
+                "blocking": self.blocking,
+                "stall_ms_total": round(1000 * sum(self.stall_seconds), 1),
+                "stall_ms_mean": round(1000 * sum(self.stall_seconds) / count, 2) if count else 0.0,
+                "write_ms_total": round(1000 * sum(self.write_seconds), 1),
+                "write_ms_mean": round(1000 * sum(self.write_seconds) / len(self.write_seconds), 2)
+                if self.write_seconds else 0.0,
+                "kept": [entry["file"] for entry in self.checkpoints]}
+
+
+def async_checkpoint(checkpoint_dir, monitor='accuracy', keep_best=3, keep_last=2, blocking=False):
     """
-    Callbacks to save the best version of the model
-    :return: ModelCheckpoint object
+    Checkpoints written in the background, see AsyncCheckpoint.
+    :param checkpoint_dir: directory of the checkpoints.
+    :param monitor: metric deciding the best checkpoints.
+    :return: AsyncCheckpoint object
     """
-    checkpoint = ModelCheckpoint(filepath=save_model_path,
-                                 monitor='accuracy',
-                                 verbose=1,
-                                 save_best_only=True,
-                                 save_weights_only=False,
-                                 mode='max')
-    return checkpoint
+    return AsyncCheckpoint(checkpoint_dir, monitor=monitor, mode='max', keep_best=keep_best, keep_last=keep_last,
+                           blocking=blocking)
 
 
 def tensorboard_callbacks(log_dir):
@@ -42,3 +274,212 @@ def reduce_lr_on_plateau():
 
     return reduce_lr
 
+
+class StepTimer(Callback):
+    """
+    Records the wall time and mean train step time of every epoch, to compare training modes
+    such as XLA and mixed precision, or numbers of replicas, run by run.
+    """
+
+    def __init__(self, mode, report_path=None, global_batch_size=None, num_replicas=1):
+        """
+        :param mode: label of the training mode, e.g. 'xla-mixed_bfloat16'.
+        :param report_path: json file rewritten after every epoch, None to only print.
+        :param global_batch_size: examples per step over all the replicas, to report examples/sec.
+        :param num_replicas: number of replicas training in sync.
+        """
+        super().__init__()
+        self.mode = mode
+        self.report_path = report_path
+        self.global_batch_size = global_batch_size
+        self.num_replicas = num_replicas
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+        self.steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+
+    def epoch_summary(self, epoch, seconds):
+        """
+        :return: dict of the timings of the epoch that just ended.
+        """
+        summary = {"epoch": epoch,
+                   "seconds": round(seconds, 3),
+                   "steps": self.steps,
+                   "mean_step_ms": round(1000 * seconds / max(self.steps, 1), 3)}
+        if self.global_batch_size:
+            summary["examples_per_sec"] = round(self.steps * self.global_batch_size / seconds, 1)
+        return summary
+
+    def write_report(self):
+        os.makedirs(os.path.dirname(self.report_path) or '.', exist_ok=True)
+        with open(self.report_path, 'w') as f:
+            json.dump({"mode": self.mode,
+                       "num_replicas": self.num_replicas,
+                       "global_batch_size": self.global_batch_size,
+                       "epochs": self.epochs}, f, indent=2)
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter() - self.epoch_start
+        self.epochs.append(self.epoch_summary(epoch, seconds))
+        print(f"\n{self.mode}: epoch {epoch} took {seconds:.2f} secs, {self.epochs[-1]['mean_step_ms']} ms/step")
+        if self.report_path:
+            self.write_report()
+
+
+def get_rss_bytes():
+    """
+    :return: resident set size of this process in bytes, its peak where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PerformanceMonitor(StepTimer):
+    """
+    StepTimer that also records, for every train step, its wall time, examples/sec, the time it
+    was blocked waiting for the input pipeline and the host RSS, as TensorBoard scalars, and adds
+    their percentiles to the per epoch report. Optionally traces a window of steps with the TF profiler.
+
+    The input wait is only measured on a dataset returned by instrument: it timestamps every batch
+    as it leaves the pipeline, and a step waited for as long as its batch was ready after the step began.
+    Steps consume the timestamps in order, since Keras reads every iterator it makes to the end or keeps
+    it across epochs. benchmark.py reports the throughput cost of the timestamps in pipeline/tribrid_instrumented.
+    """
+
+    def __init__(self, mode, report_path=None, log_dir=None, global_batch_size=None, num_replicas=1,
+                 log_every=10, profile_steps=None):
+        """
+        :param log_dir: directory of the TensorBoard scalars and profiler traces, None to skip both.
+        :param log_every: write the step scalars of one step out of log_every.
+        :param profile_steps: (first, last) train steps, counted over the whole run, to trace with the profiler.
+        """
+        super().__init__(mode, report_path, global_batch_size, num_replicas)
+        self.log_dir = log_dir
+        self.log_every = log_every
+        self.profile_steps = profile_steps
+        self.writer = None
+        self.global_step = 0
+        self.profiling = False
+        self.ready_times = None  # (time ready, batch size) of the batches not consumed by a step yet
+
+    def record_batch(self, batch_size):
+        self.ready_times.append((time.perf_counter(), int(batch_size)))
+        return batch_size
+
+    def instrument(self, dataset):
+        """
+        :param dataset: training tf.data.Dataset, batched.
+        :return: the same dataset, timestamping its batches for the input wait measurement.
+        """
+        self.ready_times = collections.deque()
+
+        def mark(*batch):
+            batch_size = tf.cast(tf.shape(tf.nest.flatten(batch)[0])[0], tf.int64)
+            # numpy_function skips the eager tensor conversions of py_function, one host call per batch
+            marked = tf.numpy_function(self.record_batch, [batch_size], tf.int64)
+            with tf.control_dependencies([marked]):
+                return tf.nest.map_structure(tf.identity, batch)
+
+        return dataset.map(mark).prefetch(tf.data.AUTOTUNE)
+
+    def on_train_begin(self, logs=None):
+        if self.ready_times is not None:  # Keras makes its first iterator after on_train_begin
+            self.ready_times.clear()
+        if self.log_dir:
+            self.writer = tf.summary.create_file_writer(os.path.join(self.log_dir, 'performance', self.mode))
+
+    def on_train_end(self, logs=None):
+        if self.profiling:
+            tf.profiler.experimental.stop()
+            self.profiling = False
+        if self.writer is not None:
+            self.writer.close()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        super().on_epoch_begin(epoch, logs)
+        self.step_seconds, self.wait_seconds, self.batch_sizes, self.rss = [], [], [], []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profile_steps and self.log_dir and self.global_step == self.profile_steps[0]:
+            tf.profiler.experimental.start(os.path.join(self.log_dir, 'profile', self.mode))
+            self.profiling = True
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step_end = time.perf_counter()
+        super().on_train_batch_end(batch, logs)
+        seconds = step_end - self.step_start
+        wait, batch_size = 0.0, self.global_batch_size or 0
+        if self.ready_times:
+            ready, batch_size = self.ready_times.popleft()
+            wait = min(max(ready - self.step_start, 0.0), seconds)
+        rss = get_rss_bytes()
+        self.step_seconds.append(seconds)
+        self.wait_seconds.append(wait)
+        self.batch_sizes.append(batch_size)
+        self.rss.append(rss)
+
+        if self.writer is not None and self.global_step % self.log_every == 0:
+            with self.writer.as_default(step=self.global_step):
+                tf.summary.scalar('step_ms', 1000 * seconds)
+                tf.summary.scalar('input_wait_ms', 1000 * wait)
+                tf.summary.scalar('examples_per_sec', batch_size / seconds)
+                tf.summary.scalar('rss_mb', rss / 2 ** 20)
+        if self.profiling and self.global_step >= self.profile_steps[1]:
+            tf.profiler.experimental.stop()
+            self.profiling = False
+        self.global_step += 1
+
+    def epoch_summary(self, epoch, seconds):
+        summary = super().epoch_summary(epoch, seconds)
+        if not self.step_seconds:
+            return summary
+        step_ms = np.array(self.step_seconds) * 1000
+        summary.update({"examples_per_sec": round(sum(self.batch_sizes) / seconds, 1),
+                        "step_ms_p50": round(float(np.percentile(step_ms, 50)), 3),
+                        "step_ms_p90": round(float(np.percentile(step_ms, 90)), 3),
+                        "step_ms_p99": round(float(np.percentile(step_ms, 99)), 3),
+                        "input_wait_ms_mean": round(1000 * float(np.mean(self.wait_seconds)), 3),
+                        "input_wait_fraction": round(sum(self.wait_seconds) / sum(self.step_seconds), 4),
+                        "rss_mb_max": round(max(self.rss) / 2 ** 20, 1)})
+        if self.writer is not None:
+            with self.writer.as_default(step=epoch):
+                for name in ("examples_per_sec", "input_wait_fraction", "rss_mb_max"):
+                    tf.summary.scalar(f'epoch_{name}', summary[name])
+            self.writer.flush()
+        print(f"\n{self.mode}: {summary['examples_per_sec']} examples/sec, "
+              f"{100 * summary['input_wait_fraction']:.1f}% of the step time waiting for input, "
+              f"{summary['rss_mb_max']} MB RSS")
+        return summary
+
+
+def step_timer(mode, log_dir, global_batch_size=None, num_replicas=1):
+    """
+    :param mode: label of the training mode.
+    :param log_dir: directory the step_times_<mode>.json report is written to.
+    :param global_batch_size: examples per step over all the replicas.
+    :param num_replicas: number of replicas training in sync.
+    :return: StepTimer object
+    """
+    return StepTimer(mode, report_path=os.path.join(log_dir, f"step_times_{mode}.json"),
+                     global_batch_size=global_batch_size, num_replicas=num_replicas)
+
+
+def performance_monitor(mode, log_dir, global_batch_size=None, num_replicas=1, log_every=10, profile_steps=None):
+    """
+    :param mode: label of the training mode.
+    :param log_dir: directory of the step_times_<mode>.json report, the TensorBoard scalars and the profiler traces.
+    :param profile_steps: (first, last) train steps to trace with the profiler, None to not profile.
+    :return: PerformanceMonitor object
+    """
+    return PerformanceMonitor(mode, report_path=os.path.join(log_dir, f"step_times_{mode}.json"), log_dir=log_dir,
+                              global_batch_size=global_batch_size, num_replicas=num_replicas,
+                              log_every=log_every, profile_steps=profile_steps)
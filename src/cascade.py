@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+from src.models import HashedNgramEmbedding, NUM_CLASSES, POSITIONAL_TOWER_LAYERS
+from src.inference import make_features, load_serving_model
+
+CASCADE_CONFIG = "cascade.json"
+FIRST_STAGE_DIR = "first_stage"
+DEFAULT_THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98, 0.99, 1.01)
+
+
+def positional_towers(model):
+    """
+    Gets the dense layers stacked on the line_number_input and total_lines_input of a tribrid model by the
+    names tribrid_model gives them.
+    :param model: trained tribrid model.
+    :return: (list of the line number tower layers, list of the total lines tower layers)
+    """
+    towers = []
+    for input_name in ("line_number_input", "total_lines_input"):
+        try:
+            towers.append([model.get_layer(name) for name in POSITIONAL_TOWER_LAYERS[input_name]])
+        except ValueError:
+            raise ValueError(f"{model.name} has no {POSITIONAL_TOWER_LAYERS[input_name]} layers on {input_name}, "
+                             f"retrain it with the current tribrid_model to use it in a cascade")
+    return towers[0], towers[1]
+
+
+def first_stage_model(full_model, num_buckets=2 ** 16):
+    """
+    Cheap first stage of the cascade: the trained positional towers of the tribrid model, frozen,
+    next to hashed word embeddings of the sentence, with a small head trained on top.
+    :param full_model: trained tribrid model.
+    :param num_buckets: number of hashed word embeddings.
+    :return: compiled model taking (line numbers one hot, total lines one hot, sentences).
+    """
+    line_number_tower, total_lines_tower = positional_towers(full_model)
+    line_number_inputs = layers.Input(shape=(15,), dtype=tf.float32, name="line_number_input")
+    total_line_inputs = layers.Input(shape=(20,), dtype=tf.int32, name="total_lines_input")
+    token_inputs = layers.Input(shape=[], dtype=tf.string, name="token_inputs")
+
+    outputs = []
+    for inputs, tower in ((line_number_inputs, line_number_tower), (total_line_inputs, total_lines_tower)):
+        x = inputs
+        for layer in tower:
+            layer.trainable = False
+            x = layer(x)
+        outputs.append(x)
+    token_embeddings = HashedNgramEmbedding(num_buckets, 32, ngram_widths=(1,), name="token_ngram_embed")(token_inputs)
+
+    concat = layers.Concatenate(name="first_stage_embedding")(outputs + [token_embeddings])
+    dense = layers.Dense(64, activation="relu")(concat)
+    output_layer = layers.Dense(NUM_CLASSES, activation="softmax", dtype="float32", name="output_layer")(dense)
+
+    model = tf.keras.Model(inputs=[line_number_inputs, total_line_inputs, token_inputs],
+                           outputs=output_layer,
+                           name="cascade_first_stage")
+    model.compile(loss="categorical_crossentropy",
+                  optimizer=tf.keras.optimizers.Adam(),
+                  metrics=["accuracy"])
+    return model
+
+
+class CascadeModel:
+    """
+    Early exit cascade behind the keras predict API: every sentence goes through the first stage,
+    and only the sentences it predicts with a confidence below threshold go through the full model.
+    """
+
+    def __init__(self, first_stage, full_model, threshold=0.9):
+        """
+        :param first_stage: model taking the first three tribrid inputs, see first_stage_model.
+        :param full_model: tribrid model taking all four inputs.
+        :param threshold: minimum first stage confidence to skip the full model, above 1 to always escalate.
+        """
+        self.first_stage = first_stage
+        self.full_model = full_model
+        self.threshold = threshold
+        self.sentences = 0
+        self.escalated = 0
+
+    @property
+    def escalation_rate(self):
+        return self.escalated / self.sentences if self.sentences else 0.0
+
+    def predict_on_batch(self, x):
+        """
+        :param x: list of the four tribrid inputs.
+        :return: array of class probabilities, one row per sentence.
+        """
+        x = [np.asarray(value) for value in x]
+        pred_probs = np.array(self.first_stage.predict_on_batch(x[:3]))
+        escalate = pred_probs.max(axis=1) < self.threshold
+        if escalate.any():
+            pred_probs[escalate] = self.full_model.predict_on_batch([value[escalate] for value in x])
+        self.sentences += len(escalate)
+        self.escalated += int(escalate.sum())
+        return pred_probs
+
+    def predict(self, x, batch_size=None):
+        x = [np.asarray(value) for value in x]
+        batch_size = batch_size or 32
+        return np.concatenate([self.predict_on_batch([value[start:start + batch_size] for value in x])
+                               for start in range(0, len(x[0]), batch_size)])
+
+
+def save_cascade(first_stage, full_model_path, cascade_dir, threshold):
+    """
+    Saves the first stage and a cascade.json pointing at the full model, so the cascade directory
+    can be served like any model directory, see load_serving_model.
+    """
+    first_stage.save(os.path.join(cascade_dir, FIRST_STAGE_DIR), save_format='tf')
+    with open(os.path.join(cascade_dir, CASCADE_CONFIG), 'w') as f:
+        json.dump({"first_stage": FIRST_STAGE_DIR,
+                   "full_model": os.path.abspath(full_model_path),
+                   "threshold": threshold}, f, indent=2)
+    print(f"saved cascade with threshold {threshold} to {cascade_dir}")
+
+
+def is_cascade(model_path):
+    return os.path.isdir(model_path) and os.path.exists(os.path.join(model_path, CASCADE_CONFIG))
+
+
+def load_cascade(cascade_dir, threshold=None):
+    """
+    :param cascade_dir: directory written by save_cascade.
+    :param threshold: overrides the saved threshold.
+    :return: CascadeModel
+    """
+    with open(os.path.join(cascade_dir, CASCADE_CONFIG), 'r') as f:
+        config = json.load(f)
+    return CascadeModel(tf.keras.models.load_model(os.path.join(cascade_dir, config["first_stage"])),
+                        load_serving_model(config["full_model"]),
+                        config["threshold"] if threshold is None else threshold)
+
+
+def sweep_thresholds(cascade, store, thresholds=DEFAULT_THRESHOLDS, num_samples=5000, batch_size=256):
+    """
+    Escalation rate, accuracy and per sentence latency of the cascade for every threshold, with
+    the full model alone (threshold above 1) as the reference.
+    :param cascade: CascadeModel, its threshold is restored afterwards.
+    :param store: SampleStore of the evaluation split.
+    :param thresholds: first stage confidence thresholds to evaluate.
+    :param num_samples: number of sentences of the split evaluated.
+    :param batch_size: batch size of the predictions.
+    :return: list of dicts, one per threshold.
+    """
+    num_samples = min(num_samples, len(store))
+    features = [np.asarray(feature) for feature in
+                make_features([store.get_sentence(i) for i in range(num_samples)],
+                              store.line_number[:num_samples].astype(np.int32),
+                              store.total_lines[:num_samples].astype(np.int32))]
+    labels = np.asarray(store.target[:num_samples])
+    cascade.predict_on_batch([feature[:batch_size] for feature in features])  # trace both stages before timing
+
+    saved_threshold, results = cascade.threshold, []
+    for threshold in thresholds:
+        cascade.threshold, cascade.sentences, cascade.escalated = threshold, 0, 0
+        start = time.perf_counter()
+        preds = cascade.predict(features, batch_size=batch_size).argmax(axis=1)
+        seconds = time.perf_counter() - start
+        results.append({"threshold": threshold,
+                        "escalation_rate": round(cascade.escalation_rate, 4),
+                        "accuracy": round(float((preds == labels).mean()), 4),
+                        "ms_per_sentence": round(1000 * seconds / num_samples, 4),
+                        "sentences_per_sec": round(num_samples / seconds, 1)})
+        print(results[-1])
+    cascade.threshold = saved_threshold
+    return results
+
+
+def pick_threshold(results, max_accuracy_drop=0.005):
+    """
+    :param results: output of sweep_thresholds, which includes a threshold above 1 as the full model reference.
+    :param max_accuracy_drop: largest accuracy loss accepted compared with the full model.
+    :return: the threshold with the lowest escalation rate within max_accuracy_drop of the full model.
+    """
+    reference = max(results, key=lambda result: result["threshold"])["accuracy"]
+    accepted = [result for result in results if result["accuracy"] >= reference - max_accuracy_drop]
+    return min(accepted, key=lambda result: (result["escalation_rate"], -result["accuracy"]))["threshold"]
@@ -1,10 +1,29 @@
-import pandas as pd
+import os
+import shutil
+import hashlib
 import numpy as np
 import string
 import tensorflow as tf
 import json
-from tqdm import tqdm
-from sklearn.preprocessing import OneHotEncoder, LabelEncoder
+from src.parsing import split_chars, preprocess_text_with_line_numbers, build_split_columns, build_splits_columns
+
+# split_chars and preprocess_text_with_line_numbers moved to src.parsing, they stay importable from here.
+__all__ = ["PREPROCESSING_VERSION", "LABELS_PATH", "LINE_NUMBER_DEPTH", "TOTAL_LINES_DEPTH", "CHAR_STRIP_REGEX",
+           "SPLIT_FILES", "DATA_DIR", "split_chars", "preprocess_text_with_line_numbers", "get_lines",
+           "file_fingerprint", "get_cache_root", "get_cache_dir", "encode_targets", "decode_sentences",
+           "write_cache", "read_cache", "read_cached_class_names", "clear_cache", "load_preprocessed_splits",
+           "load_preprocessed_split", "split_chars_tensor", "get_dataset_graph_size", "make_char_table",
+           "char_ids_tensor", "SampleStore", "DataLoader"]
+
+# Bump whenever the parsing or the cached columns change, so stale caches are rebuilt.
+PREPROCESSING_VERSION = 2
+LABELS_PATH = "labels.json"
+LINE_NUMBER_DEPTH = 15
+TOTAL_LINES_DEPTH = 20
+# Punctuation stripped by TextVectorization's "lower_and_strip_punctuation" standardization.
+CHAR_STRIP_REGEX = r'[!"#$%&()\*\+,-\./:;<=>?@\[\\\]^_`{|}~\']'
+SPLIT_FILES = {"train": "train.txt", "val": "dev.txt", "test": "test.txt"}
+DATA_DIR = "pubmed-rct/PubMed_20k_RCT_numbers_replaced_with_at_sign/"
 
 
 def get_lines(filename):
@@ -12,216 +31,746 @@ def get_lines(filename):
         return f.readlines()
 
 
-def split_chars(text):
+def file_fingerprint(filename, chunk_size=1 << 20):
     """
-    Converts a list of string to list of chars
-    :param text: string input to be converted to list of chars.
-    :return: list of chars.
+    Content hash of a file, read in chunks so large splits are never fully loaded.
+    :param filename: path of the file to hash.
+    :param chunk_size: number of bytes read at a time.
+    :return: hex sha256 digest of the file contents.
     """
-    return " ".join(list(text))
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def preprocess_text_with_line_numbers(filename):
-    """Returns a list of dictionaries of abstract line data.
+def get_cache_root(data_dir):
+    """
+    The cache lives in a sibling directory of data_dir, e.g. pubmed-rct/PubMed_20k_RCT_cache/
+    :param data_dir: directory containing train.txt, dev.txt and test.txt.
+    :return: path of the cache root directory.
+    """
+    return data_dir.rstrip('/') + '_cache'
 
-    Takes in filename, reads its contents and sorts through each line,
-    extracting things like the target label, the text of the sentence,
-    how many sentences are in the current abstract and what sentence number
-    the target line is.
 
-    Args:
-        filename: a string of the target text file to read and extract line data
-        from.
+def get_cache_dir(data_dir, split, fingerprint):
+    """
+    Cache directory for one split, its file contents and the preprocessing version.
+    :param data_dir: directory containing the split files.
+    :param split: one of 'train', 'val' or 'test'.
+    :param fingerprint: content hash of the split file.
+    :return: path of the cache directory.
+    """
+    key = hashlib.sha256(f"{PREPROCESSING_VERSION}:{fingerprint}".encode()).hexdigest()[:16]
+    return os.path.join(get_cache_root(data_dir), f"{split}-{key}")
 
-    Returns:
-        A list of dictionaries each containing a line from an abstract,
-        the lines label, the lines position in the abstract and the total number
-        of lines in the abstract where the line is from. For example:
 
-        [{"target": 'CONCLUSION',
-          "text": The study couldn't have gone better, turns out people are kinder than you think",
-          "line_number": 8,
-          "total_lines": 8}]
+def encode_targets(targets, class_names):
     """
-    file = filename.split('/')[-1]
-    input_lines = get_lines(filename)  # get all lines from filename
-    abstract_lines = ""  # create an empty abstract
-    abstract_samples = []  # create an empty list of abstracts
+    Maps target strings to their index in class_names.
+    :param targets: list of target strings.
+    :param class_names: sorted list of class names.
+    :return: int8 array of label ids.
+    """
+    class_ids = {name: i for i, name in enumerate(class_names)}
+    unknown = set(targets) - set(class_ids)
+    if unknown:
+        raise ValueError(f"found labels not present in the training split: {sorted(unknown)}")
+    return np.array([class_ids[target] for target in targets], dtype=np.int8)
 
-    # Loop through each line in target file
-    for line in tqdm(input_lines, desc=f'processing {file}'):
-        if line.startswith("###"):  # check to see if line is an ID line
-            abstract_id = line
-            abstract_lines = ""  # reset abstract string
-        elif line.isspace():  # check to see if line is a new line
-            abstract_line_split = abstract_lines.splitlines()  # split abstract into separate lines
 
-            # Iterate through each line in abstract and count them at the same time
-            for abstract_line_number, abstract_line in enumerate(abstract_line_split):
-                line_data = {}  # create empty dict to store data from line
-                target_text_split = abstract_line.split("\t")  # split target label from text
-                line_data["target"] = target_text_split[0]  # get target label
-                line_data["text"] = target_text_split[1].lower()  # get target text and lower it
-                line_data[
-                    "line_number"] = abstract_line_number  # what number line does the line appear in the abstract?
-                line_data["total_lines"] = len(
-                    abstract_line_split) - 1  # how many total lines are in the abstract? (start from 0)
-                abstract_samples.append(line_data)  # add line data to abstract samples list
+def decode_sentences(text, offsets):
+    """
+    Converts a UTF-8 text buffer and its offsets back to a list of sentences.
+    :param text: uint8 array holding every sentence back to back.
+    :param offsets: int64 array of n + 1 sentence boundaries into text.
+    :return: list of sentences.
+    """
+    buffer = text.tobytes()
+    return [buffer[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
 
-        else:  # if the above conditions aren't fulfilled, the line contains a labelled sentence
-            abstract_lines += line
-    return abstract_samples
 
+def write_cache(columns, split, cache_dir, fingerprint):
+    """
+    Writes the columns of a parsed split to cache_dir. Label ids index the sorted
+    labels of the split itself, which are stored in the meta data; the train split also
+    stores its per sentence lengths and length statistics.
+    The cache is written to a temporary directory and renamed into place, so an interrupted
+    run never leaves a half written cache behind. Caches of the split built from other file
+    contents or preprocessing versions are removed.
+    :param columns: dict of columns returned by build_split_columns.
+    :param split: one of 'train', 'val' or 'test'.
+    :param cache_dir: destination directory returned by get_cache_dir.
+    :param fingerprint: content hash of the split file.
+    """
+    columns = dict(columns)
+    class_names = sorted(set(columns["target"]))
+    columns["target"] = encode_targets(columns["target"], class_names)
+    meta = {"version": PREPROCESSING_VERSION,
+            "fingerprint": fingerprint,
+            "class_names": class_names}
+
+    if split == "train":
+        sentences = decode_sentences(columns["text"], columns["offsets"])
+        columns["word_count"] = np.array([len(sentence.split()) for sentence in sentences], dtype=np.int32)
+        columns["char_count"] = np.array([len(sentence) for sentence in sentences], dtype=np.int32)
+        meta.update({"average_train_sentences_length": float(np.mean(columns["word_count"])),
+                     "output_sequences_len": int(np.percentile(columns["word_count"], 95)),
+                     "mean_char_len": float(np.mean(columns["char_count"])),
+                     "output_sequences_char_length": int(np.percentile(columns["char_count"], 95))})
+
+    tmp_dir = f"{cache_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), values)
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    clear_cache(os.path.dirname(cache_dir), split)
+    os.rename(tmp_dir, cache_dir)
+    print(f"saved preprocessed {split} split to {cache_dir}")
+
+
+def read_cache(cache_dir):
+    """
+    Memory-maps the columns of a cache written by write_cache.
+    :param cache_dir: cache directory to read.
+    :return: (dict of column name -> memory-mapped array, meta dict), or None if the cache is missing or stale.
+    """
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
 
-class DataLoader:
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    if meta.get("version") != PREPROCESSING_VERSION:
+        return None
 
-    def __init__(self, batch_size):
-        self.DATA_DIR = "pubmed-rct/PubMed_20k_RCT_numbers_replaced_with_at_sign/"
-        self.MAX_TOKENS = 68000 + 10
-        alphabets = string.ascii_lowercase + string.digits + string.punctuation
-        self.NUM_CHAR_TOKENS = len(alphabets) + 2  # num of characters in alphabets + space + 'OOV' token
-        self.BATCH_SIZE = batch_size
-        # self.train_lines = self.get_lines(self.DATA_DIR + 'train.txt')
+    columns = {}
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".npy"):
+            columns[filename[:-len(".npy")]] = np.load(os.path.join(cache_dir, filename), mmap_mode='r')
+    return columns, meta
 
-        self.train_samples = preprocess_text_with_line_numbers(self.DATA_DIR + 'train.txt')
-        self.test_samples = preprocess_text_with_line_numbers(self.DATA_DIR + 'test.txt')
-        self.val_samples = preprocess_text_with_line_numbers(self.DATA_DIR + 'dev.txt')
 
-        self.train_df = pd.DataFrame(self.train_samples)
-        self.val_df = pd.DataFrame(self.val_samples)
-        self.test_df = pd.DataFrame(self.test_samples)
+def read_cached_class_names(data_dir):
+    """
+    Class names of the train split cache of data_dir, read from its meta data without hashing the
+    split file or mapping the columns. write_cache only keeps the cache of the latest train file.
+    :param data_dir: directory containing the split files.
+    :return: list of class names, or None if the train split is not cached.
+    """
+    cache_root = get_cache_root(data_dir)
+    if not os.path.isdir(cache_root):
+        return None
+    for name in sorted(os.listdir(cache_root)):
+        meta_path = os.path.join(cache_root, name, "meta.json")
+        if name.startswith("train-") and ".tmp-" not in name and os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            if meta.get("version") == PREPROCESSING_VERSION:
+                return meta["class_names"]
+    return None
+
+
+def clear_cache(cache_root, split=None):
+    """
+    Removes the preprocessed caches under cache_root.
+    :param cache_root: cache root directory returned by get_cache_root.
+    :param split: only remove the caches of this split, all splits if None.
+    """
+    if not os.path.isdir(cache_root):
+        return
+    for name in os.listdir(cache_root):
+        if name.endswith(f".tmp-{os.getpid()}"):  # keep the cache this process is writing
+            continue
+        if split is None or name.startswith(f"{split}-"):
+            shutil.rmtree(os.path.join(cache_root, name), ignore_errors=True)
 
-        self.train_sentences = self.train_df["text"].tolist()
-        self.val_sentences = self.val_df["text"].tolist()
-        self.test_sentences = self.test_df["text"].tolist()
 
-        one_hot_encoder = OneHotEncoder(sparse=False)
-        label_encoder = LabelEncoder()
+def load_preprocessed_splits(data_dir, splits, rebuild_cache=False, num_workers=1):
+    """
+    Returns the preprocessed columns of several splits, parsing only the split files that have
+    no valid cache for their current contents, concurrently when num_workers > 1.
+    :param data_dir: directory containing train.txt, dev.txt and test.txt.
+    :param splits: split names out of 'train', 'val' and 'test'.
+    :param rebuild_cache: if True, ignore any existing cache and rebuild it.
+    :param num_workers: number of processes used to parse the split files.
+    :return: dict of split -> (dict of column name -> memory-mapped array, meta dict)
+    """
+    loaded, missing = {}, {}
+    for split in splits:
+        filename = data_dir + SPLIT_FILES[split]
+        fingerprint = file_fingerprint(filename)
+        cache_dir = get_cache_dir(data_dir, split, fingerprint)
+        cached = None if rebuild_cache else read_cache(cache_dir)
+        if cached is not None:
+            print(f"loading preprocessed {split} split from {cache_dir}")
+            loaded[split] = cached
+        else:
+            missing[split] = (filename, cache_dir, fingerprint)
+
+    if missing:
+        columns = build_splits_columns({split: filename for split, (filename, _, _) in missing.items()},
+                                       num_workers=num_workers)
+        for split, (_, cache_dir, fingerprint) in missing.items():
+            write_cache(columns.pop(split), split, cache_dir, fingerprint)
+            loaded[split] = read_cache(cache_dir)
+
+    return {split: loaded[split] for split in splits}
+
+
+def load_preprocessed_split(data_dir, split, rebuild_cache=False, num_workers=1):
+    """
+    Returns the preprocessed columns of one split, see load_preprocessed_splits.
+    :return: (dict of column name -> memory-mapped array, meta dict)
+    """
+    return load_preprocessed_splits(data_dir, [split], rebuild_cache, num_workers)[split]
 
-        train_labels_encoded = label_encoder.fit_transform(self.train_df["target"].to_numpy())
-        class_names = label_encoder.classes_
-        print(f"class_names: {class_names}")
-        class_labels = {}
 
-        for i, name in enumerate(class_names):
-            class_labels[i] = name
+def split_chars_tensor(sentences):
+    """
+    tf.strings equivalent of split_chars, so character inputs can be built inside a tf.data map.
+    :param sentences: string tensor of sentences.
+    :return: string tensor with a space between every character of each sentence.
+    """
+    return tf.strings.strip(tf.strings.regex_replace(sentences, "(.)", r"\1 "))
 
-        with open("labels.json", "w") as f:
-            json.dump(class_labels, f)
-        print(f"saving labels to labels.json...")
 
-        self.train_labels_one_hot = one_hot_encoder.fit_transform(self.train_df["target"].to_numpy().reshape(-1, 1))
-        self.val_labels_one_hot = one_hot_encoder.transform(self.val_df["target"].to_numpy().reshape(-1, 1))
-        self.test_labels_one_hot = one_hot_encoder.transform(self.test_df["target"].to_numpy().reshape(-1, 1))
+def get_dataset_graph_size(dataset):
+    """
+    Size of the serialized graph of a tf.data pipeline, including the tensors embedded by
+    from_tensor_slices. Useful to compare pipeline variants, as the benchmarks do. tf.data has no public
+    API for the serialized graph, so this relies on the private Dataset._as_serialized_graph(), which is
+    kept to the benchmarks rather than the training or serving code.
+    :param dataset: tf.data.Dataset
+    :return: size in bytes.
+    """
+    return len(dataset._as_serialized_graph().numpy())
 
-        self.train_sentences_length = [len(sentence.split()) for sentence in self.train_sentences]
-        self.average_train_sentences_length = np.mean(self.train_sentences_length)
-        self.output_sequences_len = int(np.percentile(self.train_sentences_length, 95))
 
-        self.train_chars = [split_chars(sentence) for sentence in self.train_sentences]
-        self.valid_chars = [split_chars(sentence) for sentence in self.val_sentences]
-        self.test_chars = [split_chars(sentence) for sentence in self.test_sentences]
+def make_char_table(vocabulary):
+    """
+    Lookup table of a char vocabulary as returned by TextVectorization.get_vocabulary(), whose
+    first two entries are the padding and OOV tokens.
+    :param vocabulary: list of chars.
+    :return: tf.lookup.StaticHashTable mapping a char to its id, unknown chars to the OOV id 1.
+    """
+    keys = tf.constant(vocabulary[2:], dtype=tf.string)
+    values = tf.range(2, len(vocabulary), dtype=tf.int64)
+    return tf.lookup.StaticHashTable(tf.lookup.KeyValueTensorInitializer(keys, values), default_value=1)
 
-        self.train_chars_length = [len(sentence) for sentence in self.train_sentences]
-        self.mean_char_len = np.mean(self.train_chars_length)
-        self.output_sequences_char_length = int(np.percentile(self.train_chars_length, 95))
 
-        self.line_number = self.train_df['line_number']
-        self.train_line_numbers_one_hot = tf.one_hot(self.line_number.to_numpy(), depth=15)
-        self.val_line_numbers_one_hot = tf.one_hot(self.val_df['line_number'].to_numpy(), depth=15)
-        self.test_line_numbers_one_hot = tf.one_hot(self.test_df['line_number'].to_numpy(), depth=15)
+def char_ids_tensor(sentences, table, max_length, pad_to_max_length=True):
+    """
+    Maps sentences straight to the char ids char_vectorizer would produce for their split_chars
+    form: lower case, strip punctuation and whitespace, split into UTF-8 chars and look them up.
+    :param sentences: string tensor of sentences, scalar or 1-D.
+    :param table: table returned by make_char_table.
+    :param max_length: number of chars kept per sentence.
+    :param pad_to_max_length: pad every sentence to max_length, otherwise to the longest sentence of the batch.
+    :return: int64 tensor of char ids, 0 being padding.
+    """
+    scalar = sentences.shape.rank == 0
+    if scalar:
+        sentences = sentences[tf.newaxis]
 
-        self.train_total_lines_one_hot = tf.one_hot(self.train_df["total_lines"].to_numpy(), depth=20)
-        self.val_total_lines_one_hot = tf.one_hot(self.val_df["total_lines"].to_numpy(), depth=20)
-        self.test_total_lines_one_hot = tf.one_hot(self.test_df["total_lines"].to_numpy(), depth=20)
+    sentences = tf.strings.regex_replace(tf.strings.lower(sentences), CHAR_STRIP_REGEX, "")
+    sentences = tf.strings.regex_replace(sentences, r"\s", "")
+    chars = tf.strings.unicode_split(sentences, "UTF-8")
+    ids = tf.ragged.map_flat_values(table.lookup, chars)
+    if pad_to_max_length:
+        ids = ids.to_tensor(default_value=0, shape=[None, max_length])
+    else:
+        ids = ids.to_tensor(default_value=0)[:, :max_length]
 
-    def __get_train_char_dataset(self):
+    return ids[0] if scalar else ids
+
+
+class SampleStore:
+    """
+    Columnar storage of one dataset split.
+
+    Every sentence is kept back to back in a single UTF-8 buffer indexed by an offsets
+    array, and the label id and positional features in int8/int16 arrays, so a split costs
+    a few bytes per sentence on top of its text instead of one Python object per field.
+    The arrays may be memory-mapped from the dataset cache.
+    """
+
+    def __init__(self, text, offsets, target, line_number, total_lines, fingerprint=None):
+        self.text = text                    # uint8, all sentences back to back
+        self.offsets = offsets              # int64, n + 1 sentence boundaries into text
+        self.target = target                # int8, label ids
+        self.line_number = line_number      # int16, position of the sentence in its abstract
+        self.total_lines = total_lines      # int16, number of lines in the abstract - 1
+        self.fingerprint = fingerprint      # content hash of the split file, if known
+
+    @classmethod
+    def from_columns(cls, columns, meta, class_names):
         """
-        Generate a tf.data.Dataset input train_chars data pipeline
-        :return: a train_char pipeline
+        Builds the store of a split from the columns returned by load_preprocessed_split.
+        :param columns: dict of column name -> array.
+        :param meta: meta data of the split, holding the class names its label ids refer to.
+        :param class_names: class names the label ids of the store should refer to.
+        :return: SampleStore
+        """
+        target = columns["target"]
+        if list(meta["class_names"]) != list(class_names):
+            target = encode_targets(meta["class_names"], class_names)[target]
+        return cls(text=columns["text"],
+                   offsets=columns["offsets"],
+                   target=target,
+                   line_number=columns["line_number"],
+                   total_lines=columns["total_lines"],
+                   fingerprint=meta.get("fingerprint"))
+
+    @classmethod
+    def from_file(cls, filename, class_names):
         """
-        train_char_dataset = tf.data.Dataset.from_tensor_slices((self.train_chars, self.train_labels_one_hot))
-        train_char_dataset = train_char_dataset.batch(self.BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+        Parses a PubMed RCT file directly into a store, bypassing the cache.
+        :param filename: path to a PubMed RCT split file.
+        :param class_names: sorted list of class names used to encode the targets.
+        :return: SampleStore
+        """
+        columns = build_split_columns(filename)
+        return cls(text=columns["text"],
+                   offsets=columns["offsets"],
+                   target=encode_targets(columns["target"], class_names),
+                   line_number=columns["line_number"],
+                   total_lines=columns["total_lines"])
 
-        return train_char_dataset
+    def __len__(self):
+        return len(self.offsets) - 1
 
-    def __get_val_char_dataset(self):
+    def get_sentence(self, index):
+        """
+        :param index: position of the sentence in the split.
+        :return: the decoded sentence.
+        """
+        return self.text[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
 
-        val_char_dataset = tf.data.Dataset.from_tensor_slices((self.valid_chars, self.val_labels_one_hot))
-        val_char_dataset = val_char_dataset.batch(self.BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+    @property
+    def starts(self):
+        return np.asarray(self.offsets[:-1], dtype=np.int64)
 
-        return val_char_dataset
+    @property
+    def lengths(self):
+        return np.diff(self.offsets).astype(np.int64)
 
-    def __get_train_dataset(self):
+    def sentences(self):
         """
-        Generate a tf.data.Dataset input train data pipeline
-        :return: a training pipeline
+        Slices every sentence out of the text buffer in a single tf op.
+        :return: string tensor of shape (n,)
+        """
+        return tf.strings.substr(tf.constant(self.text.tobytes()), self.starts, self.lengths)
+
+    @property
+    def nbytes(self):
+        """
+        :return: number of bytes held by the columns of the store.
         """
-        train_dataset = tf.data.Dataset.from_tensor_slices((self.train_sentences, self.train_labels_one_hot))
-        train_dataset = train_dataset.batch(self.BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+        return sum(column.nbytes for column in (self.text, self.offsets, self.target,
+                                                self.line_number, self.total_lines))
 
-        return train_dataset
 
-    def __get_validation_dataset(self):
+class DataLoader:
+    alphabets = string.ascii_lowercase + string.digits + string.punctuation
+    NUM_CHAR_TOKENS = len(alphabets) + 2  # num of characters in alphabets + space + 'OOV' token
+
+    def __init__(self, batch_size, rebuild_cache=False, integer_features=False, bucket_by_char_length=False,
+                 num_char_buckets=8, num_workers=1, data_dir=None):
         """
-        Generate a tf.data.Dataset input validation data pipeline
-        :return: a validation pipeline
+        Nothing is read here: each split is loaded the first time it is used, so training
+        never touches the test split and evaluation never parses the train split.
+        :param batch_size: batch size of the tf.data pipelines.
+        :param rebuild_cache: ignore the preprocessed dataset cache and rebuild it for every split loaded.
+        :param integer_features: keep labels, line numbers and total lines as their int8/int16 ids in the
+        pipelines and one hot encode them per batch inside the map, instead of slicing dense float matrices.
+        :param bucket_by_char_length: batch the pipelines with a char input by sentence length, so each batch
+        only holds sentences of similar length. Meant for models built with bucketed_chars=True.
+        :param num_char_buckets: number of length buckets used when bucket_by_char_length is set.
+        :param num_workers: number of processes used to parse split files that are not cached yet.
+        :param data_dir: directory of the split files, defaults to DATA_DIR.
         """
-        valid_dataset = tf.data.Dataset.from_tensor_slices((self.val_sentences, self.val_labels_one_hot))
-        valid_dataset = valid_dataset.batch(self.BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+        self.DATA_DIR = os.path.join(data_dir or DATA_DIR, '')
+        self.MAX_TOKENS = 68000 + 10
+        self.BATCH_SIZE = batch_size
+        self.rebuild_cache = rebuild_cache
+        self.num_workers = num_workers
+        self.integer_features = integer_features
+        self.bucket_by_char_length = bucket_by_char_length
+        self.num_char_buckets = num_char_buckets
+        self.char_table = None
+        self.char_ids_length = None
+        # self.train_lines = self.get_lines(self.DATA_DIR + 'train.txt')
 
-        return valid_dataset
+        self.__stores = {}
+        self.__train_columns = None
+        self.__train_meta = None
+        self.__class_names = None
 
-    def __get_test_dataset(self):
+    def __load_train(self, loaded=None):
+        if self.__train_meta is None:
+            if loaded is None:
+                loaded = load_preprocessed_split(self.DATA_DIR, "train", rebuild_cache=self.rebuild_cache,
+                                                 num_workers=self.num_workers)
+            self.__train_columns, self.__train_meta = loaded
+            self.__class_names = self.__train_meta["class_names"]
+            print(f"class_names: {self.__class_names}")
+            class_labels = {}
+
+            for i, name in enumerate(self.__class_names):
+                class_labels[i] = name
+
+            with open(LABELS_PATH, "w") as f:
+                json.dump(class_labels, f)
+            print(f"saving labels to {LABELS_PATH}...")
+
+        return self.__train_columns, self.__train_meta
+
+    @property
+    def class_names(self):
+        """
+        Labels of the train split. When only evaluation splits are used they are read from the
+        meta data of the train split cache of DATA_DIR, or else from the labels.json written by
+        the training run, which may come from another dataset, so it must hold sorted labels and
+        cover the labels of every split loaded. The train split is only loaded without either.
+        """
+        if self.__class_names is None:
+            class_names = read_cached_class_names(self.DATA_DIR)
+            if class_names is None and os.path.exists(LABELS_PATH):
+                with open(LABELS_PATH, "r") as f:
+                    class_labels = json.load(f)
+                class_names = [class_labels[str(i)] for i in range(len(class_labels))]
+                if class_names != sorted(set(class_names)):
+                    raise ValueError(f"{LABELS_PATH} holds {class_names}, not the sorted labels of a train split, "
+                                     f"remove it to load the train split of {self.DATA_DIR}")
+                print(f"class_names: {class_names}, read from {LABELS_PATH}")
+            if class_names is None:
+                self.__load_train()
+            else:
+                self.__class_names = class_names
+        return self.__class_names
+
+    def load_splits(self, splits):
         """
-        Generates a tf.data.Dataset input test data pipeline
-        :return: a testing pipeline
+        Loads several splits into SampleStores, parsing the uncached ones concurrently.
+        :param splits: split names out of 'train', 'val' and 'test'.
+        :return: list of SampleStore, in the order of splits.
         """
-        test_dataset = tf.data.Dataset.from_tensor_slices((self.test_sentences, self.test_labels_one_hot))
+        missing = [split for split in splits if split not in self.__stores]
+        if missing:
+            loaded = load_preprocessed_splits(self.DATA_DIR, missing, rebuild_cache=self.rebuild_cache,
+                                              num_workers=self.num_workers)
+            if "train" in loaded:
+                self.__load_train(loaded["train"])
+            for split, (columns, meta) in loaded.items():
+                self.__stores[split] = SampleStore.from_columns(columns, meta, self.class_names)
+        return [self.__stores[split] for split in splits]
+
+    def load_split(self, split):
+        """
+        Loads a split into a SampleStore on first use.
+        :param split: one of 'train', 'val' or 'test'.
+        :return: SampleStore of the split.
+        """
+        return self.load_splits([split])[0]
 
-        return test_dataset
+    def set_char_vocabulary(self, vocabulary, output_sequence_length):
+        """
+        Switches the 'chars' input of every pipeline from character-spaced strings to char ids,
+        computed with tf.strings ops inside the map, for models built with char_ids=True.
+        :param vocabulary: char vocabulary, as returned by TextVectorization.get_vocabulary().
+        :param output_sequence_length: number of char ids kept per sentence.
+        """
+        self.char_table = make_char_table(vocabulary)
+        self.char_ids_length = output_sequence_length
 
-    def get_only_tokens_data(self):
-        return self.__get_train_dataset(), self.__get_validation_dataset()
+    def sample_sentences(self, split, sample_size, seed=42):
+        """
+        :param split: one of 'train', 'val' or 'test'.
+        :param sample_size: maximum number of sentences returned.
+        :param seed: seed of the sample.
+        :return: list of randomly sampled sentences of the split, in split order.
+        """
+        store = self.load_split(split)
+        sample_size = min(sample_size, len(store))
+        indices = np.sort(np.random.default_rng(seed).choice(len(store), size=sample_size, replace=False))
+        return [store.get_sentence(i) for i in indices]
+
+    @property
+    def train_store(self):
+        return self.load_split("train")
+
+    @property
+    def val_store(self):
+        return self.load_split("val")
+
+    @property
+    def test_store(self):
+        return self.load_split("test")
+
+    # Length statistics of the train split.
+    @property
+    def train_sentences_length(self):
+        return self.__load_train()[0]["word_count"]
+
+    @property
+    def average_train_sentences_length(self):
+        return self.__load_train()[1]["average_train_sentences_length"]
+
+    @property
+    def output_sequences_len(self):
+        return self.__load_train()[1]["output_sequences_len"]
+
+    @property
+    def train_chars_length(self):
+        return self.__load_train()[0]["char_count"]
+
+    @property
+    def mean_char_len(self):
+        return self.__load_train()[1]["mean_char_len"]
+
+    @property
+    def output_sequences_char_length(self):
+        return self.__load_train()[1]["output_sequences_char_length"]
+
+    # Per split features, computed from the stores on access instead of being kept around.
+    @property
+    def train_sentences(self):
+        return self.train_store.sentences()
+
+    @property
+    def val_sentences(self):
+        return self.val_store.sentences()
+
+    @property
+    def test_sentences(self):
+        return self.test_store.sentences()
+
+    @property
+    def train_chars(self):
+        return split_chars_tensor(self.train_sentences)
+
+    @property
+    def valid_chars(self):
+        return split_chars_tensor(self.val_sentences)
+
+    @property
+    def test_chars(self):
+        return split_chars_tensor(self.test_sentences)
+
+    @property
+    def train_labels_one_hot(self):
+        return self.__labels_one_hot(self.train_store)
+
+    @property
+    def val_labels_one_hot(self):
+        return self.__labels_one_hot(self.val_store)
+
+    @property
+    def test_labels_one_hot(self):
+        return self.__labels_one_hot(self.test_store)
+
+    @property
+    def train_line_numbers_one_hot(self):
+        return tf.one_hot(self.train_store.line_number.astype(np.int32), depth=LINE_NUMBER_DEPTH)
+
+    @property
+    def val_line_numbers_one_hot(self):
+        return tf.one_hot(self.val_store.line_number.astype(np.int32), depth=LINE_NUMBER_DEPTH)
+
+    @property
+    def test_line_numbers_one_hot(self):
+        return tf.one_hot(self.test_store.line_number.astype(np.int32), depth=LINE_NUMBER_DEPTH)
+
+    @property
+    def train_total_lines_one_hot(self):
+        return tf.one_hot(self.train_store.total_lines.astype(np.int32), depth=TOTAL_LINES_DEPTH)
+
+    @property
+    def val_total_lines_one_hot(self):
+        return tf.one_hot(self.val_store.total_lines.astype(np.int32), depth=TOTAL_LINES_DEPTH)
+
+    @property
+    def test_total_lines_one_hot(self):
+        return tf.one_hot(self.test_store.total_lines.astype(np.int32), depth=TOTAL_LINES_DEPTH)
 
-    def get_only_char_and_token_data(self):
+    def __labels_one_hot(self, store):
+        return np.eye(len(self.class_names))[store.target]
 
-        train_char_token_data = tf.data.Dataset.from_tensor_slices((self.train_sentences, self.train_chars))
-        train_char_token_labels = tf.data.Dataset.from_tensor_slices(self.train_labels_one_hot)
-        train_char_token_dataset = tf.data.Dataset.zip((train_char_token_data, train_char_token_labels))
+    def __build_dataset(self, store, features, batched=True, embeddings=None, soft_labels=None,
+                        with_line_numbers=False):
+        """
+        Generate a tf.data.Dataset for a split straight from its SampleStore.
+        Only sentence offsets and the small feature arrays are sliced; sentences are cut out of
+        the shared text buffer and character-split inside the map.
+        :param store: SampleStore of the split.
+        :param features: tuple of model inputs, in order, out of 'line_numbers', 'total_lines', 'tokens' and 'chars'.
+        :param batched: batch and prefetch the dataset.
+        :param embeddings: CachedEmbeddings of the split. If given, the 'tokens' input is the cached sentence
+        embedding instead of the raw sentence.
+        :param soft_labels: array of teacher probabilities of the split, one row per sentence. If given, the
+        labels are a dict of the one hot labels under 'hard_output' and these under 'soft_output'.
+        :param with_line_numbers: also yield the line number of every sentence, whatever the depth of its one hot.
+        :return: dataset of (inputs, one hot labels), or (inputs, one hot labels, line numbers)
+        """
+        text = tf.constant(store.text.tobytes())
+        num_classes = len(self.class_names)
+        slices = {"start": store.starts, "length": store.lengths}
+        if embeddings is not None:
+            slices["rows"] = embeddings.rows
+        if soft_labels is not None:
+            slices["soft_labels"] = soft_labels
+        if with_line_numbers:
+            slices["line_number_ids"] = store.line_number
+        if self.integer_features:
+            slices["labels"] = store.target
+            if 'line_numbers' in features:
+                slices['line_numbers'] = store.line_number
+            if 'total_lines' in features:
+                slices['total_lines'] = store.total_lines
+        else:
+            slices["labels"] = self.__labels_one_hot(store)
+            if 'line_numbers' in features:
+                slices['line_numbers'] = tf.one_hot(store.line_number.astype(np.int32), depth=LINE_NUMBER_DEPTH)
+            if 'total_lines' in features:
+                slices['total_lines'] = tf.one_hot(store.total_lines.astype(np.int32), depth=TOTAL_LINES_DEPTH)
+
+        def to_inputs(batch):
+            sentences = tf.strings.substr(text, batch["start"], batch["length"])
+            labels = batch["labels"]
+            if self.integer_features:
+                labels = tf.one_hot(tf.cast(labels, tf.int32), depth=num_classes)
+            inputs = []
+            for feature in features:
+                if feature == 'tokens' and embeddings is not None:
+                    inputs.append(embeddings.lookup(batch["rows"]))
+                elif feature == 'tokens':
+                    inputs.append(sentences)
+                elif feature == 'chars' and self.char_table is not None:
+                    inputs.append(char_ids_tensor(sentences, self.char_table, self.char_ids_length,
+                                                  pad_to_max_length=not self.bucket_by_char_length))
+                elif feature == 'chars':
+                    inputs.append(split_chars_tensor(sentences))
+                elif self.integer_features:
+                    depth = LINE_NUMBER_DEPTH if feature == 'line_numbers' else TOTAL_LINES_DEPTH
+                    inputs.append(tf.one_hot(tf.cast(batch[feature], tf.int32), depth=depth))
+                else:
+                    inputs.append(batch[feature])
+            if soft_labels is not None:
+                labels = {"hard_output": labels, "soft_output": tf.cast(batch["soft_labels"], tf.float32)}
+            if with_line_numbers:
+                return (tuple(inputs) if len(inputs) > 1 else inputs[0]), labels, batch["line_number_ids"]
+            return (tuple(inputs) if len(inputs) > 1 else inputs[0]), labels
+
+        dataset = tf.data.Dataset.from_tensor_slices(slices)
+        if not batched:
+            return dataset.map(to_inputs, num_parallel_calls=tf.data.AUTOTUNE)
+
+        if self.bucket_by_char_length and 'chars' in features:
+            boundaries = self.char_length_bucket_boundaries()
+            dataset = dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+                element_length_func=lambda element: element["length"],
+                bucket_boundaries=boundaries,
+                bucket_batch_sizes=[self.BATCH_SIZE] * (len(boundaries) + 1)))
+        else:
+            dataset = dataset.batch(self.BATCH_SIZE)
+
+        dataset = dataset.map(to_inputs, num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def char_length_bucket_boundaries(self):
+        """
+        Sentence length boundaries splitting the train split into num_char_buckets buckets of
+        roughly equal size. Lengths are in UTF-8 bytes, which is the char length for the ASCII
+        text of PubMed.
+        :return: sorted list of distinct int boundaries.
+        """
+        percentiles = np.linspace(0, 100, self.num_char_buckets + 1)[1:-1]
+        boundaries = np.percentile(self.train_store.lengths, percentiles).astype(np.int64) + 1
+        return sorted(set(boundaries.tolist()))
 
-        train_chars_token_dataset = train_char_token_dataset.batch(self.BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+    def __get_train_char_dataset(self):
+        """
+        Generate a tf.data.Dataset input train_chars data pipeline
+        :return: a train_char pipeline
+        """
+        return self.__build_dataset(self.train_store, ('chars',))
 
-        valid_char_token_data = tf.data.Dataset.from_tensor_slices((self.val_sentences, self.valid_chars))
-        valid_char_token_labels = tf.data.Dataset.from_tensor_slices(self.val_labels_one_hot)
-        valid_char_token_dataset = tf.data.Dataset.zip((valid_char_token_data, valid_char_token_labels))
+    def __get_val_char_dataset(self):
 
-        valid_chars_dataset = valid_char_token_dataset.batch(self.BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+        return self.__build_dataset(self.val_store, ('chars',))
 
-        return train_chars_token_dataset, valid_chars_dataset
+    def __get_train_dataset(self, embeddings=None):
+        """
+        Generate a tf.data.Dataset input train data pipeline
+        :return: a training pipeline
+        """
+        return self.__build_dataset(self.train_store, ('tokens',), embeddings=embeddings)
 
-    def get_tribrid_model_input(self):
+    def __get_validation_dataset(self, embeddings=None):
+        """
+        Generate a tf.data.Dataset input validation data pipeline
+        :return: a validation pipeline
+        """
+        return self.__build_dataset(self.val_store, ('tokens',), embeddings=embeddings)
+
+    def get_test_dataset(self, split="test", with_line_numbers=False):
+        """
+        Generates a batched and prefetched pipeline of the serving inputs of an evaluation split, for the tribrid
+        model and everything served in its place.
+        :param split: one of 'train', 'val' or 'test'.
+        :param with_line_numbers: also yield the line number of every sentence, for the per position metrics.
+        :return: dataset of (inputs, one hot labels), or (inputs, one hot labels, line numbers)
+        """
+        features = ('line_numbers', 'total_lines', 'tokens', 'chars')
+        return self.__build_dataset(self.load_split(split), features, with_line_numbers=with_line_numbers)
+
+    def get_only_tokens_data(self, embeddings=None):
+        """
+        :param embeddings: optional dict of split -> CachedEmbeddings, to feed cached sentence embeddings
+        instead of raw sentences.
+        """
+        embeddings = embeddings or {}
+        return self.__get_train_dataset(embeddings.get("train")), self.__get_validation_dataset(embeddings.get("val"))
+
+    def get_only_char_and_token_data(self, embeddings=None):
+
+        embeddings = embeddings or {}
+        return (self.__build_dataset(self.train_store, ('tokens', 'chars'), embeddings=embeddings.get("train")),
+                self.__build_dataset(self.val_store, ('tokens', 'chars'), embeddings=embeddings.get("val")))
+
+    def get_tribrid_model_input(self, embeddings=None):
         """
         Make the data pipeline for tribrid model.
+        :param embeddings: optional dict of split -> CachedEmbeddings, to feed cached sentence embeddings
+        instead of raw sentences.
         :return: training dataset with positional embeddings, validation dataset with positional embeddings.
         """
-        #training dataset.
-        train_pos_char_token_data = tf.data.Dataset.from_tensor_slices((self.train_line_numbers_one_hot,  # line numbers
-                                                                        self.train_total_lines_one_hot,   # total lines
-                                                                        self.train_sentences,             # train tokens
-                                                                        self.train_chars))                # train chars
-        train_pos_char_token_labels = tf.data.Dataset.from_tensor_slices(self.train_labels_one_hot)       # train labels
-        train_pos_char_token_dataset = tf.data.Dataset.zip((train_pos_char_token_data, train_pos_char_token_labels))  # combine data and labels
-        train_pos_char_token_dataset = train_pos_char_token_dataset.batch(self.BATCH_SIZE).prefetch(tf.data.AUTOTUNE)  # turn into batches and prefetch appropriately
-
-        # Validation dataset
-        val_pos_char_token_data = tf.data.Dataset.from_tensor_slices((self.val_line_numbers_one_hot,
-                                                                      self.val_total_lines_one_hot,
-                                                                      self.val_sentences,
-                                                                      self.valid_chars))
-        val_pos_char_token_labels = tf.data.Dataset.from_tensor_slices(self.val_labels_one_hot)
-        val_pos_char_token_dataset = tf.data.Dataset.zip((val_pos_char_token_data, val_pos_char_token_labels))
-        val_pos_char_token_dataset = val_pos_char_token_dataset.batch(self.BATCH_SIZE).prefetch(tf.data.AUTOTUNE)  # turn into batches and prefetch appropriately
-
-        return train_pos_char_token_dataset, val_pos_char_token_dataset
+        embeddings = embeddings or {}
+        features = ('line_numbers', 'total_lines', 'tokens', 'chars')
+        return (self.__build_dataset(self.train_store, features, embeddings=embeddings.get("train")),
+                self.__build_dataset(self.val_store, features, embeddings=embeddings.get("val")))
+
+    def get_positional_token_data(self):
+        """
+        Pipelines of the positional features and raw sentences, without chars, for the first stage of the cascade.
+        :return: training dataset, validation dataset
+        """
+        features = ('line_numbers', 'total_lines', 'tokens')
+        return self.__build_dataset(self.train_store, features), self.__build_dataset(self.val_store, features)
 
+    def get_distillation_data(self, soft_labels):
+        """
+        Tribrid pipelines whose labels also hold the teacher's probabilities, for distillation.
+        :param soft_labels: dict of 'train' and 'val' -> array of teacher probabilities, one row per sentence.
+        :return: training dataset, validation dataset of (inputs, {'hard_output': ..., 'soft_output': ...})
+        """
+        features = ('line_numbers', 'total_lines', 'tokens', 'chars')
+        return (self.__build_dataset(self.train_store, features, soft_labels=soft_labels["train"]),
+                self.__build_dataset(self.val_store, features, soft_labels=soft_labels["val"]))
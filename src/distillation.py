@@ -0,0 +1,116 @@
+import os
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+from tensorflow.keras import layers
+from src.data import get_cache_root
+from src.inference import make_features, load_labels, load_serving_model, model_version
+
+
+def get_teacher_cache_path(data_dir, split, store, teacher_path):
+    """
+    :param data_dir: directory containing the split files.
+    :param split: one of 'train', 'val' or 'test'.
+    :param store: SampleStore of the split.
+    :param teacher_path: directory of the saved teacher model.
+    :return: .npy file holding the teacher probabilities of the split.
+    """
+    return os.path.join(get_cache_root(data_dir), f"teacher-{model_version(teacher_path)}",
+                        f"{split}-{store.fingerprint[:16]}.npy")
+
+
+def predict_teacher(teacher, teacher_labels, store, class_names, cache_path, batch_size=1024):
+    """
+    Runs the teacher over every sentence of a split once and writes its probabilities, in the
+    column order of class_names, to a float16 .npy file memory-mapped while it is written.
+    :param teacher: loaded teacher model taking the serving inputs.
+    :param teacher_labels: label names of the teacher's outputs.
+    :param store: SampleStore of the split.
+    :param class_names: class names of the DataLoader, in label id order.
+    :param cache_path: destination returned by get_teacher_cache_path.
+    :param batch_size: number of sentences per teacher call.
+    """
+    columns = [teacher_labels.index(name) for name in class_names]
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path[:-len('.npy')]}.tmp-{os.getpid()}.npy"
+    probs = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=(len(store), len(columns)))
+
+    for start in tqdm(range(0, len(store), batch_size), desc=f'teacher {os.path.basename(cache_path)}'):
+        end = min(start + batch_size, len(store))
+        features = make_features([store.get_sentence(i) for i in range(start, end)],
+                                 store.line_number[start:end].astype(np.int32),
+                                 store.total_lines[start:end].astype(np.int32))
+        probs[start:end] = np.asarray(teacher.predict_on_batch(list(features)))[:, columns]
+    probs.flush()
+    del probs
+    os.replace(tmp_path, cache_path)
+    print(f"saved teacher probabilities to {cache_path}")
+
+
+def get_teacher_probs(data, teacher_path, splits=("train", "val"), rebuild_cache=False):
+    """
+    Teacher probabilities of every sentence of the splits, predicted once per teacher and split
+    contents and cached next to the dataset, so distillation epochs never run the teacher.
+    :param data: DataLoader
+    :param teacher_path: directory of the saved teacher model, e.g. a tribrid model saved by train.py.
+    :param splits: splits to predict.
+    :param rebuild_cache: ignore any existing cache and run the teacher again.
+    :return: dict of split -> memory-mapped float16 array of shape (sentences, classes)
+    """
+    stores = {split: data.load_split(split) for split in splits}
+    paths = {split: get_teacher_cache_path(data.DATA_DIR, split, store, teacher_path)
+             for split, store in stores.items()}
+    missing = [split for split in splits if rebuild_cache or not os.path.exists(paths[split])]
+
+    if missing:
+        teacher, teacher_labels = load_serving_model(teacher_path), load_labels(teacher_path)
+        for split in missing:
+            predict_teacher(teacher, teacher_labels, stores[split], data.class_names, paths[split])
+    return {split: np.load(path, mmap_mode='r') for split, path in paths.items()}
+
+
+def soften(probs, temperature):
+    """
+    :param probs: array of probabilities, one row per sentence.
+    :param temperature: softmax temperature, > 1 flattens the distribution.
+    :return: float32 array of softmax(log(probs) / temperature)
+    """
+    logits = np.log(np.clip(np.asarray(probs, dtype=np.float32), 1e-7, 1.0)) / temperature
+    logits -= logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def distillation_model(student, temperature=2.0, alpha=0.1):
+    """
+    Wraps a student for training: 'hard_output' is its usual softmax, trained on the labels, and
+    'soft_output' the softmax of its logits / temperature, trained on the softened teacher
+    probabilities. The soft loss is scaled by temperature ** 2 to keep its gradients comparable.
+    :param student: model with a pre-softmax layer named 'student_logits', see student_model.
+    :param temperature: distillation temperature.
+    :param alpha: weight of the loss on the labels, 1 - alpha goes to the teacher probabilities.
+    :return: compiled two output keras model sharing the student's layers.
+    """
+    logits = student.get_layer("student_logits").output
+    hard_output = layers.Activation("softmax", dtype="float32", name="hard_output")(logits)
+    soft_logits = layers.Rescaling(1 / temperature, name="temperature")(logits)
+    soft_output = layers.Activation("softmax", dtype="float32", name="soft_output")(soft_logits)
+
+    model = tf.keras.Model(inputs=student.inputs, outputs=[hard_output, soft_output], name="distillation_model")
+    model.compile(loss={"hard_output": "categorical_crossentropy", "soft_output": "categorical_crossentropy"},
+                  loss_weights={"hard_output": alpha, "soft_output": (1 - alpha) * temperature ** 2},
+                  optimizer=tf.keras.optimizers.Adam(),
+                  metrics={"hard_output": ["accuracy"]})
+    return model
+
+
+def get_distillation_data(data, teacher_path, temperature=2.0):
+    """
+    :param data: DataLoader
+    :param teacher_path: directory of the saved teacher model.
+    :param temperature: distillation temperature the teacher probabilities are softened with.
+    :return: training dataset, validation dataset for distillation_model
+    """
+    data.load_splits(["train", "val"])
+    teacher_probs = get_teacher_probs(data, teacher_path, rebuild_cache=data.rebuild_cache)
+    return data.get_distillation_data({split: soften(probs, temperature) for split, probs in teacher_probs.items()})
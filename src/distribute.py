@@ -0,0 +1,120 @@
+import os
+import json
+import shutil
+import tempfile
+import tensorflow as tf
+
+STRATEGIES = ("single", "mirrored", "multi-worker")
+
+
+def get_task():
+    """
+    :return: (task type, task index, number of workers) from TF_CONFIG, ('worker', 0, 1) without it.
+    """
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    task = tf_config.get("task", {})
+    cluster = tf_config.get("cluster", {})
+    num_workers = len(cluster.get("chief", [])) + len(cluster.get("worker", []))
+    return task.get("type", "worker"), task.get("index", 0), max(num_workers, 1)
+
+
+def is_chief():
+    """
+    :return: True for the process that writes the model, the chief or else worker 0.
+    """
+    task_type, task_index, _ = get_task()
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    if "chief" in tf_config.get("cluster", {}):
+        return task_type == "chief"
+    return task_type == "worker" and task_index == 0
+
+
+def split_cpu(num_devices):
+    """
+    Splits the CPU into num_devices logical devices for MirroredStrategy. Must run before
+    TensorFlow initialises its runtime, i.e. before any op or dataset is created.
+    :param num_devices: number of logical CPU devices.
+    :return: names of the logical CPU devices.
+    """
+    cpus = tf.config.list_physical_devices('CPU')
+    tf.config.set_logical_device_configuration(cpus[0], [tf.config.LogicalDeviceConfiguration()] * num_devices)
+    return [device.name for device in tf.config.list_logical_devices('CPU')]
+
+
+def make_strategy(name="single", num_devices=1):
+    """
+    :param name: 'single' for the default one device strategy, 'mirrored' for synchronous data parallelism
+    over the GPUs or num_devices logical CPU devices of this machine, 'multi-worker' for synchronous
+    data parallelism over the processes listed in TF_CONFIG.
+    :param num_devices: number of logical CPU devices used by 'mirrored' when there is no GPU.
+    :return: tf.distribute.Strategy
+    """
+    if name == "single":
+        return tf.distribute.get_strategy()
+    if name == "mirrored":
+        if tf.config.list_physical_devices('GPU'):
+            return tf.distribute.MirroredStrategy()
+        # NCCL all-reduce is GPU only, reduce the gradients on one device instead
+        return tf.distribute.MirroredStrategy(devices=split_cpu(num_devices),
+                                              cross_device_ops=tf.distribute.ReductionToOneDevice())
+    if name == "multi-worker":
+        if "TF_CONFIG" not in os.environ:
+            raise ValueError("the multi-worker strategy needs TF_CONFIG to describe the cluster")
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    raise ValueError(f"strategy should be one of {STRATEGIES}, got {name}")
+
+
+def shard_dataset(dataset, policy=tf.data.experimental.AutoShardPolicy.DATA):
+    """
+    Sets how a multi-worker strategy splits a dataset between the workers. DATA suits the in memory
+    DataLoader pipelines, FILE the TFRecord shards when there are at least as many shards as workers.
+    The dataset must be batched with the global batch size, the strategy splits every batch
+    between the replicas of a worker.
+    :param dataset: tf.data.Dataset
+    :param policy: tf.data.experimental.AutoShardPolicy
+    :return: the dataset with the sharding option set.
+    """
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = policy
+    return dataset.with_options(options)
+
+
+def get_write_path(path):
+    """
+    Every worker of a multi-worker strategy has to take part in saving; only the chief writes to
+    path, the others write to a temporary directory removed with clean_write_path.
+    :param path: destination of the chief.
+    :return: directory this process should save to.
+    """
+    if is_chief():
+        return path
+    task_type, task_index, _ = get_task()
+    return tempfile.mkdtemp(prefix=f"{task_type}-{task_index}-")
+
+
+def clean_write_path(write_path, path):
+    if write_path != path:
+        shutil.rmtree(write_path, ignore_errors=True)
+
+
+def local_tf_config(num_workers, index, base_port=12345):
+    """
+    :param num_workers: number of worker processes on this machine.
+    :param index: index of the worker the config is for.
+    :param base_port: port of worker 0, the others take the next ones.
+    :return: TF_CONFIG value of a cluster of local workers.
+    """
+    workers = [f"localhost:{base_port + i}" for i in range(num_workers)]
+    return json.dumps({"cluster": {"worker": workers}, "task": {"type": "worker", "index": index}})
+
+
+def scaling_report(runs):
+    """
+    :param runs: dict of number of replicas -> examples/sec of the run, must include 1.
+    :return: dict of number of replicas -> throughput, speed up and scaling efficiency over one replica.
+    """
+    base = runs[1]
+    return {n: {"examples_per_sec": round(throughput, 1),
+                "speed_up": round(throughput / base, 3),
+                "efficiency": round(throughput / (n * base), 3)}
+            for n, throughput in sorted(runs.items())}
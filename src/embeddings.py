@@ -0,0 +1,225 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+from src.data import get_cache_root
+
+EMBEDDING_CACHE_VERSION = 1
+STAND_IN_EMBEDDING_DIM = 512
+# tables up to this size are gathered from host memory, larger ones are read from the memory-mapped file
+MAX_IN_MEMORY_EMBEDDING_BYTES = 4 << 30
+EMBEDDING_CHECK_SAMPLES = 32
+EMBEDDING_CHECK_TOLERANCE = 1e-2  # float16 caches round to about 1e-3
+
+
+class HashingSentenceEncoder(tf.keras.layers.Layer):
+    """
+    Deterministic, offline stand-in for the Universal Sentence Encoder.
+
+    Every word is hashed into a fixed, seeded random table and a sentence is the normalised
+    mean of its word vectors, so equal sentences always get equal vectors of the same size
+    as the hub module's. Only meant for tests and benchmarks.
+    """
+
+    def __init__(self, output_dim=STAND_IN_EMBEDDING_DIM, num_buckets=4096, seed=42, **kwargs):
+        kwargs.setdefault("name", "hashing_sentence_encoder")
+        super().__init__(trainable=False, **kwargs)
+        self.output_dim = output_dim
+        self.num_buckets = num_buckets
+        self.seed = seed
+        table = np.random.default_rng(seed).standard_normal((num_buckets, output_dim)).astype(np.float32)
+        self.table = tf.constant(table)
+
+    def call(self, inputs):
+        words = tf.strings.split(tf.reshape(inputs, [-1]))
+        buckets = tf.strings.to_hash_bucket_fast(words, self.num_buckets)
+        vectors = tf.reduce_mean(tf.ragged.map_flat_values(tf.gather, self.table, buckets), axis=1)
+        vectors = tf.where(tf.math.is_nan(vectors), tf.zeros_like(vectors), vectors)  # empty sentences
+        return tf.math.l2_normalize(vectors, axis=-1)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"output_dim": self.output_dim, "num_buckets": self.num_buckets, "seed": self.seed})
+        return config
+
+
+class CachedEmbeddings:
+    """
+    Sentence embeddings of one split. vectors holds one row per distinct sentence and rows maps
+    every sentence of the split to its row, both memory-mapped from the embedding cache.
+
+    Tables up to max_in_memory_bytes are copied into a host tf.Variable and gathered with tf.gather,
+    which runs in parallel map calls without the GIL and without embedding the table in the graph.
+    Larger tables, e.g. the train split of PubMed 200k with a big encoder, would not fit in memory
+    next to the training process, so their rows are read from the memory-mapped file with a
+    tf.numpy_function: slower, GIL bound and not serializable, but paged in from disk on demand.
+    """
+
+    def __init__(self, vectors, rows, max_in_memory_bytes=MAX_IN_MEMORY_EMBEDDING_BYTES):
+        self.vectors = vectors
+        self.rows = rows
+        self.table = None
+        if vectors.nbytes <= max_in_memory_bytes:
+            with tf.device("/cpu:0"):
+                self.table = tf.Variable(np.asarray(vectors), trainable=False, name="sentence_embeddings")
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def lookup(self, rows):
+        """
+        Gathers embedding rows inside a tf.data map.
+        :param rows: int tensor of row indices.
+        :return: float32 tensor of shape rows.shape + (dim,)
+        """
+        if self.table is not None:
+            return tf.cast(tf.gather(self.table, rows), tf.float32)
+        vectors = tf.numpy_function(lambda r: np.asarray(self.vectors[r], dtype=np.float32), [rows], tf.float32)
+        vectors.set_shape(rows.shape.concatenate([self.dim]))
+        return vectors
+
+
+def sentence_hashes(store):
+    """
+    :param store: SampleStore of a split.
+    :return: array of 16 byte digests, one per sentence.
+    """
+    buffer = store.text.tobytes()
+    offsets = store.offsets
+    return np.array([hashlib.blake2b(buffer[offsets[i]:offsets[i + 1]], digest_size=16).digest()
+                     for i in range(len(store))], dtype='S16')
+
+
+def get_embedding_cache_dir(data_dir, split, store, encoder_name):
+    """
+    :param data_dir: directory containing the split files.
+    :param split: one of 'train', 'val' or 'test'.
+    :param store: SampleStore of the split.
+    :param encoder_name: name identifying the sentence encoder, e.g. its hub url.
+    :return: directory of the embedding cache of the split for that encoder.
+    """
+    encoder_key = re.sub(r'[^A-Za-z0-9_.-]+', '_', encoder_name).strip('_')
+    return os.path.join(get_cache_root(data_dir), f"embeddings-{encoder_key}", f"{split}-{store.fingerprint[:16]}")
+
+
+def build_embedding_cache(store, encoder, cache_dir, dtype=np.float16, batch_size=1024):
+    """
+    Encodes every distinct sentence of a split once and writes the vectors, their sentence
+    hashes and the sentence -> row mapping to cache_dir. The vectors are written straight to a
+    memory-mapped file, so the split is never held in memory as floats. Caches of the same
+    split for other file contents are removed.
+    :param store: SampleStore of the split.
+    :param encoder: callable mapping a string tensor of shape (n,) to a (n, dim) tensor.
+    :param cache_dir: destination directory returned by get_embedding_cache_dir.
+    :param dtype: np.float16 or np.float32.
+    :param batch_size: number of sentences encoded per call.
+    """
+    hashes = sentence_hashes(store)
+    unique_hashes, first_index, rows = np.unique(hashes, return_index=True, return_inverse=True)
+
+    tmp_dir = f"{cache_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    vectors = None
+    for start in tqdm(range(0, len(unique_hashes), batch_size), desc=f'encoding {os.path.basename(cache_dir)}'):
+        indices = first_index[start:start + batch_size]
+        batch = np.asarray(encoder(tf.constant([store.get_sentence(i) for i in indices])))
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(os.path.join(tmp_dir, "vectors.npy"), mode='w+', dtype=dtype,
+                                                shape=(len(unique_hashes), batch.shape[1]))
+        vectors[start:start + len(indices)] = batch
+    if vectors is None:  # no sentence to encode, the encoder still gives the size of the vectors
+        dim = np.asarray(encoder(tf.constant([""]))).shape[1]
+        vectors = np.zeros((0, dim), dtype=dtype)
+        np.save(os.path.join(tmp_dir, "vectors.npy"), vectors)
+    else:
+        vectors.flush()
+
+    np.save(os.path.join(tmp_dir, "hashes.npy"), unique_hashes)
+    np.save(os.path.join(tmp_dir, "rows.npy"), rows.astype(np.int32))
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({"version": EMBEDDING_CACHE_VERSION, "dtype": np.dtype(dtype).name, "dim": int(vectors.shape[1]),
+                   "sentences": len(store), "unique_sentences": len(unique_hashes)}, f)
+
+    split = os.path.basename(cache_dir).split('-')[0]
+    parent = os.path.dirname(cache_dir)
+    for name in os.listdir(parent):
+        if name.startswith(f"{split}-") and not name.endswith(f".tmp-{os.getpid()}"):
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+    os.rename(tmp_dir, cache_dir)
+    print(f"saved sentence embeddings to {cache_dir}")
+
+
+def load_embedding_cache(cache_dir, dtype=np.float16):
+    """
+    :param cache_dir: cache directory written by build_embedding_cache.
+    :param dtype: expected dtype of the vectors.
+    :return: CachedEmbeddings, or None if the cache is missing or stale.
+    """
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    if meta.get("version") != EMBEDDING_CACHE_VERSION or meta.get("dtype") != np.dtype(dtype).name:
+        return None
+
+    return CachedEmbeddings(vectors=np.load(os.path.join(cache_dir, "vectors.npy"), mmap_mode='r'),
+                            rows=np.load(os.path.join(cache_dir, "rows.npy"), mmap_mode='r'))
+
+
+def check_embedding_cache(embeddings, store, encoder, num_samples=EMBEDDING_CHECK_SAMPLES, seed=42):
+    """
+    Compares the cached vectors of randomly sampled sentences with those of the live encoder, to catch
+    a cache written by another encoder under the same name.
+    :param embeddings: CachedEmbeddings of the split.
+    :param store: SampleStore of the split.
+    :param encoder: callable mapping a string tensor of shape (n,) to a (n, dim) tensor.
+    :param num_samples: number of sentences compared.
+    :param seed: seed of the sample.
+    :return: largest absolute difference found, 0.0 for an empty split, inf if the shapes differ.
+    """
+    if len(store) == 0:
+        return 0.0
+    indices = np.sort(np.random.default_rng(seed).choice(len(store), size=min(num_samples, len(store)),
+                                                         replace=False))
+    live = np.asarray(encoder(tf.constant([store.get_sentence(i) for i in indices])), dtype=np.float32)
+    cached = np.asarray(embeddings.vectors[np.asarray(embeddings.rows)[indices]], dtype=np.float32)
+    if live.shape != cached.shape:
+        return float('inf')
+    return float(np.abs(live - cached).max())
+
+
+def get_cached_embeddings(data, split, encoder, encoder_name, dtype=np.float16, rebuild_cache=False):
+    """
+    Returns the sentence embeddings of a split, encoding it only if no valid cache exists.
+    :param data: DataLoader
+    :param split: one of 'train', 'val' or 'test'.
+    :param encoder: callable mapping a string tensor to sentence embeddings, e.g. the hub layer.
+    :param encoder_name: name identifying the encoder in the cache path.
+    :param dtype: np.float16 or np.float32.
+    :param rebuild_cache: ignore any existing cache and re-encode the split.
+    :return: CachedEmbeddings
+    """
+    store = data.load_split(split)
+    cache_dir = get_embedding_cache_dir(data.DATA_DIR, split, store, encoder_name)
+
+    if not rebuild_cache:
+        embeddings = load_embedding_cache(cache_dir, dtype)
+        if embeddings is not None:
+            difference = check_embedding_cache(embeddings, store, encoder)
+            if difference <= EMBEDDING_CHECK_TOLERANCE:
+                print(f"loading sentence embeddings from {cache_dir}")
+                return embeddings
+            print(f"cached sentence embeddings in {cache_dir} differ from the encoder by up to {difference}, "
+                  f"re-encoding the split")
+
+    build_embedding_cache(store, encoder, cache_dir, dtype=dtype)
+    return load_embedding_cache(cache_dir, dtype)
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from collections import OrderedDict
+from src.data import split_chars_tensor, LINE_NUMBER_DEPTH, TOTAL_LINES_DEPTH
+from src.registry import REGISTRY_DIR, read_index, resolve_model, get_active_version, get_latest_version
+from src.inference import load_serving_model, load_labels
+from src.batch_inference import iter_jsonl
+
+EVALUATION_BATCH_SIZE = 1024
+
+
+def read_jsonl_split(filename, batch_size, class_names):
+    """
+    Streams a JSONL file of labelled sentences into batches of serving inputs. Every line holds one sentence
+    as written by iter_samples: {"text": ..., "target": <label name>, "line_number": ..., "total_lines": ...}.
+    Lines are parsed in a generator, sentences are character-split and batched in the prefetched pipeline.
+    :param filename: path to the JSONL file.
+    :param batch_size: batch size.
+    :param class_names: class names indexed by label id.
+    :return: dataset of (inputs, one hot labels, line numbers)
+    """
+    class_ids = {name: i for i, name in enumerate(class_names)}
+
+    def samples():
+        for _, line in iter_jsonl(filename):
+            sample = json.loads(line)
+            if sample["target"] not in class_ids:
+                raise ValueError(f"found label not present in the model labels: {sample['target']}")
+            yield sample["text"], class_ids[sample["target"]], sample["line_number"], sample["total_lines"]
+
+    def to_inputs(text, label, line_number, total_lines):
+        inputs = (tf.one_hot(line_number, depth=LINE_NUMBER_DEPTH),
+                  tf.one_hot(total_lines, depth=TOTAL_LINES_DEPTH),
+                  text,
+                  split_chars_tensor(text))
+        return inputs, tf.one_hot(label, depth=len(class_names)), line_number
+
+    dataset = tf.data.Dataset.from_generator(samples, output_signature=(tf.TensorSpec([], tf.string),
+                                                                        tf.TensorSpec([], tf.int64),
+                                                                        tf.TensorSpec([], tf.int64),
+                                                                        tf.TensorSpec([], tf.int64)))
+    dataset = dataset.batch(batch_size).map(to_inputs, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def resolve_model_spec(spec, registry_dir=REGISTRY_DIR):
+    """
+    :param spec: version name in the registry, 'active' or 'latest', or the path of a model or registry.
+    :param registry_dir: registry the version names refer to.
+    :return: (name of the model in the report, path to load it from)
+    """
+    if os.path.exists(spec):
+        path, version = resolve_model(spec)
+        return version or os.path.normpath(spec), path
+    if spec == "active":
+        version, manifest = get_active_version(registry_dir)
+    elif spec == "latest":
+        version, manifest = get_latest_version(registry_dir)
+    else:
+        versions = read_index(registry_dir)["versions"]
+        if spec not in versions:
+            raise KeyError(f"{spec} is neither a model path nor a version of {registry_dir}, "
+                           f"known versions: {sorted(versions)}")
+        version, manifest = spec, versions[spec]
+    return version, os.path.normpath(os.path.join(registry_dir, manifest["path"]))
+
+
+def load_models(specs, registry_dir=REGISTRY_DIR):
+    """
+    :param specs: list of model specs, see resolve_model_spec.
+    :return: OrderedDict of name -> dict with the loaded model, its labels, path and load time.
+    """
+    models = OrderedDict()
+    for spec in specs:
+        name, path = resolve_model_spec(spec, registry_dir)
+        start = time.perf_counter()
+        model = load_serving_model(path)
+        models[name] = {"model": model, "labels": load_labels(path), "path": path,
+                        "load_seconds": round(time.perf_counter() - start, 3)}
+        print(f"loaded {name} from {path} in {models[name]['load_seconds']} secs")
+    return models
+
+
+class StreamingEvaluation:
+    """
+    Metrics of one model accumulated batch by batch: the confusion matrix, the correct and total
+    counts per line number and the prediction time of every batch. Predictions are dropped once
+    counted, so memory does not grow with the number of sentences evaluated.
+    """
+
+    def __init__(self, class_names):
+        self.class_names = list(class_names)
+        self.confusion = np.zeros((len(class_names), len(class_names)), dtype=np.int64)
+        self.position_total = np.zeros(0, dtype=np.int64)
+        self.position_correct = np.zeros(0, dtype=np.int64)
+        self.batch_seconds = []
+        self.batch_seconds_total = 0.0
+        self.sentences = 0
+        self.agreements = 0
+        self.compared = 0
+
+    def update(self, labels, preds, line_numbers, seconds, reference_preds=None):
+        """
+        :param labels: true class ids of a batch.
+        :param preds: predicted class ids.
+        :param line_numbers: line number of every sentence.
+        :param seconds: time the model took to predict the batch.
+        :param reference_preds: class ids predicted by the reference model, to count the agreement with it.
+        """
+        num_classes = len(self.class_names)
+        self.confusion += np.bincount(labels * num_classes + preds,
+                                      minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+        size = max(len(self.position_total), int(line_numbers.max()) + 1)
+        self.position_total = np.pad(self.position_total, (0, size - len(self.position_total)))
+        self.position_correct = np.pad(self.position_correct, (0, size - len(self.position_correct)))
+        self.position_total += np.bincount(line_numbers, minlength=size)
+        self.position_correct += np.bincount(line_numbers[labels == preds], minlength=size)
+        self.batch_seconds.append(seconds)
+        self.batch_seconds_total += seconds
+        self.sentences += len(labels)
+        if reference_preds is not None:
+            self.agreements += int((preds == reference_preds).sum())
+            self.compared += len(preds)
+
+    def report(self):
+        """
+        :return: dict of accuracy, macro and weighted F1, per class precision/recall/F1, per position accuracy,
+        confusion matrix (rows are true classes), throughput and batch latency percentiles.
+        """
+        true_positives = np.diag(self.confusion).astype(np.float64)
+        predicted = self.confusion.sum(axis=0)
+        support = self.confusion.sum(axis=1)
+        precision = np.divide(true_positives, predicted, out=np.zeros_like(true_positives), where=predicted > 0)
+        recall = np.divide(true_positives, support, out=np.zeros_like(true_positives), where=support > 0)
+        f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(true_positives),
+                       where=precision + recall > 0)
+        total = max(int(support.sum()), 1)
+        batch_ms = np.array(self.batch_seconds or [0.0]) * 1000
+        predict_seconds = self.batch_seconds_total
+
+        report = {"sentences": self.sentences,
+                  "accuracy": round(float(true_positives.sum() / total), 4),
+                  "macro_f1": round(float(f1.mean()), 4),
+                  "weighted_f1": round(float((f1 * support).sum() / total), 4),
+                  "per_class": {name: {"precision": round(float(precision[i]), 4),
+                                       "recall": round(float(recall[i]), 4),
+                                       "f1": round(float(f1[i]), 4),
+                                       "support": int(support[i])}
+                                for i, name in enumerate(self.class_names)},
+                  "per_position": [{"line_number": line_number,
+                                    "accuracy": round(float(self.position_correct[line_number] / count), 4),
+                                    "sentences": int(count)}
+                                   for line_number, count in enumerate(self.position_total) if count],
+                  "confusion_matrix": {"labels": self.class_names, "matrix": self.confusion.tolist()},
+                  "predict_seconds": round(predict_seconds, 3),
+                  "sentences_per_sec": round(self.sentences / predict_seconds, 1) if predict_seconds else None,
+                  "batch_latency_ms": {"p50": round(float(np.percentile(batch_ms, 50)), 3),
+                                       "p90": round(float(np.percentile(batch_ms, 90)), 3),
+                                       "p99": round(float(np.percentile(batch_ms, 99)), 3),
+                                       "max": round(float(batch_ms.max()), 3)},
+                  "ms_per_sentence": round(1000 * predict_seconds / self.sentences, 4) if self.sentences else None}
+        if self.compared:
+            report["agreement_with_reference"] = round(self.agreements / self.compared, 4)
+        return report
+
+
+def evaluate_models(models, dataset, class_names, max_batches=None):
+    """
+    Runs every model over the same batches, so the data is read and preprocessed once however many
+    models are compared. Each model predicts the first batch once untimed, to trace it.
+    :param models: OrderedDict of name -> dict with 'model' and 'labels', see load_models. The first one is
+    the reference the agreement of the others is measured against.
+    :param dataset: batches of (inputs, one hot labels, line numbers).
+    :param class_names: class names of the dataset labels, in label id order.
+    :param max_batches: number of batches evaluated, None for the whole dataset.
+    :return: dict with the wall time, the time spent outside the predictions, mostly waiting for the input
+    pipeline, and a report per model.
+    """
+    columns = {}
+    for name, entry in models.items():
+        missing = [label for label in class_names if label not in entry["labels"]]
+        if missing:
+            raise ValueError(f"{name} does not predict the dataset classes {missing}")
+        columns[name] = [entry["labels"].index(label) for label in class_names]
+    evaluations = {name: StreamingEvaluation(class_names) for name in models}
+
+    start, warm_up_seconds = time.perf_counter(), 0.0
+    for step, (inputs, labels, line_numbers) in enumerate(dataset):
+        if max_batches is not None and step >= max_batches:
+            break
+        inputs = [np.asarray(value) for value in inputs]
+        labels = np.asarray(labels).argmax(axis=1)
+        line_numbers = np.asarray(line_numbers).astype(np.int64)
+        reference_preds = None
+        for name, entry in models.items():
+            if step == 0:
+                warm_up_start = time.perf_counter()
+                entry["model"].predict_on_batch(inputs)
+                warm_up_seconds += time.perf_counter() - warm_up_start
+            batch_start = time.perf_counter()
+            probs = np.asarray(entry["model"].predict_on_batch(inputs))
+            seconds = time.perf_counter() - batch_start
+            preds = probs[:, columns[name]].argmax(axis=1)
+            evaluations[name].update(labels, preds, line_numbers, seconds, reference_preds)
+            if reference_preds is None:
+                reference_preds = preds
+        if (step + 1) % 50 == 0:
+            print(f"{evaluations[next(iter(models))].sentences} sentences evaluated")
+    wall_seconds = time.perf_counter() - start
+
+    reports = OrderedDict((name, {"path": entry["path"], "load_seconds": entry["load_seconds"],
+                                  **evaluations[name].report()}) for name, entry in models.items())
+    predict_seconds = sum(evaluation.batch_seconds_total for evaluation in evaluations.values()) + warm_up_seconds
+    return {"wall_seconds": round(wall_seconds, 3),
+            "warm_up_seconds": round(warm_up_seconds, 3),
+            "input_wait_seconds": round(max(wall_seconds - predict_seconds, 0.0), 3),
+            "models": reports}
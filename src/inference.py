@@ -0,0 +1,421 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+import numpy as np
+import tensorflow as tf
+from collections import OrderedDict, deque, namedtuple
+from tensorflow.keras.models import load_model
+from src.parsing import split_chars, make_sentencizer
+from src.data import LABELS_PATH, LINE_NUMBER_DEPTH, TOTAL_LINES_DEPTH
+from src.registry import resolve_model, is_registry, REGISTRY_DIR
+
+SERVING_MODEL_PATH = 'deploy_models/model'
+# seconds between checks of the registry, or model directory, for a newly deployed model in the servers
+HOT_SWAP_INTERVAL = 30
+DEFAULT_LABELS = ['BACKGROUND', 'CONCLUSIONS', 'METHODS', 'OBJECTIVE', 'RESULTS']
+PREDICTION_CACHE_SIZE = 100000
+LATENCY_WINDOW = 1000  # latest abstracts whose latency InferenceSession.latency_report summarizes
+WARM_UP_ABSTRACT = ("This study evaluates a new treatment. Patients were randomized to two groups. "
+                    "The treatment group improved significantly. The treatment is effective.")
+
+
+def load_labels(model_path=SERVING_MODEL_PATH):
+    """
+    Label names of a model, read from the labels.json saved next to it, or the repo's labels.json.
+    :param model_path: directory of the saved model, a .tflite file, or a model registry.
+    :return: list of label names indexed by class id.
+    """
+    model_path, _ = resolve_model(model_path)
+    model_dir = os.path.dirname(model_path) if os.path.isfile(model_path) else model_path
+    for path in (os.path.join(model_dir, 'labels.json'), LABELS_PATH):
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                class_labels = json.load(f)
+            return [class_labels[str(i)] for i in range(len(class_labels))]
+    return list(DEFAULT_LABELS)
+
+
+def model_version(model_path=SERVING_MODEL_PATH):
+    """
+    Cheap fingerprint of a saved model directory, from the names, sizes and modification times of
+    its files, so replacing the deployed model changes it without hashing the weights.
+    :param model_path: directory of the saved model, or a .tflite file.
+    :return: 12 character hex string.
+    """
+    digest = hashlib.sha1()
+    if os.path.isfile(model_path):
+        stat = os.stat(model_path)
+        digest.update(f"{os.path.basename(model_path)}:{stat.st_size}:{stat.st_mtime_ns};".encode('utf-8'))
+    for root, dirs, files in os.walk(model_path):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            digest.update(f"{os.path.relpath(path, model_path)}:{stat.st_size}:{stat.st_mtime_ns};".encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+def default_serving_path():
+    """
+    :return: the model registry train.py registers its models in if there is one, SERVING_MODEL_PATH otherwise.
+    """
+    return REGISTRY_DIR if is_registry(REGISTRY_DIR) else SERVING_MODEL_PATH
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache of sentence predictions with an optional time to live. Keys are
+    (sentence, line_number, total_lines, model version), the only inputs of a prediction.
+    Safe to share between threads.
+    """
+
+    # rough size of the dict slot, key tuple and entry tuple of one sentence, on top of the text and probabilities
+    ENTRY_OVERHEAD_BYTES = 250
+
+    def __init__(self, max_entries=PREDICTION_CACHE_SIZE, ttl=None, clock=time.monotonic):
+        """
+        :param max_entries: number of sentences kept, the least recently used are evicted first.
+        :param ttl: seconds an entry stays valid, None to keep entries until evicted.
+        :param clock: time source, in seconds.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (expiry time, probabilities)
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def entry_size(key, probs):
+        return sys.getsizeof(key[0]) + probs.nbytes + PredictionCache.ENTRY_OVERHEAD_BYTES
+
+    def get(self, key):
+        """
+        :return: cached probabilities of key, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= self.clock():
+                del self.entries[key]
+                self.nbytes -= self.entry_size(key, entry[1])
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, probs):
+        """
+        :param key: (sentence, line_number, total_lines, model version)
+        :param probs: probabilities of the sentence, copied so the batch they come from can be freed.
+        """
+        probs = np.array(probs, dtype=np.float32)
+        expiry = self.clock() + self.ttl if self.ttl else None
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= self.entry_size(key, previous[1])
+            self.entries[key] = (expiry, probs)
+            self.nbytes += self.entry_size(key, probs)
+            while len(self.entries) > self.max_entries:
+                old_key, (_, old_probs) = self.entries.popitem(last=False)
+                self.nbytes -= self.entry_size(old_key, old_probs)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """
+        :return: dict of the cache counters.
+        """
+        return {"entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hit_rate, 4),
+                "evictions": self.evictions,
+                "expirations": self.expirations}
+
+
+def load_serving_model(model_path=SERVING_MODEL_PATH):
+    """
+    :param model_path: directory of a saved keras model, a .tflite file written by export_tflite.py,
+    which is run with the TFLite interpreter, a cascade directory written by cascade.py, or a model
+    registry, whose active version is loaded.
+    :return: model with the keras predict API.
+    """
+    model_path, _ = resolve_model(model_path)
+    if model_path.endswith('.tflite'):
+        from src.tflite import TFLiteModel  # src.tflite imports this module
+        return TFLiteModel(model_path)
+    if os.path.exists(os.path.join(model_path, 'cascade.json')):
+        from src.cascade import load_cascade  # src.cascade imports this module
+        return load_cascade(model_path)
+    return load_model(model_path)
+
+
+def make_abstract_features(abstract_lines):
+    """
+    Builds the tribrid model inputs of the sentences of one abstract.
+    :param abstract_lines: list of sentences of the abstract, in order.
+    :return: (line number one hot, total lines one hot, sentences, character-spaced sentences)
+    """
+    # Get total number of lines
+    total_lines_in_sample = len(abstract_lines)
+    line_numbers = list(range(total_lines_in_sample))
+    total_lines = [total_lines_in_sample - 1] * total_lines_in_sample
+    return make_features(abstract_lines, line_numbers, total_lines)
+
+
+def make_features(sentences, line_numbers, total_lines, chars=None):
+    """
+    Builds the tribrid model inputs of sentences with known positions, possibly from several abstracts.
+    :param sentences: list of sentences.
+    :param line_numbers: position of each sentence in its abstract.
+    :param total_lines: number of lines - 1 of the abstract of each sentence.
+    :param chars: character-spaced sentences, if already computed.
+    :return: (line number one hot, total lines one hot, sentences, character-spaced sentences)
+    """
+    # One-hot encode to same depth as training data, so model accepts right input shape
+    line_numbers_one_hot = tf.one_hot(line_numbers, depth=LINE_NUMBER_DEPTH)
+    total_lines_one_hot = tf.one_hot(total_lines, depth=TOTAL_LINES_DEPTH)
+    if chars is None:
+        chars = [split_chars(sentence) for sentence in sentences]
+    return line_numbers_one_hot, total_lines_one_hot, tf.constant(sentences), tf.constant(chars)
+
+
+class ServingModel(namedtuple("ServingModel", ["model", "labels", "version", "path"])):
+    """
+    A loaded model with the labels and version it was loaded with, swapped as one reference.
+    """
+
+
+class InferenceSession:
+    """
+    Holds a loaded serving model and sentencizer for the lifetime of the process, so requests
+    only pay for the prediction itself.
+
+    When model_path is a model registry, the active version is served. With a version_check_interval,
+    a newly activated version, or a changed model directory, is loaded and warmed up in a background
+    thread and then swapped in: requests keep being served by the previous model until the swap, and
+    requests already running finish on the model they started with.
+    """
+
+    def __init__(self, model_path=SERVING_MODEL_PATH, warm_up=True, cache_size=0, cache_ttl=None,
+                 version_check_interval=None):
+        """
+        :param model_path: model registry directory, directory of a saved tribrid model, or a .tflite export of it.
+        :param warm_up: run one prediction right away, so the first request does not pay for tracing.
+        :param cache_size: number of sentence predictions to cache, 0 to disable the cache.
+        :param cache_ttl: seconds a cached prediction stays valid, None for no expiry.
+        :param version_check_interval: seconds between checks for a newly deployed model, None to never swap.
+        """
+        start = time.time()
+        print("loading model...")
+        self.model_path = model_path
+        self.sentencizer = make_sentencizer()
+        self.warm_up_sentences = self.split_sentences(WARM_UP_ABSTRACT)
+        self.serving = self.load_version(*self.resolve_version())
+        self.load_seconds = time.time() - start
+        print(f"model {self.model_version} loaded in {self.load_seconds:.2f} secs")
+
+        self.cache = PredictionCache(max_entries=cache_size, ttl=cache_ttl) if cache_size else None
+        self.version_check_interval = version_check_interval
+        self.last_version_check = time.monotonic()
+        self.reload_lock = threading.Lock()
+        self.reloading = False
+        self.swaps = 0
+
+        self.abstract_seconds = deque(maxlen=LATENCY_WINDOW)
+        self.first_abstract_seconds = None
+        self.warm_up_seconds = None
+        if warm_up:
+            self.warm_up_seconds = self.warm_up(self.serving)
+            print(f"model warmed up in {self.warm_up_seconds:.2f} secs")
+
+    @property
+    def model(self):
+        return self.serving.model
+
+    @property
+    def labels(self):
+        return self.serving.labels
+
+    @property
+    def model_version(self):
+        return self.serving.version
+
+    def resolve_version(self):
+        """
+        :return: (path of the model to serve, its version), the registry's active version or the
+        fingerprint of the model files.
+        """
+        path, version = resolve_model(self.model_path)
+        return path, version or model_version(path)
+
+    def load_version(self, path, version):
+        """
+        :return: ServingModel of the model at path.
+        """
+        return ServingModel(load_serving_model(path), load_labels(path), version, path)
+
+    def warm_up(self, serving):
+        """
+        Traces the prediction of a model before it serves requests.
+        :return: seconds it took.
+        """
+        start = time.time()
+        line_numbers = list(range(len(self.warm_up_sentences)))
+        total_lines = [len(self.warm_up_sentences) - 1] * len(self.warm_up_sentences)
+        serving.model.predict(make_features(self.warm_up_sentences, line_numbers, total_lines),
+                              batch_size=len(self.warm_up_sentences))
+        return time.time() - start
+
+    def split_sentences(self, text):
+        """
+        :param text: raw abstract.
+        :return: list of its sentences.
+        """
+        return [str(sentence) for sentence in self.sentencizer(text).sents]
+
+    def check_model_version(self):
+        """
+        At most once every version_check_interval seconds, starts a background check for a newly
+        deployed model, see reload. Never blocks the caller.
+        """
+        if not self.version_check_interval or time.monotonic() - self.last_version_check < self.version_check_interval:
+            return
+        with self.reload_lock:
+            if self.reloading:
+                return
+            self.last_version_check = time.monotonic()
+            self.reloading = True
+        threading.Thread(target=self.reload, name="model-reload", daemon=True).start()
+
+    def reload(self):
+        """
+        Loads and warms up the deployed model if it changed since the current one was loaded, then
+        swaps it in. The current model keeps serving if the new one fails to load.
+        """
+        try:
+            path, version = self.resolve_version()
+            if version == self.serving.version:
+                return
+            print(f"deployed model changed from {self.serving.version} to {version}, loading it")
+            serving = self.load_version(path, version)
+            warm_up_seconds = self.warm_up(serving)
+            self.serving = serving  # one reference assignment, requests see either model in full
+            self.swaps += 1
+            if self.cache is not None:
+                self.cache.clear()  # keyed on the version, the previous model's entries would never be hit again
+            print(f"now serving {version}, warmed up in {warm_up_seconds:.2f} secs")
+        except Exception as e:
+            print(f"could not load the deployed model, still serving {self.serving.version}: {e}")
+        finally:
+            self.reloading = False
+
+    def predict_features(self, features, batch_size=None, serving=None):
+        """
+        :param features: model inputs as returned by make_features.
+        :param serving: ServingModel to predict with, the current one by default.
+        :return: array of class probabilities, one row per sentence.
+        """
+        return (serving or self.serving).model.predict(x=features, batch_size=batch_size)
+
+    def predict_sentences(self, sentences, line_numbers, total_lines, serving=None):
+        """
+        Predicts sentences with known positions. With the prediction cache enabled, only the
+        sentences not already cached for the current model go through the model.
+        :param sentences: list of sentences.
+        :param line_numbers: position of each sentence in its abstract.
+        :param total_lines: number of lines - 1 of the abstract of each sentence.
+        :param serving: ServingModel to predict with, the current one by default.
+        :return: array of class probabilities, one row per sentence.
+        """
+        self.check_model_version()
+        serving = serving or self.serving  # the whole request uses one model, even if a swap happens meanwhile
+        if self.cache is None:
+            return self.predict_features(make_features(sentences, line_numbers, total_lines),
+                                         batch_size=len(sentences), serving=serving)
+
+        keys = [(sentence, line_number, total, serving.version)
+                for sentence, line_number, total in zip(sentences, line_numbers, total_lines)]
+        pred_probs = [self.cache.get(key) for key in keys]
+        misses = [i for i, probs in enumerate(pred_probs) if probs is None]
+        # a sentence missed several times in one batch, e.g. an abstract sent by concurrent requests, is predicted once
+        missed_keys = list(dict.fromkeys(keys[i] for i in misses))
+
+        if missed_keys:
+            miss_probs = self.predict_features(make_features([key[0] for key in missed_keys],
+                                                             [key[1] for key in missed_keys],
+                                                             [key[2] for key in missed_keys]),
+                                               batch_size=len(missed_keys), serving=serving)
+            predicted = dict(zip(missed_keys, miss_probs))
+            for key, probs in predicted.items():
+                self.cache.put(key, probs)
+            for i in misses:
+                pred_probs[i] = predicted[keys[i]]
+        return np.stack(pred_probs)
+
+    def predict_abstract(self, text):
+        """
+        Classifies every sentence of an abstract.
+        :param text: raw abstract.
+        :return: list of (sentence, label) tuples, in abstract order.
+        """
+        start = time.perf_counter()
+        abstract_lines = self.split_sentences(text)
+        if not abstract_lines:
+            return []
+        serving = self.serving
+        total_lines = len(abstract_lines) - 1
+        pred_probs = self.predict_sentences(abstract_lines, list(range(len(abstract_lines))),
+                                            [total_lines] * len(abstract_lines), serving=serving)
+        preds = tf.argmax(pred_probs, axis=1).numpy()
+        labelled = [(line, serving.labels[i]) for line, i in zip(abstract_lines, preds)]
+
+        seconds = time.perf_counter() - start
+        if self.first_abstract_seconds is None:
+            self.first_abstract_seconds = seconds
+        self.abstract_seconds.append(seconds)
+        return labelled
+
+    def latency_report(self):
+        """
+        :return: dict with the cold start costs, i.e. the model load and warm-up seconds and the latency of the
+        first abstract, and the p50/p90/p99 latency in ms of the last LATENCY_WINDOW abstracts.
+        """
+        report = {"load_seconds": round(self.load_seconds, 3),
+                  "warm_up_seconds": round(self.warm_up_seconds, 3) if self.warm_up_seconds is not None else None,
+                  "first_abstract_ms": None,
+                  "abstracts": 0}
+        abstract_ms = np.array(list(self.abstract_seconds)) * 1000
+        if len(abstract_ms):
+            report.update({"first_abstract_ms": round(1000 * self.first_abstract_seconds, 3),
+                           "abstracts": len(abstract_ms),
+                           "abstract_ms_p50": round(float(np.percentile(abstract_ms, 50)), 3),
+                           "abstract_ms_p90": round(float(np.percentile(abstract_ms, 90)), 3),
+                           "abstract_ms_p99": round(float(np.percentile(abstract_ms, 99)), 3)})
+        return report
@@ -1,31 +1,29 @@
 import os
+import json
+import numpy as np
 import tensorflow as tf
 import tensorflow_hub as hub
 from tensorflow.keras import layers
-from src.data import DataLoader
+from src.data import DataLoader, split_chars, split_chars_tensor, make_char_table
+from src.embeddings import get_cached_embeddings
+from src import tfrecords
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
-data = DataLoader(batch_size=128)
 EMBEDDING_LAYER_URL = "https://tfhub.dev/google/universal-sentence-encoder/4"
 OUTPUT_DIM = 128
 CHAR_OUTPUT_DIM = 25
-
-tf_hub_embedding_layer = hub.KerasLayer(EMBEDDING_LAYER_URL,
-                                        trainable=False,
-                                        name="universal_sentence_encoder")
-
-char_vectorizer = tf.keras.layers.TextVectorization(max_tokens=data.NUM_CHAR_TOKENS,
-                                                    output_sequence_length=data.output_sequences_char_length,
-                                                    standardize="lower_and_strip_punctuation",
-                                                    name="char_vectorizer")
-
-char_vectorizer.adapt(data.train_chars)
-
-char_embed = layers.Embedding(input_dim=data.NUM_CHAR_TOKENS,
-                              output_dim=CHAR_OUTPUT_DIM,
-                              mask_zero=False,
-                              name='char_embed')
+BATCH_SIZE = 128
+SENTENCE_EMBEDDING_DIM = 512
+# Models trained on cached sentence embeddings name their embedding input '<raw input name>' + this suffix.
+CACHED_EMBEDDING_SUFFIX = "_embedding"
+# Models taking precomputed char ids name their char input '<raw input name>' + this suffix.
+CHAR_IDS_SUFFIX = "_ids"
+CHAR_VOCAB_PATH = "char_vocab.json"
+STUDENT_HASH_BUCKETS = 2 ** 18
+# Dense layers stacked on each positional input of tribrid_model, in order, reused by the cascade's first stage.
+POSITIONAL_TOWER_LAYERS = {"line_number_input": ("line_number_dense_1", "line_number_dense_2"),
+                           "total_lines_input": ("total_lines_dense_1", "total_lines_dense_2")}
 
 # text_vectorizer = tf.keras.layers.TextVectorization(max_tokens=data.MAX_TOKENS,
 #                                                     output_sequence_length=data.output_sequences_len)
@@ -39,42 +37,382 @@ char_embed = layers.Embedding(input_dim=data.NUM_CHAR_TOKENS,
 
 NUM_CLASSES = 5
 
+# The DataLoader and the layers shared between the models are built the first time they are
+# needed rather than when this module is imported, so `import src` stays cheap.
+_data = None
+_tf_hub_embedding_layer = None
+_sentence_encoder_name = EMBEDDING_LAYER_URL
+_char_vectorizer = None
+_char_embed = None
+
+
+def get_data(batch_size=BATCH_SIZE, rebuild_cache=False, integer_features=False, bucket_by_char_length=False,
+             num_workers=1, data_dir=None):
+    """
+    Returns the shared DataLoader, creating it on the first call. The splits themselves are
+    only loaded when a pipeline needs them. The arguments only apply to that first call.
+    :param batch_size: batch size of the pipelines.
+    :param rebuild_cache: rebuild the preprocessed dataset cache.
+    :param integer_features: one hot encode labels and positional features per batch inside the pipelines.
+    :param bucket_by_char_length: batch pipelines with a char input by sentence length.
+    :param num_workers: number of processes used to parse split files that are not cached yet.
+    :param data_dir: directory of the split files, defaults to src.data.DATA_DIR.
+    :return: DataLoader
+    """
+    global _data
+    if _data is None:
+        _data = DataLoader(batch_size=batch_size, rebuild_cache=rebuild_cache, integer_features=integer_features,
+                           bucket_by_char_length=bucket_by_char_length, num_workers=num_workers, data_dir=data_dir)
+    return _data
+
+
+def get_tf_hub_embedding_layer():
+    global _tf_hub_embedding_layer
+    if _tf_hub_embedding_layer is None:
+        # the hub module computes in float32 whatever the global policy, so keep the layer out of mixed precision
+        _tf_hub_embedding_layer = hub.KerasLayer(EMBEDDING_LAYER_URL,
+                                                 trainable=False,
+                                                 dtype="float32",
+                                                 name="universal_sentence_encoder")
+    return _tf_hub_embedding_layer
+
+
+def set_sentence_encoder(encoder, name, dim=SENTENCE_EMBEDDING_DIM):
+    """
+    Replaces the Universal Sentence Encoder used by every model, e.g. with
+    src.embeddings.HashingSentenceEncoder to run offline.
+    :param encoder: keras layer mapping a string tensor of shape (n,) to (n, dim) embeddings.
+    :param name: name identifying the encoder in the embedding cache.
+    :param dim: size of the embeddings.
+    """
+    global _tf_hub_embedding_layer, _sentence_encoder_name, SENTENCE_EMBEDDING_DIM
+    _tf_hub_embedding_layer = encoder
+    _sentence_encoder_name = name
+    SENTENCE_EMBEDDING_DIM = dim
+
+
+def set_mixed_precision(policy="mixed_bfloat16"):
+    """
+    Sets the global keras dtype policy used by the models built afterwards. Their softmax outputs
+    stay in float32, and compile wraps the optimizer in a LossScaleOptimizer for mixed_float16.
+    :param policy: 'mixed_bfloat16' (CPUs with bfloat16 support), 'mixed_float16' (GPUs) or 'float32'.
+    """
+    tf.keras.mixed_precision.set_global_policy(policy)
+    print(f"keras dtype policy: {policy}")
+
+
+def compile_model(model, optimizer, jit_compile=False, **kwargs):
+    """
+    Compiles a model, with its train step compiled by XLA if jit_compile is set.
+    XLA has no kernels for string ops, so models whose inputs are raw sentences or character-spaced
+    strings (the sentence encoder and the char vectorizer) are rejected; build them with
+    cached_embeddings=True and char_ids=True instead.
+    :param model: keras model.
+    :param optimizer: optimizer or its name.
+    :param jit_compile: compile the train, test and predict steps with XLA.
+    :param kwargs: loss, metrics, ... passed to model.compile.
+    :return: the model.
+    """
+    if not jit_compile:
+        model.compile(optimizer=optimizer, **kwargs)
+        return model
+
+    string_inputs = [name for name, tensor in zip(model.input_names, model.inputs) if tensor.dtype == tf.string]
+    if string_inputs:
+        raise ValueError(f"jit_compile needs numeric inputs, but {model.name} takes strings in {string_inputs}: "
+                         f"build it with cached_embeddings=True and char_ids=True")
+    try:
+        model.compile(optimizer=optimizer, jit_compile=True, **kwargs)
+    except TypeError:  # keras releases without compile(jit_compile=...)
+        model.compile(optimizer=optimizer, **kwargs)
+        model.train_step = tf.function(model.train_step, jit_compile=True)
+    return model
+
+
+def save_char_vocabulary(vectorizer, path=CHAR_VOCAB_PATH):
+    """
+    Saves the vocabulary and output length of an adapted char vectorizer.
+    :param vectorizer: adapted TextVectorization layer.
+    :param path: json file to write.
+    """
+    with open(path, "w") as f:
+        json.dump({"vocabulary": vectorizer.get_vocabulary(),
+                   "output_sequence_length": vectorizer.get_config()["output_sequence_length"]}, f)
+    print(f"saving char vocabulary to {path}...")
+
+
+def load_char_vocabulary(path=CHAR_VOCAB_PATH):
+    """
+    :param path: json file written by save_char_vocabulary.
+    :return: dict with the vocabulary and output_sequence_length, or None if path does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def make_char_vectorizer(vocabulary=None, output_sequence_length=None):
+    """
+    :param vocabulary: char vocabulary to start from, None to adapt the layer afterwards.
+    :param output_sequence_length: pad/truncate to this many chars, None to pad to the longest sentence of the batch.
+    :return: char TextVectorization layer.
+    """
+    return tf.keras.layers.TextVectorization(max_tokens=DataLoader.NUM_CHAR_TOKENS,
+                                             output_sequence_length=output_sequence_length,
+                                             standardize="lower_and_strip_punctuation",
+                                             vocabulary=vocabulary,
+                                             name="char_vectorizer")
+
+
+def adapt_char_vectorizer(sample_size=None, path=CHAR_VOCAB_PATH):
+    """
+    Adapts the char vectorizer on the train split, or on a random sample of it, and saves its
+    vocabulary to path so later runs and the serving app can reload it instead.
+    :param sample_size: number of train sentences to adapt on, all of them if None.
+    :param path: json file to write the vocabulary to.
+    :return: the adapted TextVectorization layer, also returned by get_char_vectorizer from now on.
+    """
+    global _char_vectorizer
+    data = get_data()
+    if sample_size is None:
+        train_chars = data.train_chars
+    else:
+        train_chars = [split_chars(sentence) for sentence in data.sample_sentences("train", sample_size)]
+
+    _char_vectorizer = make_char_vectorizer(output_sequence_length=data.output_sequences_char_length)
+    _char_vectorizer.adapt(train_chars)
+    save_char_vocabulary(_char_vectorizer, path)
+    return _char_vectorizer
+
+
+def adapt_char_vectorizer_from_tfrecords(tfrecords_dir, sample_size=None, path=CHAR_VOCAB_PATH):
+    """
+    Adapts the char vectorizer on the train shards, or on their first sample_size sentences, streamed
+    from disk so the train split is never loaded into memory, and saves its vocabulary to path.
+    The output length is the 95th percentile of the sentence lengths, as for the in memory splits.
+    :param tfrecords_dir: directory the shards were exported to.
+    :param sample_size: number of train sentences to adapt on, all of them if None.
+    :param path: json file to write the vocabulary to.
+    :return: the adapted TextVectorization layer, also returned by get_char_vectorizer from now on.
+    """
+    global _char_vectorizer
+    texts = tfrecords.read_split_texts(tfrecords_dir, "train")
+    if sample_size is not None:
+        texts = texts.unbatch().take(sample_size).batch(4096)
+    lengths = np.concatenate([tf.strings.length(batch, unit="UTF8_CHAR").numpy() for batch in texts])
+
+    _char_vectorizer = make_char_vectorizer(output_sequence_length=int(np.percentile(lengths, 95)))
+    _char_vectorizer.adapt(texts.map(split_chars_tensor, num_parallel_calls=tf.data.AUTOTUNE))
+    save_char_vocabulary(_char_vectorizer, path)
+    return _char_vectorizer
+
+
+def get_char_vectorizer():
+    """
+    Returns the char TextVectorization layer. Its vocabulary is loaded from char_vocab.json when it
+    exists, otherwise it is adapted on the train split and saved there on the first call.
+    """
+    global _char_vectorizer
+    if _char_vectorizer is None:
+        saved = load_char_vocabulary()
+        if saved is None:
+            return adapt_char_vectorizer()
+        _char_vectorizer = make_char_vectorizer(vocabulary=saved["vocabulary"],
+                                                output_sequence_length=saved["output_sequence_length"])
+    return _char_vectorizer
+
+
+def get_char_embed():
+    global _char_embed
+    if _char_embed is None:
+        _char_embed = layers.Embedding(input_dim=DataLoader.NUM_CHAR_TOKENS,
+                                       output_dim=CHAR_OUTPUT_DIM,
+                                       mask_zero=False,
+                                       name='char_embed')
+    return _char_embed
+
+
+def __getattr__(name):
+    # Keeps `src.models.data`, `src.models.char_vectorizer`, ... working without building them on import.
+    lazy_attributes = {"data": get_data,
+                       "tf_hub_embedding_layer": get_tf_hub_embedding_layer,
+                       "char_vectorizer": get_char_vectorizer,
+                       "char_embed": get_char_embed}
+    if name in lazy_attributes:
+        return lazy_attributes[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_sentence_embeddings(split, dtype=np.float16):
+    """
+    Sentence embeddings of a split from the current sentence encoder, encoded once and cached on disk.
+    :param split: one of 'train', 'val' or 'test'.
+    :param dtype: np.float16 or np.float32.
+    :return: src.embeddings.CachedEmbeddings
+    """
+    data = get_data()
+    return get_cached_embeddings(data, split, get_tf_hub_embedding_layer(), _sentence_encoder_name,
+                                 dtype=dtype, rebuild_cache=data.rebuild_cache)
+
+
+def get_data_for_training(dataset_type, cached_embeddings=False, char_ids=False):
+    """
+    :param dataset_type: 'tribrid', 'token_and_chars' or 'tokens'.
+    :param cached_embeddings: feed cached sentence embeddings instead of raw sentences, for the models
+    built with cached_embeddings=True.
+    :param char_ids: feed char ids computed inside the pipeline instead of character-spaced strings, for
+    the models built with char_ids=True.
+    :return: training dataset, validation dataset
+    """
+    data = get_data()
+    data.load_splits(["train", "val"])  # parse both splits concurrently if they are not cached
+    if char_ids:
+        vectorizer = get_char_vectorizer()
+        data.set_char_vocabulary(vectorizer.get_vocabulary(), vectorizer.get_config()["output_sequence_length"])
+    embeddings = None
+    if cached_embeddings:
+        embeddings = {split: get_sentence_embeddings(split) for split in ("train", "val")}
 
-def get_data_for_training(dataset_type):
     if dataset_type == 'tribrid':
-        return data.get_tribrid_model_input()
+        return data.get_tribrid_model_input(embeddings)
     elif dataset_type == 'token_and_chars':
-        return data.get_only_char_and_token_data()
+        return data.get_only_char_and_token_data(embeddings)
+    elif dataset_type == 'tokens':
+        return data.get_only_tokens_data(embeddings)
+
+
+MODEL_FEATURES = {'tribrid': ('line_numbers', 'total_lines', 'tokens', 'chars'),
+                  'token_and_chars': ('tokens', 'chars'),
+                  'tokens': ('tokens',)}
+
+
+def get_tfrecord_data_for_training(dataset_type, tfrecords_dir, shuffle_buffer=10000, char_ids=False):
+    """
+    Training and validation pipelines read from the TFRecord shards written by export_tfrecords.py,
+    without loading the splits into Python.
+    :param dataset_type: 'tribrid', 'token_and_chars' or 'tokens'.
+    :param tfrecords_dir: directory the shards were exported to.
+    :param shuffle_buffer: shuffle buffer of the training pipeline.
+    :param char_ids: feed char ids instead of character-spaced strings.
+    :return: training dataset, validation dataset
+    """
+    features = MODEL_FEATURES[dataset_type]
+    num_classes = len(tfrecords.read_split_meta(tfrecords_dir, "train")["class_names"])
+    char_table, char_ids_length = None, None
+    if char_ids:
+        vectorizer = get_char_vectorizer()
+        char_table = make_char_table(vectorizer.get_vocabulary())
+        char_ids_length = vectorizer.get_config()["output_sequence_length"]
+
+    batch_size = get_data().BATCH_SIZE
+    train_dataset = tfrecords.read_split(tfrecords_dir, "train", batch_size, features, num_classes,
+                                         shuffle_buffer=shuffle_buffer, deterministic=False,
+                                         char_table=char_table, char_ids_length=char_ids_length)
+    validation_dataset = tfrecords.read_split(tfrecords_dir, "val", batch_size, features, num_classes,
+                                              char_table=char_table, char_ids_length=char_ids_length)
+    return train_dataset, validation_dataset
+
+
+def token_embedding_input(name, cached_embeddings=False):
+    """
+    Input of the token branch and the sentence embedding computed from it.
+    :param name: name of the raw sentence input.
+    :param cached_embeddings: take precomputed sentence embeddings instead of raw sentences.
+    :return: (input layer, sentence embeddings)
+    """
+    if cached_embeddings:
+        inputs = layers.Input(shape=(SENTENCE_EMBEDDING_DIM,), dtype=tf.float32, name=name + CACHED_EMBEDDING_SUFFIX)
+        return inputs, inputs
 
+    inputs = layers.Input(shape=[], dtype=tf.string, name=name)
+    return inputs, get_tf_hub_embedding_layer()(inputs)
 
-def only_tokens_model():
-    inputs = layers.Input(shape=[], dtype=tf.string)
-    pretrained_embedding = tf_hub_embedding_layer(inputs)
+
+def char_embedding_input(name, bucketed_chars=False, char_ids=False):
+    """
+    Input of the char branch and its char embeddings.
+    :param name: name of the char input.
+    :param bucketed_chars: pad the char ids to the longest sentence of the batch instead of
+    output_sequences_char_length, and mask the padding, for length-bucketed pipelines.
+    :param char_ids: take char ids computed by the input pipeline instead of character-spaced strings,
+    see to_serving_model to get a model that accepts strings back.
+    :return: (input layer, char embeddings)
+    """
+    if char_ids:
+        char_inputs = layers.Input(shape=(None,), dtype=tf.int64, name=name + CHAR_IDS_SUFFIX)
+        char_vectors = char_inputs
+    else:
+        char_inputs = layers.Input(shape=(1,), dtype=tf.string, name=name)
+        if not bucketed_chars:
+            return char_inputs, get_char_embed()(get_char_vectorizer()(char_inputs))
+        vectorizer = make_char_vectorizer(vocabulary=get_char_vectorizer().get_vocabulary())
+        char_vectors = vectorizer(char_inputs)  # padded to the longest sentence of the batch
+
+    if not bucketed_chars:
+        return char_inputs, get_char_embed()(char_vectors)
+
+    max_length = get_char_vectorizer().get_config()["output_sequence_length"]
+    char_vectors = layers.Lambda(lambda x: x[:, :max_length], name="char_truncation")(char_vectors)
+    char_embeddings = layers.Embedding(input_dim=DataLoader.NUM_CHAR_TOKENS,
+                                       output_dim=CHAR_OUTPUT_DIM,
+                                       mask_zero=True,  # the LSTMs skip the padding of each bucket
+                                       name='masked_char_embed')(char_vectors)
+    return char_inputs, char_embeddings
+
+
+def to_serving_model(model):
+    """
+    Wraps a model trained on cached sentence embeddings or char ids so that it accepts raw
+    sentences and character-spaced strings again, by putting the sentence encoder in front of
+    its embedding inputs and the char vectorizer in front of its char id inputs. The other inputs
+    keep their names, shapes and order.
+    :param model: model built with cached_embeddings=True and/or char_ids=True.
+    :return: uncompiled keras model with the same input signature as the cached_embeddings=False model.
+    """
+    serving_inputs, model_inputs = [], []
+    for name, tensor in zip(model.input_names, model.inputs):
+        if name.endswith(CACHED_EMBEDDING_SUFFIX):
+            inputs = layers.Input(shape=[], dtype=tf.string, name=name[:-len(CACHED_EMBEDDING_SUFFIX)])
+            model_inputs.append(get_tf_hub_embedding_layer()(inputs))
+        elif name.endswith(CHAR_IDS_SUFFIX):
+            inputs = layers.Input(shape=(1,), dtype=tf.string, name=name[:-len(CHAR_IDS_SUFFIX)])
+            model_inputs.append(get_char_vectorizer()(inputs))
+        else:
+            inputs = layers.Input(shape=tensor.shape[1:], dtype=tensor.dtype, name=name)
+            model_inputs.append(inputs)
+        serving_inputs.append(inputs)
+
+    outputs = model(model_inputs if len(model_inputs) > 1 else model_inputs[0])
+    return tf.keras.Model(inputs=serving_inputs, outputs=outputs, name=f"{model.name}_serving")
+
+
+def only_tokens_model(cached_embeddings=False, jit_compile=False):
+    inputs, pretrained_embedding = token_embedding_input("token_inputs", cached_embeddings)
     x = layers.Dense(128, activation="relu")(pretrained_embedding)
-    outputs = layers.Dense(5, activation="softmax")(x)
+    outputs = layers.Dense(5, activation="softmax", dtype="float32")(x)  # float32 softmax under mixed precision
     token_model = tf.keras.Model(inputs=inputs,
                                  outputs=outputs)
 
     # Compile the model
-    token_model.compile(loss="categorical_crossentropy",
-                        optimizer=tf.keras.optimizers.Adam(),
-                        metrics=["accuracy"])
+    compile_model(token_model,
+                  optimizer=tf.keras.optimizers.Adam(),
+                  jit_compile=jit_compile,
+                  loss="categorical_crossentropy",
+                  metrics=["accuracy"])
 
     return token_model
 
 
-def char_and_token_model():
-    token_inputs = layers.Input(shape=[], dtype=tf.string, name="token_input")
-    token_embeddings = tf_hub_embedding_layer(token_inputs)  # bert_layer(token_inputs)
+def char_and_token_model(cached_embeddings=False, bucketed_chars=False, char_ids=False, jit_compile=False):
+    token_inputs, token_embeddings = token_embedding_input("token_input", cached_embeddings)  # bert_layer(token_inputs)
     token_dense_1 = layers.Dense(256, activation='relu')(token_embeddings)
     token_dense_2 = layers.Dense(128, activation='relu')(token_dense_1)
     token_model = tf.keras.Model(inputs=token_inputs,
                                  outputs=token_dense_2,
                                  name="token_model")
 
-    char_inputs = layers.Input(shape=(1,), dtype=tf.string, name="char_input")
-    char_vectors = char_vectorizer(char_inputs)
-    char_embeddings = char_embed(char_vectors)
+    char_inputs, char_embeddings = char_embedding_input("char_input", bucketed_chars, char_ids)
     char_bi_lstm = layers.Bidirectional(layers.LSTM(128, return_sequences=True))(char_embeddings)
     char_bi_lstm_2 = layers.Bidirectional(layers.LSTM(128))(char_bi_lstm)
     char_dense = layers.Dense(128, activation='relu')(char_bi_lstm_2)
@@ -85,28 +423,35 @@ def char_and_token_model():
     concat = layers.Concatenate(name="concatenation_layer")([token_model.output, char_model.output])
     combined_dropout = layers.Dropout(0.5)(concat)
     combined_dense = layers.Dense(128, activation='relu')(combined_dropout)
-    output_layer = layers.Dense(NUM_CLASSES, activation='softmax')(combined_dense)
+    output_layer = layers.Dense(NUM_CLASSES, activation='softmax', dtype='float32')(combined_dense)
 
     model = tf.keras.Model(inputs=[token_inputs, char_inputs],
                            outputs=output_layer,
                            name="combined_model")
 
-    model.compile(loss='categorical_crossentropy',
+    compile_model(model,
                   optimizer='adam',
+                  jit_compile=jit_compile,
+                  loss='categorical_crossentropy',
                   metrics=['accuracy'])
 
     return model
 
 
-def tribrid_model():
+def tribrid_model(cached_embeddings=False, bucketed_chars=False, char_ids=False, jit_compile=False):
     """
     This model is trained on token, char and positional embeddings.
+    :param cached_embeddings: take precomputed sentence embeddings instead of raw sentences as token input,
+    see to_serving_model to get a model that accepts raw sentences back.
+    :param bucketed_chars: run the char BiLSTMs over per batch padded, masked char ids, to be trained on
+    a DataLoader with bucket_by_char_length=True.
+    :param char_ids: take char ids computed by the input pipeline instead of character-spaced strings.
+    :param jit_compile: compile the train step with XLA, needs cached_embeddings and char_ids, see compile_model.
     :return: a compiled model which accepts char_embedding, token_embedding and positional_embedding.
     """
 
-    token_inputs = layers.Input(shape=[], dtype=tf.string, name="token_inputs")
     # token_vectors = text_vectorizer(token_inputs)
-    token_embeddings = tf_hub_embedding_layer(token_inputs)
+    token_inputs, token_embeddings = token_embedding_input("token_inputs", cached_embeddings)
     # token_lstm_1 = layers.LSTM(256, return_sequences=True)(token_embeddings)
     # token_lstm_2 = layers.LSTM(128)(token_lstm_1)
     dense_1 = layers.Dense(512, activation='relu')(token_embeddings)
@@ -115,9 +460,7 @@ def tribrid_model():
     token_model = tf.keras.Model(inputs=token_inputs,
                                  outputs=token_outputs)
 
-    char_inputs = layers.Input(shape=(1,), dtype=tf.string, name='char_inputs')
-    char_vectors = char_vectorizer(char_inputs)
-    char_embeddings = char_embed(char_vectors)
+    char_inputs, char_embeddings = char_embedding_input('char_inputs', bucketed_chars, char_ids)
     char_bi_lstm_1 = layers.Bidirectional(layers.LSTM(64, return_sequences=True))(char_embeddings)
     char_bi_lstm_2 = layers.Bidirectional(layers.LSTM(64))(char_bi_lstm_1)
     char_dense_1 = layers.Dense(128, activation='relu')(char_bi_lstm_2)
@@ -125,15 +468,17 @@ def tribrid_model():
                                 outputs=char_dense_1)
 
     line_number_inputs = layers.Input(shape=(15,), dtype=tf.float32, name="line_number_input")
-    dense_3 = layers.Dense(256, activation='relu')(line_number_inputs)
-    dense_4 = layers.Dense(128, activation='relu')(dense_3)
+    dense_3 = layers.Dense(256, activation='relu', name=POSITIONAL_TOWER_LAYERS["line_number_input"][0])(
+        line_number_inputs)
+    dense_4 = layers.Dense(128, activation='relu', name=POSITIONAL_TOWER_LAYERS["line_number_input"][1])(dense_3)
 
     line_number_model = tf.keras.Model(inputs=line_number_inputs,
                                        outputs=dense_4)
 
     total_line_inputs = layers.Input(shape=(20,), dtype=tf.int32, name="total_lines_input")
-    dense_5 = layers.Dense(256, activation="relu")(total_line_inputs)
-    dense_6 = layers.Dense(128, activation="relu")(dense_5)
+    dense_5 = layers.Dense(256, activation="relu", name=POSITIONAL_TOWER_LAYERS["total_lines_input"][0])(
+        total_line_inputs)
+    dense_6 = layers.Dense(128, activation="relu", name=POSITIONAL_TOWER_LAYERS["total_lines_input"][1])(dense_5)
 
     total_line_model = tf.keras.Model(inputs=total_line_inputs,
                                       outputs=dense_6)
@@ -152,7 +497,8 @@ def tribrid_model():
 
     # 7. Create output layer
     output_layer_0 = layers.Dense(128, activation="relu", name="output_layer_0")(concat)
-    output_layer = layers.Dense(NUM_CLASSES, activation="softmax", name="output_layer")(output_layer_0)
+    # kept in float32 so the softmax and the loss stay stable under mixed precision
+    output_layer = layers.Dense(NUM_CLASSES, activation="softmax", dtype="float32", name="output_layer")(output_layer_0)
 
     # 8. Put together model
     tribrid_model = tf.keras.Model(inputs=[line_number_model.input,
@@ -161,8 +507,88 @@ def tribrid_model():
                                            char_model.input],
                                    outputs=output_layer)
 
-    tribrid_model.compile(loss="categorical_crossentropy",
-                          optimizer=tf.keras.optimizers.Adam(),
-                          metrics=["accuracy"])
+    compile_model(tribrid_model,
+                  optimizer=tf.keras.optimizers.Adam(),
+                  jit_compile=jit_compile,
+                  loss="categorical_crossentropy",
+                  metrics=["accuracy"])
 
     return tribrid_model
+
+
+class HashedNgramEmbedding(layers.Layer):
+    """
+    fastText style text embedding: the mean of the embeddings of the hashed n-grams of the
+    whitespace separated tokens of each string. No vocabulary to adapt and no sequence model, so
+    it costs a few table lookups per sentence.
+    """
+
+    def __init__(self, num_buckets=STUDENT_HASH_BUCKETS, output_dim=64, ngram_widths=(1, 2), separator=" ",
+                 **kwargs):
+        """
+        :param num_buckets: number of rows of the hashed embedding table.
+        :param output_dim: size of the embeddings.
+        :param ngram_widths: n-gram sizes embedded, e.g. (1, 2) for words and word pairs.
+        :param separator: string joining the tokens of an n-gram, '' to build char n-grams from character-spaced text.
+        """
+        super().__init__(**kwargs)
+        self.num_buckets = num_buckets
+        self.output_dim = output_dim
+        self.ngram_widths = tuple(ngram_widths)
+        self.separator = separator
+
+    def build(self, input_shape):
+        self.embeddings = self.add_weight(name="embeddings", shape=(self.num_buckets, self.output_dim),
+                                          initializer="uniform", trainable=True)
+        super().build(input_shape)
+
+    def call(self, inputs):
+        tokens = tf.strings.split(tf.strings.lower(tf.reshape(inputs, [-1])))
+        ngrams = tf.strings.ngrams(tokens, list(self.ngram_widths), separator=self.separator)
+        ids = tf.strings.to_hash_bucket_fast(ngrams, self.num_buckets)
+        sums = tf.reduce_sum(tf.ragged.map_flat_values(tf.nn.embedding_lookup, self.embeddings, ids), axis=1)
+        counts = tf.cast(tf.expand_dims(ids.row_lengths(), -1), sums.dtype)
+        return sums / tf.maximum(counts, 1)  # empty sentences get a zero vector
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"num_buckets": self.num_buckets, "output_dim": self.output_dim,
+                       "ngram_widths": self.ngram_widths, "separator": self.separator})
+        return config
+
+
+def student_model(num_buckets=STUDENT_HASH_BUCKETS):
+    """
+    Small model meant to be distilled from the tribrid model. It takes the same four inputs, so it
+    can replace it in serving, but embeds sentences with hashed word n-grams and chars with hashed
+    char trigrams instead of the Universal Sentence Encoder and the char BiLSTMs.
+    :param num_buckets: number of hashed word n-gram embeddings, a quarter as many char trigram embeddings are used.
+    :return: a compiled model whose pre-softmax layer is named 'student_logits'.
+    """
+    line_number_inputs = layers.Input(shape=(15,), dtype=tf.float32, name="line_number_input")
+    total_line_inputs = layers.Input(shape=(20,), dtype=tf.int32, name="total_lines_input")
+    token_inputs = layers.Input(shape=[], dtype=tf.string, name="token_inputs")
+    char_inputs = layers.Input(shape=(1,), dtype=tf.string, name="char_inputs")
+
+    token_embeddings = HashedNgramEmbedding(num_buckets, 64, ngram_widths=(1, 2),
+                                            name="token_ngram_embed")(token_inputs)
+    char_embeddings = HashedNgramEmbedding(num_buckets // 4, 32, ngram_widths=(3,), separator="",
+                                           name="char_ngram_embed")(char_inputs)
+    line_number_dense = layers.Dense(32, activation="relu")(line_number_inputs)
+    total_line_dense = layers.Dense(32, activation="relu")(total_line_inputs)
+
+    concat = layers.Concatenate(name="student_embedding")([line_number_dense, total_line_dense,
+                                                           token_embeddings, char_embeddings])
+    dense = layers.Dense(128, activation="relu")(concat)
+    logits = layers.Dense(NUM_CLASSES, name="student_logits")(dense)
+    output_layer = layers.Activation("softmax", dtype="float32", name="output_layer")(logits)
+
+    model = tf.keras.Model(inputs=[line_number_inputs, total_line_inputs, token_inputs, char_inputs],
+                           outputs=output_layer,
+                           name="student_model")
+
+    model.compile(loss="categorical_crossentropy",
+                  optimizer=tf.keras.optimizers.Adam(),
+                  metrics=["accuracy"])
+
+    return model
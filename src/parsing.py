@@ -0,0 +1,260 @@
+import io
+import os
+import sys
+import locale
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from tqdm import tqdm
+
+# Pure Python parsing of the PubMed RCT split files and of abstracts into sentences. This module must not import
+# tensorflow: the parsing and sentence splitting worker processes import it, see build_splits_columns.
+
+# Files are only split across parsing workers in shards of at least this many bytes.
+MIN_SHARD_BYTES = 4 << 20
+
+
+def split_chars(text):
+    """
+    Converts a list of string to list of chars
+    :param text: string input to be converted to list of chars.
+    :return: list of chars.
+    """
+    return " ".join(list(text))
+
+
+def make_sentencizer():
+    """
+    :return: spaCy English pipeline with only a rule based sentencizer.
+    """
+    from spacy.lang.en import English  # only the serving code paths need spaCy
+
+    language = English()
+    sentencizer = language.create_pipe("sentencizer")
+    language.add_pipe(sentencizer)
+    return language
+
+
+def parse_abstracts(lines):
+    """
+    Groups the lines of a PubMed RCT file into abstracts, see iter_abstracts.
+    :param lines: iterable of lines, with their line endings.
+    :return: generator of lists of line dictionaries, one list per abstract.
+    """
+    abstract_lines = []  # labelled lines of the current abstract
+
+    for line in lines:
+        if line.startswith("###"):  # check to see if line is an ID line
+            abstract_lines = []  # reset abstract buffer
+        elif line.isspace():  # check to see if line is a new line
+            abstract_line_split = "".join(abstract_lines).splitlines()  # split abstract into separate lines
+            total_lines = len(abstract_line_split) - 1  # how many total lines are in the abstract? (start from 0)
+            abstract_samples = []
+
+            # Iterate through each line in abstract and count them at the same time
+            for abstract_line_number, abstract_line in enumerate(abstract_line_split):
+                target_text_split = abstract_line.split("\t")  # split target label from text
+                abstract_samples.append({"target": target_text_split[0],
+                                         "text": target_text_split[1].lower(),
+                                         "line_number": abstract_line_number,
+                                         "total_lines": total_lines})
+            yield abstract_samples
+
+        else:  # if the above conditions aren't fulfilled, the line contains a labelled sentence
+            abstract_lines.append(line)
+
+
+def iter_abstracts(filename):
+    """Yields the line data of one abstract at a time.
+
+    Reads filename incrementally instead of loading it with readlines, so peak
+    memory is bounded by a single abstract. Each abstract's labelled lines are
+    buffered in a list and joined once when the blank separator line is reached,
+    which keeps the parse linear in the size of the file.
+
+    Args:
+        filename: a string of the target text file to read and extract line data
+        from.
+
+    Yields:
+        A list of dictionaries, one per line of the abstract, in the same format
+        as preprocess_text_with_line_numbers.
+    """
+    file = filename.split('/')[-1]
+
+    with open(filename, 'r') as f:
+        yield from parse_abstracts(tqdm(f, desc=f'processing {file}'))
+
+
+def iter_lines_in_range(filename, start, end):
+    """
+    Streams the lines of filename whose first byte lies in [start, end), decoded the same way
+    open(filename, 'r') would decode them, universal newlines included.
+    :param filename: path of the file.
+    :param start: byte offset of the first line, must be the start of a line.
+    :param end: byte offset past which no line starts.
+    :return: generator of lines.
+    """
+    encoding = locale.getpreferredencoding(False)
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        position = start
+        for raw_line in f:
+            if position >= end:
+                break
+            position += len(raw_line)
+            line = raw_line.decode(encoding)
+            if '\r' in line:
+                yield from io.StringIO(line, newline=None)
+            else:
+                yield line
+
+
+def find_abstract_boundaries(filename, num_shards):
+    """
+    Splits a file into up to num_shards byte ranges that each start at an abstract ID line,
+    so every range can be parsed on its own. The parser resets its state on ID lines, which
+    makes the concatenated output of the ranges identical to parsing the whole file.
+    :param filename: path to a PubMed RCT split file.
+    :param num_shards: wanted number of ranges.
+    :return: list of (start, end) byte offsets covering the file.
+    """
+    size = os.path.getsize(filename)
+    starts = [0]
+    with open(filename, 'rb') as f:
+        for shard in range(1, num_shards):
+            target = max(size * shard // num_shards, starts[-1] + 1)
+            if target >= size:
+                break
+            f.seek(target)
+            f.readline()  # skip to the start of the next line
+            position = f.tell()
+            for line in iter(f.readline, b''):
+                if line.startswith(b"###"):
+                    break
+                position += len(line)
+            else:
+                break  # no ID line left, the last range runs to the end of the file
+            if position > starts[-1]:
+                starts.append(position)
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def iter_samples(filename, byte_range=None):
+    """
+    Streams the line dictionaries of every abstract in filename.
+    :param filename: path to a PubMed RCT split file.
+    :param byte_range: optional (start, end) range returned by find_abstract_boundaries to parse only part of the file.
+    :return: generator of line dictionaries.
+    """
+    if byte_range is None:
+        abstracts = iter_abstracts(filename)
+    else:
+        abstracts = parse_abstracts(iter_lines_in_range(filename, *byte_range))
+    for abstract_samples in abstracts:
+        yield from abstract_samples
+
+
+def preprocess_text_with_line_numbers(filename):
+    """Returns a list of dictionaries of abstract line data.
+
+    Takes in filename, reads its contents and sorts through each line,
+    extracting things like the target label, the text of the sentence,
+    how many sentences are in the current abstract and what sentence number
+    the target line is.
+
+    Args:
+        filename: a string of the target text file to read and extract line data
+        from.
+
+    Returns:
+        A list of dictionaries each containing a line from an abstract,
+        the lines label, the lines position in the abstract and the total number
+        of lines in the abstract where the line is from. For example:
+
+        [{"target": 'CONCLUSION',
+          "text": The study couldn't have gone better, turns out people are kinder than you think",
+          "line_number": 8,
+          "total_lines": 8}]
+    """
+    return list(iter_samples(filename))
+
+
+def build_split_columns(filename, byte_range=None):
+    """
+    Parses a split file into compact columns.
+    :param filename: path to a PubMed RCT split file.
+    :param byte_range: optional (start, end) range returned by find_abstract_boundaries to parse only part of the file.
+    :return: dict with the target strings and the text buffer, offsets, line_number and total_lines arrays.
+    """
+    targets, line_numbers, total_lines = [], [], []
+    text = bytearray()
+    offsets = [0]
+
+    for sample in iter_samples(filename, byte_range):
+        targets.append(sample["target"])
+        line_numbers.append(sample["line_number"])
+        total_lines.append(sample["total_lines"])
+        text += sample["text"].encode('utf-8')
+        offsets.append(len(text))
+
+    return {"target": targets,
+            "text": np.frombuffer(bytes(text), dtype=np.uint8),
+            "offsets": np.array(offsets, dtype=np.int64),
+            "line_number": np.array(line_numbers, dtype=np.int16),
+            "total_lines": np.array(total_lines, dtype=np.int16)}
+
+
+def merge_split_columns(parts):
+    """
+    Concatenates the columns of consecutive parts of a split, shifting the text offsets.
+    :param parts: list of dicts returned by build_split_columns, in file order.
+    :return: dict of columns, as if the whole split had been parsed at once.
+    """
+    if len(parts) == 1:
+        return parts[0]
+
+    offsets = [parts[0]["offsets"]]
+    text_length = len(parts[0]["text"])
+    for part in parts[1:]:
+        offsets.append(part["offsets"][1:] + text_length)
+        text_length += len(part["text"])
+
+    return {"target": [target for part in parts for target in part["target"]],
+            "text": np.concatenate([part["text"] for part in parts]),
+            "offsets": np.concatenate(offsets),
+            "line_number": np.concatenate([part["line_number"] for part in parts]),
+            "total_lines": np.concatenate([part["total_lines"] for part in parts])}
+
+
+def build_splits_columns(filenames, num_workers=1):
+    """
+    Parses several split files, concurrently when num_workers > 1. Large files are cut at abstract
+    ID lines into shards parsed by different workers, and the shards are merged back in file order,
+    so the result is identical to parsing each file serially.
+    :param filenames: dict of split name -> path of the split file.
+    :param num_workers: number of worker processes, capped at the number of shards, 1 to parse serially in this
+    process.
+    :return: dict of split name -> dict of columns returned by build_split_columns.
+    """
+    if num_workers <= 1:
+        return {split: build_split_columns(filename) for split, filename in filenames.items()}
+
+    shards = {split: find_abstract_boundaries(filename, max(1, min(num_workers,
+                                                                   os.path.getsize(filename) // MIN_SHARD_BYTES)))
+              for split, filename in filenames.items()}
+    num_workers = min(num_workers, sum(len(byte_ranges) for byte_ranges in shards.values()))
+    if num_workers <= 1:
+        return {split: build_split_columns(filename) for split, filename in filenames.items()}
+
+    # A process forked after tensorflow started its runtime threads can deadlock on a lock copied while held,
+    # so workers are spawned once it is imported. They only import this module, plus the top-level imports
+    # of the main script, and never run a TensorFlow op.
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods and 'tensorflow' not in sys.modules else 'spawn')
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as executor:
+        futures = {split: [executor.submit(build_split_columns, filenames[split], byte_range)
+                           for byte_range in byte_ranges]
+                   for split, byte_ranges in shards.items()}
+        return {split: merge_split_columns([future.result() for future in split_futures])
+                for split, split_futures in futures.items()}
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import fcntl
+import datetime
+from contextlib import contextmanager
+
+REGISTRY_DIR = "models"
+REGISTRY_INDEX = "registry.json"
+MODEL_MANIFEST = "manifest.json"
+
+
+def get_index_path(registry_dir=REGISTRY_DIR):
+    return os.path.join(registry_dir, REGISTRY_INDEX)
+
+
+def is_registry(path):
+    return os.path.isdir(path) and os.path.exists(get_index_path(path))
+
+
+def new_model_dir(registry_dir=REGISTRY_DIR, prefix="model"):
+    """
+    Creates the directory of a new model version, named after the current time down to the second,
+    with a numeric suffix if another run created the same name first.
+    :param registry_dir: directory holding the model versions.
+    :param prefix: start of the version name.
+    :return: path of the new, empty directory.
+    """
+    os.makedirs(registry_dir, exist_ok=True)
+    name = f"{prefix}_{datetime.datetime.now():%Y-%m-%d_%H-%M-%S}"
+    for attempt in range(1, 1000):
+        path = os.path.join(registry_dir, name if attempt == 1 else f"{name}-{attempt}")
+        try:
+            os.makedirs(path)  # fails if the directory exists, so two runs never share one
+            return path
+        except FileExistsError:
+            continue
+    raise RuntimeError(f"could not create a new model directory in {registry_dir}")
+
+
+@contextmanager
+def locked_index(registry_dir=REGISTRY_DIR):
+    """
+    Holds an exclusive lock on the index of a registry and yields its contents, written back
+    atomically when the block exits, so concurrent training runs do not lose each other's versions.
+    """
+    os.makedirs(registry_dir, exist_ok=True)
+    with open(os.path.join(registry_dir, REGISTRY_INDEX + ".lock"), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = read_index(registry_dir)
+        yield index
+        tmp_path = get_index_path(registry_dir) + f".tmp-{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, get_index_path(registry_dir))
+
+
+def read_index(registry_dir=REGISTRY_DIR):
+    """
+    :return: dict with the 'active' version name and the 'versions' entries, empty if there is no index.
+    """
+    if not os.path.exists(get_index_path(registry_dir)):
+        return {"active": None, "versions": {}}
+    with open(get_index_path(registry_dir), 'r') as f:
+        return json.load(f)
+
+
+def get_input_signature(model):
+    """
+    :param model: keras model.
+    :return: list of the name, dtype and shape of every input, in model order.
+    """
+    return [{"name": name, "dtype": tensor.dtype.name, "shape": [dim for dim in tensor.shape.as_list()]}
+            for name, tensor in zip(model.input_names, model.inputs)]
+
+
+def make_manifest(model_path, input_signature, metrics=None, training_args=None):
+    """
+    :param model_path: directory of the saved model, with its labels.json and char_vocab.json.
+    :param input_signature: see get_input_signature.
+    :param metrics: dict of the final training and validation metrics.
+    :param training_args: dict of the train.py arguments.
+    :return: manifest dict of the model version.
+    """
+    manifest = {"version": os.path.basename(os.path.normpath(model_path)),
+                "path": os.path.abspath(model_path),  # made relative to the registry by register_model
+                "created": time.time(),
+                "metrics": metrics or {},
+                "input_signature": input_signature,
+                "labels": None,
+                "char_vocab": None,
+                "training_args": training_args or {}}
+    labels_path = os.path.join(model_path, "labels.json")
+    if os.path.exists(labels_path):
+        with open(labels_path, 'r') as f:
+            class_labels = json.load(f)
+        manifest["labels"] = [class_labels[str(i)] for i in range(len(class_labels))]
+    char_vocab_path = os.path.join(model_path, "char_vocab.json")
+    if os.path.exists(char_vocab_path):
+        with open(char_vocab_path, 'r') as f:
+            char_vocab = json.load(f)
+        manifest["char_vocab"] = {"file": "char_vocab.json",
+                                  "size": len(char_vocab["vocabulary"]),
+                                  "output_sequence_length": char_vocab["output_sequence_length"]}
+    return manifest
+
+
+def register_model(model_path, input_signature, metrics=None, training_args=None, activate=False,
+                   registry_dir=REGISTRY_DIR):
+    """
+    Writes the manifest of a saved model next to it and adds it to the registry index.
+    :param model_path: directory of the saved model.
+    :param activate: make it the version served from now on.
+    :return: version name.
+    """
+    manifest = make_manifest(model_path, input_signature, metrics, training_args)
+    # relative, so the registry can be copied or mounted elsewhere, e.g. into the serving container
+    manifest["path"] = os.path.relpath(manifest["path"], os.path.abspath(registry_dir))
+    with open(os.path.join(model_path, MODEL_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    with locked_index(registry_dir) as index:
+        index["versions"][manifest["version"]] = manifest
+        if activate or index["active"] is None:
+            index["active"] = manifest["version"]
+    active = " as the active version" if index["active"] == manifest["version"] else ""
+    print(f"registered {manifest['version']}{active}")
+    return manifest["version"]
+
+
+def activate_version(version, registry_dir=REGISTRY_DIR):
+    """
+    Makes version the one served, servers watching the registry swap to it in the background.
+    """
+    with locked_index(registry_dir) as index:
+        if version not in index["versions"]:
+            raise KeyError(f"{version} is not a version of {registry_dir}, known versions: {sorted(index['versions'])}")
+        index["active"] = version
+    print(f"activated {version}")
+
+
+def remove_version(version, registry_dir=REGISTRY_DIR):
+    """
+    Removes version from the index, its files are left on disk.
+    """
+    with locked_index(registry_dir) as index:
+        if version not in index["versions"]:
+            raise KeyError(f"{version} is not a version of {registry_dir}, known versions: {sorted(index['versions'])}")
+        if version == index["active"]:
+            raise ValueError(f"{version} is the active version, activate another one first")
+        del index["versions"][version]
+
+
+def get_active_version(registry_dir=REGISTRY_DIR):
+    """
+    :return: (version name, manifest) of the active version.
+    """
+    index = read_index(registry_dir)
+    if index["active"] is None:
+        raise LookupError(f"no active model version in {registry_dir}")
+    return index["active"], index["versions"][index["active"]]
+
+
+def get_latest_version(registry_dir=REGISTRY_DIR):
+    """
+    :return: (version name, manifest) of the most recently registered version.
+    """
+    versions = read_index(registry_dir)["versions"]
+    if not versions:
+        raise LookupError(f"no model version registered in {registry_dir}")
+    version = max(versions, key=lambda name: versions[name]["created"])
+    return version, versions[version]
+
+
+def resolve_model(model_path):
+    """
+    :param model_path: registry directory, or the path of a single model.
+    :return: (path of the model to load, version name) with the active version of a registry,
+    (model_path, None) otherwise.
+    """
+    if is_registry(model_path):
+        version, manifest = get_active_version(model_path)
+        return os.path.normpath(os.path.join(model_path, manifest["path"])), version
+    return model_path, None
@@ -0,0 +1,328 @@
+import json
+import time
+import asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_REQUEST_BYTES = 1 << 20
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class MicroBatcher:
+    """
+    Merges the sentences of concurrent requests into one model batch. A batch is closed when it
+    holds max_batch_size sentences or max_wait_ms after its first request arrived, predicted in a
+    background thread, and every request gets back the rows of its own sentences.
+    With max_batch_size=1 and max_wait_ms=0 every request is predicted on its own.
+    A batch only holds requests of one ServingModel, so requests that started before a hot swap
+    finish on the model they started with.
+    """
+
+    def __init__(self, session, max_batch_size=256, max_wait_ms=5.0):
+        """
+        :param session: InferenceSession
+        :param max_batch_size: number of sentences after which a batch is closed. A single abstract
+        longer than that is still predicted in one batch.
+        :param max_wait_ms: time a request waits for others to join its batch.
+        """
+        self.session = session
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.task = None
+        self.carry = None
+        self.stats = {"requests": 0, "batches": 0, "sentences": 0}
+
+    def start(self):
+        """
+        Starts the batching loop, must be called from the running event loop.
+        """
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+    async def predict(self, sentences, serving=None):
+        """
+        Predicts the sentences of one abstract.
+        :param sentences: list of the sentences of the abstract, in order.
+        :param serving: ServingModel to predict with, the session's current one by default.
+        :return: array of class probabilities, one row per sentence.
+        """
+        serving = serving or self.session.serving
+        if not sentences:
+            return np.zeros((0, len(serving.labels)), dtype=np.float32)
+        future = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((sentences, serving, future))
+        return await future
+
+    async def next_batch(self):
+        """
+        :return: list of (sentences, serving, future) of the requests of the next batch, all of one serving model.
+        """
+        loop = asyncio.get_event_loop()
+        first, self.carry = self.carry or await self.queue.get(), None
+        batch, size = [first], len(first[0])
+        deadline = loop.time() + self.max_wait
+
+        while size < self.max_batch_size:
+            timeout = deadline - loop.time()
+            try:
+                item = self.queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self.queue.get(), timeout)
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+            if size + len(item[0]) > self.max_batch_size or item[1] is not first[1]:
+                self.carry = item
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self.next_batch()
+            sentences, line_numbers, total_lines = [], [], []
+            serving = batch[0][1]
+            for request_sentences, _, _ in batch:
+                sentences.extend(request_sentences)
+                line_numbers.extend(range(len(request_sentences)))
+                total_lines.extend([len(request_sentences) - 1] * len(request_sentences))
+
+            try:
+                pred_probs = await loop.run_in_executor(self.executor, self.session.predict_sentences,
+                                                        sentences, line_numbers, total_lines, serving)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            start = 0
+            for request_sentences, _, future in batch:
+                end = start + len(request_sentences)
+                if not future.done():  # the client may have gone away
+                    future.set_result(pred_probs[start:end])
+                start = end
+
+            self.stats["requests"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["sentences"] += len(sentences)
+
+
+class PredictionServer:
+    """
+    Minimal HTTP/1.1 JSON server in front of a MicroBatcher.
+
+    POST /predict with {"abstract": "..."} returns the label of every sentence, GET /health the
+    batching statistics. Abstracts are split into sentences in a thread pool, so parsing a request
+    never holds up the event loop and the other requests waiting for the batcher.
+    """
+
+    def __init__(self, session, batcher, split_workers=2):
+        """
+        :param session: InferenceSession
+        :param batcher: MicroBatcher predicting the sentences.
+        :param split_workers: number of threads splitting abstracts into sentences.
+        """
+        self.session = session
+        self.batcher = batcher
+        self.split_executor = ThreadPoolExecutor(max_workers=split_workers)
+
+    async def predict(self, payload):
+        if not isinstance(payload, dict) or not isinstance(payload.get("abstract"), str):
+            return 400, {"error": "expected a JSON object with an 'abstract' string"}
+        sentences = await asyncio.get_event_loop().run_in_executor(self.split_executor, self.session.split_sentences,
+                                                                   payload["abstract"])
+        serving = self.session.serving  # labels and probabilities come from the same model, even across a hot swap
+        pred_probs = await self.batcher.predict(sentences, serving)
+        return 200, {"predictions": [{"sentence": sentence,
+                                      "line_number": i,
+                                      "total_lines": len(sentences) - 1,
+                                      "label": serving.labels[int(probs.argmax())],
+                                      "confidence": float(probs.max())}
+                                     for i, (sentence, probs) in enumerate(zip(sentences, pred_probs))]}
+
+    async def route(self, method, path, body):
+        if path == "/health":
+            stats = dict(self.batcher.stats)
+            stats["mean_batch_size"] = stats["sentences"] / stats["batches"] if stats["batches"] else 0.0
+            if self.session.cache is not None:
+                stats["cache"] = self.session.cache.stats()
+            stats["model_swaps"] = self.session.swaps
+            return 200, {"status": "ok", "model_version": self.session.model_version, "stats": stats}
+        if path != "/predict":
+            return 404, {"error": f"unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400, {"error": "invalid JSON"}
+        return await self.predict(payload)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_REQUEST_BYTES:
+                    status, response = 413, {"error": "request too large"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    try:
+                        status, response = await self.route(method, path, body)
+                    except Exception as e:
+                        status, response = 500, {"error": str(e)}
+                    keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+
+                data = json.dumps(response).encode('utf-8')
+                writer.write(f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                             f"Content-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(session, host='127.0.0.1', port=8000, max_batch_size=256, max_wait_ms=5.0, split_workers=2):
+    """
+    Runs the prediction server until cancelled.
+    :param session: InferenceSession
+    :param split_workers: number of threads splitting abstracts into sentences.
+    """
+    batcher = MicroBatcher(session, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    batcher.start()
+    prediction_server = PredictionServer(session, batcher, split_workers=split_workers)
+    server = await asyncio.start_server(prediction_server.handle, host, port)
+    print(f"serving on http://{host}:{port} (max batch {max_batch_size} sentences, max wait {max_wait_ms} ms)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+        prediction_server.split_executor.shutdown(wait=True)
+
+
+async def post_json(reader, writer, host, path, payload):
+    """
+    Sends one request over an open keep-alive connection.
+    :return: (status, decoded JSON response)
+    """
+    data = json.dumps(payload).encode('utf-8')
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode('latin-1') + data)
+    await writer.drain()
+    return await read_json_response(reader)
+
+
+async def get_health(host, port):
+    """
+    :return: decoded GET /health response of a running server.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"GET /health HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+        await writer.drain()
+        return (await read_json_response(reader))[1]
+    finally:
+        writer.close()
+
+
+async def read_json_response(reader):
+    """
+    :return: (status, decoded JSON body) of the next response on a connection.
+    """
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode('latin-1').partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def run_load_test(host, port, abstracts, num_requests=1000, concurrency=32):
+    """
+    Sends num_requests abstracts to a running server from concurrency keep-alive connections.
+    Abstracts are cycled through, so with the server's prediction cache on, most requests after the
+    first round are cache hits that skip the model; the report records whether the cache was on
+    and its hit rate during the test.
+    :param abstracts: list of abstract texts, cycled through.
+    :return: dict with the throughput and latency percentiles in ms, and the server's cache use.
+    """
+    health_before = await get_health(host, port)
+    latencies, sentences, errors = [], [], 0
+    next_request = iter(range(num_requests))
+
+    async def client():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for i in next_request:
+                start = time.perf_counter()
+                status, response = await post_json(reader, writer, host, "/predict",
+                                                   {"abstract": abstracts[i % len(abstracts)]})
+                latencies.append(time.perf_counter() - start)
+                if status == 200:
+                    sentences.append(len(response["predictions"]))
+                else:
+                    errors += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    seconds = time.perf_counter() - start
+
+    health_after = await get_health(host, port)
+    cache_before, cache_after = health_before["stats"].get("cache"), health_after["stats"].get("cache")
+    cache = {"enabled": cache_after is not None}
+    if cache_after is not None:
+        hits = cache_after["hits"] - (cache_before or {}).get("hits", 0)
+        lookups = hits + cache_after["misses"] - (cache_before or {}).get("misses", 0)
+        cache.update(hits=hits, hit_rate=round(hits / lookups, 4) if lookups else 0.0)
+        print(f"warning: the server caches predictions, {100 * cache['hit_rate']:.1f}% of the sentences skipped the "
+              f"model. Start serve.py with --cache-size 0 to measure the model")
+
+    latencies_ms = np.array(latencies) * 1000
+    return {"model_version": health_after["model_version"],
+            "prediction_cache": cache,
+            "requests": len(latencies),
+            "errors": errors,
+            "concurrency": concurrency,
+            "seconds": round(seconds, 3),
+            "requests_per_sec": round(len(latencies) / seconds, 1),
+            "sentences_per_sec": round(sum(sentences) / seconds, 1),
+            "p50_ms": round(float(np.percentile(latencies_ms, 50)), 2),
+            "p90_ms": round(float(np.percentile(latencies_ms, 90)), 2),
+            "p99_ms": round(float(np.percentile(latencies_ms, 99)), 2),
+            "max_ms": round(float(latencies_ms.max()), 2)}
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import shutil
+import threading
+import numpy as np
+import tensorflow as tf
+from src.inference import make_features, load_labels, load_serving_model
+
+QUANTIZATIONS = ("float", "dynamic", "int8")
+
+
+def get_tflite_meta_path(tflite_path):
+    return os.path.splitext(tflite_path)[0] + '.json'
+
+
+def calibration_samples(model, store, num_samples=200, seed=42):
+    """
+    Representative dataset for full integer quantization: randomly drawn sentences of a split,
+    one per step, built with the same feature construction as serving.
+    :param model: keras model to be converted, used for the order and dtypes of its inputs.
+    :param store: SampleStore of the split to draw from, usually the train split.
+    :param num_samples: number of sentences.
+    :param seed: seed of the draw.
+    :return: callable returning a generator of lists of model inputs with batch size 1.
+    """
+    indices = np.random.default_rng(seed).choice(len(store), size=min(num_samples, len(store)), replace=False)
+
+    def representative_dataset():
+        for i in indices:
+            features = make_features([store.get_sentence(i)], [int(store.line_number[i])],
+                                     [int(store.total_lines[i])])
+            yield [feature if tensor.dtype == tf.string else tf.cast(feature, tensor.dtype)
+                   for feature, tensor in zip(features, model.inputs)]
+
+    return representative_dataset
+
+
+def convert_to_tflite(model, quantization="float", representative_dataset=None):
+    """
+    Converts a keras model to TFLite. The sentence encoder and the char vectorizer work on
+    strings, which TFLite builtins do not cover, so the converted model keeps them as select
+    TF ops and needs the Flex delegate that ships with the tensorflow pip package.
+    :param model: keras model taking the serving inputs.
+    :param quantization: 'float' for no quantization, 'dynamic' for int8 weights with float
+    activations, 'int8' for int8 weights and activations wherever a builtin int8 kernel exists.
+    Inputs and outputs stay float/string in every case.
+    :param representative_dataset: calibration data, required for 'int8', see calibration_samples.
+    :return: the flatbuffer bytes.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"quantization should be one of {QUANTIZATIONS}, got {quantization}")
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    if quantization == "dynamic":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization == "int8":
+        if representative_dataset is None:
+            raise ValueError("int8 quantization needs a representative dataset")
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.SELECT_TF_OPS]
+    return converter.convert()
+
+
+def export_tflite(model, tflite_path, quantization="float", representative_dataset=None, labels_path=None):
+    """
+    Converts a model and writes it to tflite_path, with a .json file next to it recording the
+    input names in model order, and the labels.json of the model.
+    :param model: keras model taking the serving inputs.
+    :param tflite_path: destination .tflite file.
+    :param labels_path: labels.json to copy next to the converted model.
+    :return: size of the converted model in bytes.
+    """
+    flatbuffer = convert_to_tflite(model, quantization, representative_dataset)
+    os.makedirs(os.path.dirname(tflite_path) or '.', exist_ok=True)
+    with open(tflite_path, 'wb') as f:
+        f.write(flatbuffer)
+    with open(get_tflite_meta_path(tflite_path), 'w') as f:
+        json.dump({"input_names": list(model.input_names), "quantization": quantization}, f)
+    if labels_path and os.path.exists(labels_path):
+        shutil.copy(labels_path, os.path.join(os.path.dirname(tflite_path) or '.', 'labels.json'))
+    print(f"saved {quantization} TFLite model ({len(flatbuffer) / 2 ** 20:.1f} MB) to {tflite_path}")
+    return len(flatbuffer)
+
+
+class TFLiteModel:
+    """
+    TFLite interpreter behind the subset of the keras model API used for serving, so an
+    InferenceSession can run a .tflite file in place of the SavedModel.
+    """
+
+    def __init__(self, tflite_path, num_threads=None):
+        """
+        :param tflite_path: .tflite file written by export_tflite.
+        :param num_threads: number of interpreter threads, None for the TFLite default.
+        """
+        self.interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=num_threads)
+        self.lock = threading.Lock()  # an interpreter is not thread safe
+        details = {detail["name"]: detail for detail in self.interpreter.get_input_details()}
+
+        # the converter names the input tensors serving_default_<keras input name>:0, in no particular order
+        self.input_details = list(details.values())
+        meta_path = get_tflite_meta_path(tflite_path)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                input_names = json.load(f)["input_names"]
+            ordered = [details.get(f"serving_default_{name}:0", details.get(name)) for name in input_names]
+            if all(detail is not None for detail in ordered):
+                self.input_details = ordered
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+
+    def predict_on_batch(self, x):
+        """
+        :param x: list of model inputs, in the order of the keras model inputs.
+        :return: array of class probabilities, one row per sentence.
+        """
+        inputs = []
+        for value, detail in zip(x, self.input_details):
+            value = np.asarray(value.numpy() if hasattr(value, "numpy") else value)
+            if detail["dtype"] not in (np.bytes_, np.object_):
+                value = value.astype(detail["dtype"])
+            inputs.append(value.reshape((len(value),) + tuple(detail["shape_signature"][1:])))
+
+        with self.lock:
+            batch_size = len(inputs[0])
+            if batch_size != self.batch_size:  # resizing reallocates every tensor, skip it for same size batches
+                for value, detail in zip(inputs, self.input_details):
+                    self.interpreter.resize_tensor_input(detail["index"], value.shape)
+                self.interpreter.allocate_tensors()
+                self.batch_size = batch_size
+            for value, detail in zip(inputs, self.input_details):
+                self.interpreter.set_tensor(detail["index"], value)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index).copy()
+
+    def predict(self, x, batch_size=None):
+        """
+        :param x: list of model inputs, in the order of the keras model inputs.
+        :param batch_size: number of sentences per interpreter call, defaults to 32 like keras.
+        :return: array of class probabilities, one row per sentence.
+        """
+        x = [np.asarray(value.numpy() if hasattr(value, "numpy") else value) for value in x]
+        batch_size = batch_size or 32
+        return np.concatenate([self.predict_on_batch([value[start:start + batch_size] for value in x])
+                               for start in range(0, len(x[0]), batch_size)])
+
+
+def get_model_size(model_path):
+    """
+    :param model_path: SavedModel directory or .tflite file.
+    :return: size on disk in bytes.
+    """
+    if os.path.isfile(model_path):
+        return os.path.getsize(model_path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(model_path) for name in files)
+
+
+def benchmark_model(model, store, num_samples=2000, num_latency_samples=200, batch_size=256, reference=None):
+    """
+    Accuracy, batch 1 latency and batched throughput of a model on the first sentences of a split.
+    :param model: keras model or TFLiteModel.
+    :param store: SampleStore of the evaluation split, usually the test split.
+    :param num_samples: number of sentences scored for accuracy and throughput.
+    :param num_latency_samples: number of sentences predicted one at a time for the latency.
+    :param batch_size: batch size of the throughput measurement.
+    :param reference: predicted class ids of a reference model, to report the agreement with it.
+    :return: (dict of metrics, predicted class ids)
+    """
+    num_samples = min(num_samples, len(store))
+    features = make_features([store.get_sentence(i) for i in range(num_samples)],
+                             store.line_number[:num_samples].astype(np.int32),
+                             store.total_lines[:num_samples].astype(np.int32))
+    features = [np.asarray(feature) for feature in features]
+
+    latencies = []
+    for i in range(min(num_latency_samples, num_samples)):
+        start = time.perf_counter()
+        model.predict_on_batch([feature[i:i + 1] for feature in features])
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    preds = np.concatenate([np.asarray(model.predict_on_batch([feature[i:i + batch_size] for feature in features]))
+                            for i in range(0, num_samples, batch_size)]).argmax(axis=1)
+    seconds = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    metrics = {"accuracy": round(float((preds == store.target[:num_samples]).mean()), 4),
+               "latency_p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+               "latency_p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+               "sentences_per_sec": round(num_samples / seconds, 1)}
+    if reference is not None:
+        metrics["agreement"] = round(float((preds == reference).mean()), 4)
+    return metrics, preds
+
+
+def load_backend(model_path, num_threads=None):
+    """
+    :param model_path: SavedModel directory or .tflite file.
+    :return: (loaded model, load time in seconds)
+    """
+    start = time.perf_counter()
+    if model_path.endswith('.tflite'):
+        model = TFLiteModel(model_path, num_threads=num_threads)
+    else:
+        model = load_serving_model(model_path)
+    return model, time.perf_counter() - start
+
+
+def compare_backends(model_paths, store, num_samples=2000, num_latency_samples=200, batch_size=256,
+                     num_threads=None):
+    """
+    Report of size, load time, accuracy, latency and throughput of several variants of a model,
+    and their agreement with the first one.
+    :param model_paths: dict of variant name -> SavedModel directory or .tflite file.
+    :param store: SampleStore of the evaluation split.
+    :return: dict of variant name -> dict of metrics.
+    """
+    report, reference = {}, None
+    for name, model_path in model_paths.items():
+        model, load_seconds = load_backend(model_path, num_threads)
+        metrics, preds = benchmark_model(model, store, num_samples, num_latency_samples, batch_size, reference)
+        if reference is None:
+            reference = preds
+        report[name] = {"path": model_path,
+                        "size_mb": round(get_model_size(model_path) / 2 ** 20, 2),
+                        "load_seconds": round(load_seconds, 3),
+                        **metrics}
+        print(f"{name:>8}: {report[name]}")
+    return report
+
+
+def check_labels(model_path, class_names):
+    """
+    Raises if the labels saved with a model do not match the class ids of the evaluation data.
+    """
+    labels = load_labels(model_path if os.path.isdir(model_path) else os.path.dirname(model_path))
+    if list(labels) != list(class_names):
+        raise ValueError(f"labels of {model_path} {labels} do not match the dataset classes {list(class_names)}")
@@ -0,0 +1,170 @@
+import os
+import json
+import tensorflow as tf
+from src.parsing import iter_samples
+from src.data import (split_chars_tensor, char_ids_tensor, SPLIT_FILES,
+                      LINE_NUMBER_DEPTH, TOTAL_LINES_DEPTH)
+
+TFRECORD_FEATURES = {"text": tf.io.FixedLenFeature([], tf.string),
+                     "label": tf.io.FixedLenFeature([], tf.int64),
+                     "line_number": tf.io.FixedLenFeature([], tf.int64),
+                     "total_lines": tf.io.FixedLenFeature([], tf.int64)}
+COMPRESSION = "GZIP"
+
+
+def get_tfrecords_dir(data_dir):
+    """
+    Default location of the shards, a sibling directory of data_dir, e.g. pubmed-rct/PubMed_20k_RCT_tfrecords/
+    :param data_dir: directory containing train.txt, dev.txt and test.txt.
+    :return: path of the shard directory.
+    """
+    return data_dir.rstrip('/') + '_tfrecords'
+
+
+def read_split_meta(tfrecords_dir, split):
+    """
+    :param tfrecords_dir: directory the shards were exported to.
+    :param split: one of 'train', 'val' or 'test'.
+    :return: dict with the shard names, class names and number of sentences of the split.
+    """
+    with open(os.path.join(tfrecords_dir, f"{split}.json"), "r") as f:
+        return json.load(f)
+
+
+def get_shard_paths(tfrecords_dir, split):
+    """
+    :param tfrecords_dir: directory the shards were exported to.
+    :param split: one of 'train', 'val' or 'test'.
+    :return: list of the shard files of the split, in shard order.
+    """
+    return [os.path.join(tfrecords_dir, name) for name in read_split_meta(tfrecords_dir, split)["shards"]]
+
+
+def make_example(sample, class_ids):
+    """
+    :param sample: line dictionary yielded by iter_samples.
+    :param class_ids: dict of class name -> label id.
+    :return: tf.train.Example
+    """
+    return tf.train.Example(features=tf.train.Features(feature={
+        "text": tf.train.Feature(bytes_list=tf.train.BytesList(value=[sample["text"].encode('utf-8')])),
+        "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[class_ids[sample["target"]]])),
+        "line_number": tf.train.Feature(int64_list=tf.train.Int64List(value=[sample["line_number"]])),
+        "total_lines": tf.train.Feature(int64_list=tf.train.Int64List(value=[sample["total_lines"]]))}))
+
+
+def export_split(filename, split, tfrecords_dir, class_names, num_shards=8):
+    """
+    Streams a split file into num_shards GZIP compressed TFRecord shards. Sentences are written
+    round robin, so shard i holds sentences i, i + num_shards, ... and reading the shards with a
+    deterministic interleave of cycle_length num_shards gives back the original order.
+    A <split>.json file records the shards, the class names and the number of sentences.
+    :param filename: path to a PubMed RCT split file.
+    :param split: one of 'train', 'val' or 'test'.
+    :param tfrecords_dir: directory to write the shards to.
+    :param class_names: class names indexed by label id.
+    :param num_shards: number of shards.
+    :return: number of sentences written.
+    """
+    os.makedirs(tfrecords_dir, exist_ok=True)
+    class_ids = {name: i for i, name in enumerate(class_names)}
+    shards = [f"{split}-{i:05d}-of-{num_shards:05d}.tfrecord.gz" for i in range(num_shards)]
+    options = tf.io.TFRecordOptions(compression_type=COMPRESSION)
+    writers = [tf.io.TFRecordWriter(os.path.join(tfrecords_dir, shard), options) for shard in shards]
+
+    count = 0
+    try:
+        for sample in iter_samples(filename):
+            if sample["target"] not in class_ids:
+                raise ValueError(f"found label not present in the training split: {sample['target']}")
+            writers[count % num_shards].write(make_example(sample, class_ids).SerializeToString())
+            count += 1
+    finally:
+        for writer in writers:
+            writer.close()
+
+    with open(os.path.join(tfrecords_dir, f"{split}.json"), "w") as f:
+        json.dump({"shards": shards, "class_names": list(class_names), "num_examples": count}, f)
+    print(f"wrote {count} {split} sentences to {num_shards} shards in {tfrecords_dir}")
+    return count
+
+
+def export_splits(data_dir, tfrecords_dir, class_names, num_shards=8, splits=tuple(SPLIT_FILES)):
+    """
+    Exports every split of data_dir, see export_split.
+    :return: dict of split -> number of sentences written.
+    """
+    return {split: export_split(data_dir + SPLIT_FILES[split], split, tfrecords_dir, class_names, num_shards)
+            for split in splits}
+
+
+def read_split_texts(tfrecords_dir, split, batch_size=4096):
+    """
+    Streams the sentences of a split from its shards, in split order, without the labels and positions.
+    :param tfrecords_dir: directory the shards were exported to.
+    :param split: one of 'train', 'val' or 'test'.
+    :param batch_size: number of sentences per batch.
+    :return: dataset of batches of sentences.
+    """
+    shard_paths = get_shard_paths(tfrecords_dir, split)
+    dataset = tf.data.Dataset.from_tensor_slices(shard_paths)
+    dataset = dataset.interleave(lambda path: tf.data.TFRecordDataset(path, compression_type=COMPRESSION),
+                                 cycle_length=len(shard_paths), block_length=1, num_parallel_calls=tf.data.AUTOTUNE)
+    text_feature = {"text": TFRECORD_FEATURES["text"]}
+    dataset = dataset.batch(batch_size).map(lambda serialized: tf.io.parse_example(serialized, text_feature)["text"],
+                                            num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def read_split(tfrecords_dir, split, batch_size, features, num_classes, shuffle_buffer=0, deterministic=True,
+               char_table=None, char_ids_length=None, seed=None, with_line_numbers=False):
+    """
+    Reads the shards of a split into batches of model inputs. Shards are read in parallel with
+    interleave and decoded per batch, so the split is never loaded into Python.
+    :param tfrecords_dir: directory the shards were exported to.
+    :param split: one of 'train', 'val' or 'test'.
+    :param batch_size: batch size.
+    :param features: tuple of model inputs, in order, out of 'line_numbers', 'total_lines', 'tokens' and 'chars'.
+    :param num_classes: depth of the one hot labels.
+    :param shuffle_buffer: size of the shuffle buffer, 0 to keep the shards' order.
+    :param deterministic: if True and shuffle_buffer is 0, sentences come out in the original split order;
+    if False, interleave returns whichever shard is ready first.
+    :param char_table: optional char lookup table (see make_char_table), to feed char ids instead of
+    character-spaced strings.
+    :param char_ids_length: number of char ids kept per sentence when char_table is given.
+    :param seed: shuffle seed.
+    :param with_line_numbers: also yield the line number of every sentence, for the per position metrics.
+    :return: dataset of (inputs, one hot labels), or (inputs, one hot labels, line numbers)
+    """
+    shard_paths = get_shard_paths(tfrecords_dir, split)
+    dataset = tf.data.Dataset.from_tensor_slices(shard_paths)
+    dataset = dataset.interleave(lambda path: tf.data.TFRecordDataset(path, compression_type=COMPRESSION),
+                                 cycle_length=len(shard_paths),
+                                 block_length=1,
+                                 num_parallel_calls=tf.data.AUTOTUNE,
+                                 deterministic=deterministic)
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+
+    def to_inputs(serialized):
+        batch = tf.io.parse_example(serialized, TFRECORD_FEATURES)
+        inputs = []
+        for feature in features:
+            if feature == 'tokens':
+                inputs.append(batch["text"])
+            elif feature == 'chars' and char_table is not None:
+                inputs.append(char_ids_tensor(batch["text"], char_table, char_ids_length))
+            elif feature == 'chars':
+                inputs.append(split_chars_tensor(batch["text"]))
+            elif feature == 'line_numbers':
+                inputs.append(tf.one_hot(batch["line_number"], depth=LINE_NUMBER_DEPTH))
+            elif feature == 'total_lines':
+                inputs.append(tf.one_hot(batch["total_lines"], depth=TOTAL_LINES_DEPTH))
+        labels = tf.one_hot(batch["label"], depth=num_classes)
+        if with_line_numbers:
+            return (tuple(inputs) if len(inputs) > 1 else inputs[0]), labels, batch["line_number"]
+        return (tuple(inputs) if len(inputs) > 1 else inputs[0]), labels
+
+    dataset = dataset.batch(batch_size).map(to_inputs, num_parallel_calls=tf.data.AUTOTUNE,
+                                            deterministic=deterministic)
+    return dataset.prefetch(tf.data.AUTOTUNE)
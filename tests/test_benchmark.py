@@ -0,0 +1,28 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+pytest.importorskip("tensorflow")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# imports is left out, it times streamlit and spaCy, which the training environment may not have
+SUITES = ["parsing", "data_loader", "pipelines", "train_steps", "inference"]
+
+
+def test_benchmark_runs_on_a_small_synthetic_corpus(tmp_path):
+    output, baseline = tmp_path / "results.json", tmp_path / "baseline.json"
+    subprocess.run([sys.executable, "benchmark.py", "--size", "20", "--suites", *SUITES, "--parse-workers", "1", "2",
+                    "--batch-size", "8", "--num-batches", "2", "--repeats", "2", "--work-dir", str(tmp_path / "work"),
+                    "--output", str(output), "--baseline", str(baseline), "--update-baseline"],
+                   cwd=ROOT, check=True)
+
+    with open(output, 'r') as f:
+        results = json.load(f)["results"]
+    for name in ("parse/preprocess_text_with_line_numbers", "parse/splits_2_workers", "data_loader/load_splits_warm",
+                 "memory/synthetic/train_sample_store", "pipeline/tribrid", "pipeline/tribrid_bucketed",
+                 "pipeline_memory/tribrid_one_hot", "pipeline_memory/tribrid_integer_features",
+                 "train_step/tribrid", "train_step/char_and_token_bucketed", "inference/batch_1"):
+        assert results[name]["value"] > 0, name
+    assert os.path.exists(baseline)
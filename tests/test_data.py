@@ -0,0 +1,85 @@
+import os
+import json
+import pytest
+
+pytest.importorskip("tensorflow")
+
+import numpy as np  # noqa: E402
+import src.data  # noqa: E402
+from test_parsing import reference_preprocess_text_with_line_numbers, write_split  # noqa: E402
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    data_dir = tmp_path / "corpus"
+    data_dir.mkdir()
+    for num_copies, filename in zip((4, 2, 2), src.data.SPLIT_FILES.values()):
+        write_split(data_dir / filename, num_copies=num_copies)
+    return os.path.join(str(data_dir), '')
+
+
+def cache_dirs(data_dir):
+    return sorted(os.listdir(src.data.get_cache_root(data_dir)))
+
+
+def test_cache_is_reused_until_the_split_file_changes(data_dir):
+    columns, meta = src.data.load_preprocessed_split(data_dir, "train")
+    first_cache_dirs = cache_dirs(data_dir)
+    assert len(first_cache_dirs) == 1
+
+    cached_columns, cached_meta = src.data.load_preprocessed_split(data_dir, "train")
+    assert cache_dirs(data_dir) == first_cache_dirs and cached_meta == meta
+    np.testing.assert_array_equal(cached_columns["text"], columns["text"])
+
+    with open(data_dir + src.data.SPLIT_FILES["train"], 'a') as f:
+        f.write("###30000000\nMETHODS\tA new abstract .\n\n")
+    changed_columns, changed_meta = src.data.load_preprocessed_split(data_dir, "train")
+    assert len(cache_dirs(data_dir)) == 1 and cache_dirs(data_dir) != first_cache_dirs  # the stale cache is removed
+    assert changed_meta["fingerprint"] != meta["fingerprint"]
+    assert len(changed_columns["offsets"]) == len(columns["offsets"]) + 1
+
+
+def test_cache_is_rebuilt_for_a_new_preprocessing_version(data_dir, monkeypatch):
+    src.data.load_preprocessed_split(data_dir, "val")
+    first_cache_dirs = cache_dirs(data_dir)
+    monkeypatch.setattr(src.data, "PREPROCESSING_VERSION", src.data.PREPROCESSING_VERSION + 1)
+    _, meta = src.data.load_preprocessed_split(data_dir, "val")
+    assert meta["version"] == src.data.PREPROCESSING_VERSION
+    assert len(cache_dirs(data_dir)) == 1 and cache_dirs(data_dir) != first_cache_dirs
+
+
+def test_sample_store_round_trip(data_dir, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the DataLoader writes labels.json to the working directory
+    data = src.data.DataLoader(batch_size=4, data_dir=data_dir)
+    for split, filename in src.data.SPLIT_FILES.items():
+        samples = reference_preprocess_text_with_line_numbers(data_dir + filename)
+        store = data.load_split(split)
+
+        assert len(store) == len(samples)
+        assert [store.get_sentence(i) for i in range(len(store))] == [sample["text"] for sample in samples]
+        assert [data.class_names[target] for target in store.target] == [sample["target"] for sample in samples]
+        assert store.line_number.tolist() == [sample["line_number"] for sample in samples]
+        assert store.total_lines.tolist() == [sample["total_lines"] for sample in samples]
+        assert [sentence.decode('utf-8') for sentence in store.sentences().numpy()] == \
+            [sample["text"] for sample in samples]
+        assert store.nbytes == sum(column.nbytes for column in (store.text, store.offsets, store.target,
+                                                                store.line_number, store.total_lines))
+
+
+def test_class_names_come_from_the_train_cache_over_a_stale_labels_json(data_dir, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open(src.data.LABELS_PATH, 'w') as f:
+        json.dump({"0": "stale", "1": "labels"}, f)
+    _, meta = src.data.load_preprocessed_split(data_dir, "train")
+
+    data = src.data.DataLoader(batch_size=4, data_dir=data_dir)
+    assert data.class_names == meta["class_names"]
+    assert len(data.load_split("test")) > 0
+
+
+def test_unsorted_labels_json_is_rejected(data_dir, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open(src.data.LABELS_PATH, 'w') as f:
+        json.dump({"0": "RESULTS", "1": "BACKGROUND"}, f)
+    with pytest.raises(ValueError, match="not the sorted labels"):
+        src.data.DataLoader(batch_size=4, data_dir=data_dir).class_names
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+import src.parsing
+
+# Abstracts in the PubMed RCT format with the cases the parser must keep as they were: unicode, tabs in the text,
+# consecutive blank lines, Windows line endings and a last abstract without its blank separator line.
+ABSTRACTS = [
+    "###24491034\nBACKGROUND\tThe emergence of HIV as a chronic condition .\n"
+    "METHODS\tWe enrolled @ patients in Zürich and Bogotá .\nRESULTS\tMean age was @ years\twith tabs .\n\n",
+    "###24854809\nOBJECTIVE\tTo assess the efficacy of drug A .\nCONCLUSIONS\tDrug A works .\n\n\n",
+    "###25000000\r\nMETHODS\tWindows line endings .\r\nRESULTS\tStill parsed .\r\n\r\n",
+    "###25000001\nBACKGROUND\tA single sentence abstract .\n\n",
+    "###25000002\nRESULTS\tNo separator line at the end of the file .\n",
+]
+
+
+def reference_preprocess_text_with_line_numbers(filename):
+    """
+    preprocess_text_with_line_numbers as it was before the parsing was streamed and sharded: readlines and
+    string concatenation.
+    """
+    with open(filename, 'r') as f:
+        input_lines = f.readlines()
+    abstract_lines = ""
+    abstract_samples = []
+
+    for line in input_lines:
+        if line.startswith("###"):
+            abstract_lines = ""
+        elif line.isspace():
+            abstract_line_split = abstract_lines.splitlines()
+            for abstract_line_number, abstract_line in enumerate(abstract_line_split):
+                target_text_split = abstract_line.split("\t")
+                abstract_samples.append({"target": target_text_split[0],
+                                         "text": target_text_split[1].lower(),
+                                         "line_number": abstract_line_number,
+                                         "total_lines": len(abstract_line_split) - 1})
+        else:
+            abstract_lines += line
+    return abstract_samples
+
+
+def write_split(path, num_copies=1):
+    with open(path, 'w', newline='') as f:
+        f.write("".join(ABSTRACTS[:-1] * num_copies + ABSTRACTS[-1:]))
+    return str(path)
+
+
+def columns_to_samples(columns):
+    text = columns["text"].tobytes()
+    return [{"target": target,
+             "text": text[start:end].decode('utf-8'),
+             "line_number": int(line_number),
+             "total_lines": int(total_lines)}
+            for target, start, end, line_number, total_lines in zip(columns["target"], columns["offsets"][:-1],
+                                                                     columns["offsets"][1:], columns["line_number"],
+                                                                     columns["total_lines"])]
+
+
+def test_preprocess_text_with_line_numbers_matches_reference(tmp_path):
+    filename = write_split(tmp_path / "train.txt")
+    assert src.parsing.preprocess_text_with_line_numbers(filename) == \
+        reference_preprocess_text_with_line_numbers(filename)
+
+
+def test_build_split_columns_matches_reference(tmp_path):
+    filename = write_split(tmp_path / "train.txt")
+    columns = src.parsing.build_split_columns(filename)
+    assert columns_to_samples(columns) == reference_preprocess_text_with_line_numbers(filename)
+    assert columns["text"].tobytes() == "".join(
+        sample["text"] for sample in reference_preprocess_text_with_line_numbers(filename)).encode('utf-8')
+
+
+@pytest.mark.parametrize("num_shards", [2, 3, 7, 50])
+def test_shards_start_at_abstracts_and_cover_the_file(tmp_path, num_shards):
+    filename = write_split(tmp_path / "train.txt", num_copies=10)
+    byte_ranges = src.parsing.find_abstract_boundaries(filename, num_shards)
+    with open(filename, 'rb') as f:
+        contents = f.read()
+
+    assert byte_ranges[0][0] == 0 and byte_ranges[-1][1] == len(contents)
+    assert all(end == next_start for (_, end), (next_start, _) in zip(byte_ranges, byte_ranges[1:]))
+    assert all(contents[start:end].startswith(b"###") for start, end in byte_ranges)
+    sharded = [sample for byte_range in byte_ranges for sample in src.parsing.iter_samples(filename, byte_range)]
+    assert sharded == reference_preprocess_text_with_line_numbers(filename)
+
+
+def test_sharded_build_splits_columns_matches_serial(tmp_path, monkeypatch):
+    filenames = {"train": write_split(tmp_path / "train.txt", num_copies=20),
+                 "val": write_split(tmp_path / "dev.txt", num_copies=3)}
+    serial = src.parsing.build_splits_columns(filenames, num_workers=1)
+    monkeypatch.setattr(src.parsing, "MIN_SHARD_BYTES", 256)  # shard the small files
+    sharded = src.parsing.build_splits_columns(filenames, num_workers=4)
+
+    for split, filename in filenames.items():
+        assert columns_to_samples(serial[split]) == reference_preprocess_text_with_line_numbers(filename)
+        assert sharded[split]["target"] == serial[split]["target"]
+        for name in ("text", "offsets", "line_number", "total_lines"):
+            assert sharded[split][name].dtype == serial[split][name].dtype
+            np.testing.assert_array_equal(sharded[split][name], serial[split][name])
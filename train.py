@@ -1,7 +1,13 @@
-import os, glob, time
-import datetime
+import os, glob, time, shutil, json
 import tensorflow as tf
-import src
+import src.callbacks
+import src.data
+import src.distillation
+import src.distribute
+import src.models
+import src.registry
+import src.tflite
+import src.tfrecords
 from argparse import ArgumentParser
 from tensorflow.keras.utils import plot_model
 
@@ -13,25 +19,17 @@ def gen_model_path():
     This function generates a new directory to save the models
     :return: path to save the model.
     """
-    now = datetime.datetime.now()
-
-    if not os.path.exists(os.getcwd() + '/models'):
-        os.makedirs(os.getcwd() + '/models')
-    else:
-        name = 'model_{}-{}-{}:{}'.format(now.day, now.month, now.hour, now.minute)
-        if not os.path.exists('models/' + name):
-            os.makedirs('models/' + name)
-
-        return 'models/' + name
+    return src.registry.new_model_dir(src.registry.REGISTRY_DIR)
 
 
 def get_latest_model_dir():
     """
     Function to return the latest model.
-    This is based on the time at which the model was created.
+    This is the version registered last in the model registry.
     :return: directory of the latest model
     """
-    return max([os.path.join('src/models', d) for d in os.listdir('src/models')], key=os.path.getmtime)
+    _, manifest = src.registry.get_latest_version(src.registry.REGISTRY_DIR)
+    return os.path.join(src.registry.REGISTRY_DIR, manifest["path"])
 
 
 def check_gpu_status():
@@ -54,28 +52,140 @@ def train(args):
     :param args: contains the training configurations
     :return:
     """
+    # the strategy configures the devices, so it is created before TensorFlow runs anything
+    strategy = src.distribute.make_strategy(args.strategy, num_devices=args.num_devices)
+    num_replicas = strategy.num_replicas_in_sync
     check_gpu_status()
-    save_model_path = gen_model_path()
+    if args.mixed_precision:
+        src.models.set_mixed_precision(args.mixed_precision)  # before any layer is built
+    # every step consumes one global batch, split between the replicas
+    global_batch_size = src.models.BATCH_SIZE * num_replicas
+    src.models.get_data(batch_size=global_batch_size,
+                        rebuild_cache=args.rebuild_cache,
+                        integer_features=args.integer_features,
+                        bucket_by_char_length=args.bucket_chars,
+                        num_workers=args.parse_workers)
+    if args.tfrecords_dir and (args.adapt_char_vocab or args.char_vocab_sample
+                               or not os.path.exists(src.models.CHAR_VOCAB_PATH)):
+        # streamed from the shards, the in memory adapt would load the whole train split
+        src.models.adapt_char_vectorizer_from_tfrecords(args.tfrecords_dir, sample_size=args.char_vocab_sample)
+    elif args.adapt_char_vocab or args.char_vocab_sample:
+        src.models.adapt_char_vectorizer(sample_size=args.char_vocab_sample)
+    elif not args.distill_from:
+        src.models.get_char_vectorizer()  # adapting is not supported inside a strategy scope, do it here if needed
+    # only the chief of a run that saves gets a run directory, the other workers write to get_write_path's temp dirs
+    save_model_path = args.resume
+    if save_model_path is None and not args.no_save and src.distribute.is_chief():
+        save_model_path = gen_model_path()
+    checkpoint_dir = os.path.join(save_model_path, 'checkpoints') if save_model_path else None
 
     tensorboard_callback = src.callbacks.tensorboard_callbacks('src/logs')
     reducde_lr_on_plateau = src.callbacks.reduce_lr_on_plateau()
-    model_checkpoints = src.callbacks.model_checkpoint(save_model_path)
+    training_mode = args.run_name or f"{'xla' if args.jit_compile else 'no-xla'}-{args.mixed_precision or 'float32'}"
+    if not src.distribute.is_chief():
+        task_type, task_index, _ = src.distribute.get_task()
+        training_mode = f"{training_mode}-{task_type}{task_index}"
+    if args.perf_monitor:
+        step_timer = src.callbacks.performance_monitor(training_mode, 'src/logs', global_batch_size=global_batch_size,
+                                                       num_replicas=num_replicas, log_every=args.perf_log_every,
+                                                       profile_steps=args.profile_steps)
+    else:
+        step_timer = src.callbacks.step_timer(training_mode, 'src/logs', global_batch_size=global_batch_size,
+                                              num_replicas=num_replicas)
+    checkpoint_metric = 'hard_output_accuracy' if args.distill_from else 'accuracy'
+    callbacks = [tensorboard_callback, reducde_lr_on_plateau, step_timer]
+    if not args.no_save and src.distribute.is_chief():
+        # weights only checkpoints written in the background, the full model is saved once after training
+        callbacks.append(src.callbacks.async_checkpoint(checkpoint_dir, monitor=checkpoint_metric,
+                                                        keep_best=args.keep_best, keep_last=args.keep_last,
+                                                        blocking=args.blocking_checkpoints))
 
     start = time.time()
 
-    model = src.models.tribrid_model()
-    train_dataset, validation_dataset = src.models.get_data_for_training('tribrid')
+    if args.distill_from:
+        with strategy.scope():
+            model = src.models.student_model(num_buckets=args.student_buckets)
+            training_model = src.distillation.distillation_model(model, temperature=args.temperature,
+                                                                 alpha=args.distill_alpha)
+        train_dataset, validation_dataset = src.distillation.get_distillation_data(src.models.get_data(),
+                                                                                   args.distill_from,
+                                                                                   temperature=args.temperature)
+    else:
+        with strategy.scope():
+            model = training_model = src.models.tribrid_model(cached_embeddings=args.cached_embeddings,
+                                                              bucketed_chars=args.bucket_chars,
+                                                              char_ids=args.char_ids,
+                                                              jit_compile=args.jit_compile)
+        if args.tfrecords_dir:
+            train_dataset, validation_dataset = src.models.get_tfrecord_data_for_training(
+                'tribrid', args.tfrecords_dir, shuffle_buffer=args.shuffle_buffer, char_ids=args.char_ids)
+        else:
+            train_dataset, validation_dataset = src.models.get_data_for_training(
+                'tribrid', cached_embeddings=args.cached_embeddings, char_ids=args.char_ids)
+    if args.strategy == 'multi-worker':
+        # split by shard when every worker gets at least one, by batch otherwise
+        _, _, num_workers = src.distribute.get_task()
+        policy = tf.data.experimental.AutoShardPolicy.DATA
+        if args.tfrecords_dir and len(src.tfrecords.get_shard_paths(args.tfrecords_dir, 'train')) >= num_workers:
+            policy = tf.data.experimental.AutoShardPolicy.FILE
+        train_dataset = src.distribute.shard_dataset(train_dataset, policy)
+        validation_dataset = src.distribute.shard_dataset(validation_dataset, tf.data.experimental.AutoShardPolicy.DATA)
+    initial_epoch = 0
+    if args.resume:
+        checkpoint_path = src.callbacks.latest_checkpoint(checkpoint_dir)
+        if checkpoint_path is None:
+            raise ValueError(f"no checkpoint to resume from in {checkpoint_dir}")
+        with strategy.scope():
+            initial_epoch = src.callbacks.restore_checkpoint(training_model, checkpoint_path) + 1
+    if args.perf_monitor:
+        train_dataset = step_timer.instrument(train_dataset)  # timestamps the batches to measure the input wait
     print(model.summary())
 
-    plot_model(model, to_file='tribrid.png', show_layer_names=True, show_shapes=True, dpi=96)
-    model.fit(train_dataset,
-              epochs=args.epochs,
-              validation_data=validation_dataset,
-              callbacks=[tensorboard_callback, reducde_lr_on_plateau, model_checkpoints])
+    plot_model(model, to_file='student.png' if args.distill_from else 'tribrid.png',
+               show_layer_names=True, show_shapes=True, dpi=96)
+    history = training_model.fit(train_dataset,
+                                 epochs=args.epochs,
+                                 initial_epoch=initial_epoch,
+                                 steps_per_epoch=args.steps_per_epoch,
+                                 validation_data=validation_dataset,
+                                 callbacks=callbacks)
 
     print(f"Time taken to train: {(time.time() - start) / 60:.2f} mins")
-    model.save(save_model_path, save_format='tf')
-    print(f"Done saving the model at: {save_model_path}")
+    if args.no_save:
+        return
+    exported_epoch = history.epoch[-1] if history.epoch else initial_epoch - 1
+    best_path = src.callbacks.best_checkpoint(checkpoint_dir) if checkpoint_dir else None
+    if best_path is not None:
+        # export the best checkpoint kept by the best-K retention rather than the last epoch
+        with strategy.scope():
+            exported_epoch = src.callbacks.restore_checkpoint(training_model, best_path, restore_optimizer=False)
+    if args.cached_embeddings or args.char_ids:
+        model = src.models.to_serving_model(model)  # accept raw sentences and chars again
+    # every worker takes part in saving, only the chief keeps the model
+    write_path = src.distribute.get_write_path(save_model_path)
+    model.save(write_path, save_format='tf')
+    src.distribute.clean_write_path(write_path, save_model_path)
+    if not src.distribute.is_chief():
+        return
+    # keep the label names and char vocabulary the model was trained with next to it
+    shutil.copy(src.data.LABELS_PATH, save_model_path)
+    if os.path.exists(src.models.CHAR_VOCAB_PATH):  # the distilled student has no char vocabulary
+        shutil.copy(src.models.CHAR_VOCAB_PATH, save_model_path)
+    print(f"Done saving the model of epoch {exported_epoch} at: {save_model_path}")
+    metrics = {"epoch": exported_epoch}
+    if exported_epoch in history.epoch:  # the best checkpoint may come from the run that was resumed
+        metrics.update({name: float(values[history.epoch.index(exported_epoch)])
+                        for name, values in history.history.items()})
+    src.registry.register_model(save_model_path, src.registry.get_input_signature(model), metrics=metrics,
+                                training_args=vars(args), activate=args.activate)
+
+    if args.distill_from and args.distill_report_samples:
+        # accuracy cost and speed up of the student over its teacher, on the test split
+        report = src.tflite.compare_backends({"teacher": args.distill_from, "student": save_model_path},
+                                             src.models.get_data().test_store,
+                                             num_samples=args.distill_report_samples)
+        with open(os.path.join(save_model_path, 'distillation_report.json'), 'w') as f:
+            json.dump(report, f, indent=2)
 
 
 if __name__ == '__main__':
@@ -83,8 +193,79 @@ if __name__ == '__main__':
     p = ArgumentParser()
     p.add_argument('--epochs', required=False, type=int, default=50, help='Number of epochs to train on')
     p.add_argument('--train', required=False, type=str, default='True', help='flag to train the data')
+    p.add_argument('--rebuild-cache', action='store_true', help='ignore the preprocessed dataset cache and rebuild it')
+    p.add_argument('--integer-features', action='store_true',
+                   help='one hot encode labels and positional features per batch inside the input pipeline')
+    p.add_argument('--cached-embeddings', action='store_true',
+                   help='encode every split once with the frozen sentence encoder and train on the cached vectors')
+    p.add_argument('--bucket-chars', action='store_true',
+                   help='batch sentences by length and pad the char branch per batch instead of to a fixed length')
+    p.add_argument('--adapt-char-vocab', action='store_true',
+                   help='re-adapt the char vocabulary on the train split instead of loading char_vocab.json')
+    p.add_argument('--char-vocab-sample', required=False, type=int, default=None,
+                   help='re-adapt the char vocabulary on this many randomly sampled train sentences')
+    p.add_argument('--char-ids', action='store_true',
+                   help='compute char ids inside the input pipeline instead of feeding character-spaced strings')
+    p.add_argument('--tfrecords-dir', required=False, type=str, default=None,
+                   help='train from the TFRecord shards written by export_tfrecords.py in this directory')
+    p.add_argument('--shuffle-buffer', required=False, type=int, default=10000,
+                   help='shuffle buffer used when training from TFRecord shards')
+    p.add_argument('--parse-workers', required=False, type=int, default=1,
+                   help='number of processes used to parse dataset splits that are not cached yet. Workers are '
+                        'spawned and re-import the modules of train.py, so only large splits gain from them')
+    p.add_argument('--distill-from', required=False, type=str, default=None,
+                   help='train the small student model on the probabilities of the teacher saved in this directory')
+    p.add_argument('--temperature', required=False, type=float, default=2.0, help='distillation temperature')
+    p.add_argument('--distill-alpha', required=False, type=float, default=0.1,
+                   help='weight of the loss on the labels, the rest goes to the teacher probabilities')
+    p.add_argument('--student-buckets', required=False, type=int, default=src.models.STUDENT_HASH_BUCKETS,
+                   help='number of hashed word n-gram embeddings of the student')
+    p.add_argument('--distill-report-samples', required=False, type=int, default=5000,
+                   help='number of test sentences the student is compared with its teacher on, 0 to skip')
+    p.add_argument('--jit-compile', action='store_true',
+                   help='compile the train step with XLA, needs --cached-embeddings and --char-ids')
+    p.add_argument('--mixed-precision', required=False, type=str, default=None,
+                   choices=['mixed_bfloat16', 'mixed_float16'],
+                   help='train with this keras mixed precision policy, mixed_bfloat16 for CPUs')
+    p.add_argument('--strategy', required=False, type=str, default='single', choices=src.distribute.STRATEGIES,
+                   help='single device, mirrored over the local devices, or multi-worker over the TF_CONFIG cluster')
+    p.add_argument('--num-devices', required=False, type=int, default=2,
+                   help='number of logical CPU devices the mirrored strategy splits the CPU into when there is no GPU')
+    p.add_argument('--steps-per-epoch', required=False, type=int, default=None,
+                   help='number of train steps per epoch, defaults to the whole train split')
+    p.add_argument('--run-name', required=False, type=str, default=None,
+                   help='name of the step_times_<name>.json report, defaults to the training mode')
+    p.add_argument('--no-save', action='store_true', help='do not checkpoint or save the model, for benchmark runs')
+    p.add_argument('--perf-monitor', action='store_true',
+                   help='record step times, input wait, examples/sec and RSS to TensorBoard and step_times_<mode>.json')
+    p.add_argument('--perf-log-every', required=False, type=int, default=10,
+                   help='write the per step scalars of the performance monitor every this many steps')
+    p.add_argument('--profile-steps', required=False, type=int, nargs=2, default=None, metavar=('FIRST', 'LAST'),
+                   help='trace these train steps with the TF profiler, needs --perf-monitor')
+    p.add_argument('--keep-best', required=False, type=int, default=3,
+                   help='number of checkpoints with the best training accuracy kept')
+    p.add_argument('--keep-last', required=False, type=int, default=2, help='number of latest checkpoints kept')
+    p.add_argument('--blocking-checkpoints', action='store_true',
+                   help='write the checkpoints in the training loop, to measure the stall the background writes remove')
+    p.add_argument('--resume', required=False, type=str, default=None,
+                   help='model directory of an interrupted run, to continue from its latest checkpoint')
+    p.add_argument('--activate', action='store_true',
+                   help='make the trained model the active version of the registry, served by app.py and serve.py')
     p.format_usage()
     args = p.parse_args()
 
+    if args.tfrecords_dir and args.cached_embeddings:
+        p.error('--cached-embeddings is not supported with --tfrecords-dir')
+    if args.jit_compile and not (args.cached_embeddings and args.char_ids):
+        p.error('--jit-compile needs --cached-embeddings and --char-ids, XLA cannot compile the string ops of the '
+                'sentence encoder and char vectorizer')
+    if args.distill_from and (args.cached_embeddings or args.char_ids or args.tfrecords_dir):
+        p.error('--distill-from is not supported with --cached-embeddings, --char-ids or --tfrecords-dir')
+
+    if args.resume and not os.path.isdir(os.path.join(args.resume, 'checkpoints')):
+        p.error(f'--resume: {args.resume} has no checkpoints directory')
+    if args.profile_steps and not args.perf_monitor:
+        p.error('--profile-steps needs --perf-monitor')
+
     if args.train == 'True':
         train(args)